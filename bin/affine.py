@@ -2,14 +2,31 @@
 # Compute affine transformation matrix
 
 import argparse
+import cv2
 import gc
 import os
 import numpy as np
 import logging
-from utils.io import load_h5
-from utils.io import save_pickle, load_pickle
-from utils.cropping import reconstruct_image
-from utils.mapping import compute_affine_mapping_cv2, apply_mapping
+from utils.io import load_h5, load_h5_downsampled, open_image_store
+from utils.io import save_tile_payload, load_pickle
+from utils.cache import open_registration_cache
+from utils.tissue import TissueIndex, is_uniform
+from utils.warping import warp_affine, warp_affine_to_store
+from utils.displacement import (
+    downsample_field,
+    get_maps_source_region,
+    get_sampling_maps,
+    get_tile_displacement,
+    remap_region,
+)
+from utils.mapping import (
+    compute_affine_mapping_cv2,
+    compute_diffeomorphic_mapping_dipy,
+    detect_orb_features_grid,
+    normalize_to_uint8,
+    rescale_affine_matrix,
+    compose_affine_matrices,
+)
 from utils import logging_config
 
 # Set up logging configuration
@@ -39,9 +56,10 @@ def _parse_args():
         "-m",
         "--moving_image",
         type=str,
+        nargs="+",
         default=None,
         required=True,
-        help="h5 image file",
+        help="h5 image files, registered in turn against the same fixed image",
     )
     parser.add_argument(
         "-f",
@@ -57,15 +75,7 @@ def _parse_args():
         type=int,
         default=10000,
         required=False,
-        help="Size of the crop",
-    )
-    parser.add_argument(
-        "-oa",
-        "--overlap_size_affine",
-        type=int,
-        default=4000,
-        required=False,
-        help="Size of the overlap",
+        help="Size of the output tiles of the affine warp",
     )
     parser.add_argument(
         "-cd",
@@ -83,6 +93,75 @@ def _parse_args():
         required=False,
         help="Size of the overlap",
     )
+    parser.add_argument(
+        "-ds",
+        "--downscale_factor",
+        type=int,
+        default=8,
+        required=False,
+        help="Downsampling factor of the DAPI level the global affine is estimated on.",
+    )
+    parser.add_argument(
+        "-rf",
+        "--refine_factor",
+        type=int,
+        default=0,
+        required=False,
+        help="Downsampling factor of the finer DAPI level used to refine the global affine (0 disables refinement).",
+    )
+    parser.add_argument(
+        "-t",
+        "--n_threads",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of threads for feature detection and the affine warp.",
+    )
+    parser.add_argument(
+        "-n",
+        "--n_features",
+        type=int,
+        default=2000,
+        required=False,
+        help="Initial number of ORB features per image.",
+    )
+    parser.add_argument(
+        "-ws",
+        "--warm_start_factor",
+        type=int,
+        default=0,
+        required=False,
+        help="Downsampling factor of the whole-slide diffeomorphic field diffeo tiles start from (0 disables warm start).",
+    )
+    parser.add_argument(
+        "-tf",
+        "--tissue_factor",
+        type=int,
+        default=32,
+        required=False,
+        help="Downsampling factor of the tissue index; diffeo tiles without tissue are not written.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        required=False,
+        help="Directory of the content-addressed registration cache. Default is no caching.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Chunk edge (Y and X) of the affine image store. Default is automatic.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        required=False,
+        help="Compression of the affine image store: none, lzf, gzip, lz4 or blosc.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -119,64 +198,312 @@ def get_crops_positions(shape, crop_size, overlap_size):
 
     return positions
 
-def save_stacked_crops(areas, fixed_image_path, moving_image_path, reconstructed_image):
+class FixedReference:
+    """
+    Fixed-image work shared by every moving image of a patient.
+
+    The normalized DAPI pyramid levels and their ORB features are computed
+    on first use and kept for the following moving images, which are all
+    registered in the same process.
+    """
+
+    def __init__(self, path, n_features=2000, n_threads=1):
+        self.path = path
+        self.n_features = n_features
+        self.n_threads = n_threads
+        self.levels = {}
+        self.features = {}
+
+    def get_level(self, factor):
+        """Normalized 8-bit DAPI channel downsampled by `factor`."""
+        if factor not in self.levels:
+            self.levels[factor] = normalize_to_uint8(load_h5_downsampled(self.path, factor))
+        return self.levels[factor]
+
+    def get_features(self, factor):
+        """ORB (points, descriptors) of the DAPI level downsampled by `factor`."""
+        if factor not in self.features:
+            self.features[factor] = detect_orb_features_grid(
+                self.get_level(factor), self.n_features, n_threads=self.n_threads
+            )
+        return self.features[factor]
+
+
+def estimate_affine_matrix(fixed_reference, moving_image_path, downscale_factor=8, refine_factor=0,
+                           cache=None):
+    """
+    Estimate the global affine matrix on a downsampled DAPI pyramid level.
+
+    Only the DAPI channel (last channel) is read, band by band, and
+    downsampled by block averaging. The matrix is estimated at
+    `downscale_factor`, optionally refined at the finer `refine_factor`
+    level, and returned in full-resolution coordinates.
+
+    Args:
+        fixed_reference (FixedReference): Fixed DAPI levels and features.
+        moving_image_path (str): Padded moving image store.
+        downscale_factor (int): Downsampling factor of the estimation level.
+        refine_factor (int): Downsampling factor of the refinement level (0 disables refinement).
+        cache (RegistrationCache, optional): Cache of matrices, keyed on the DAPI levels and parameters.
+
+    Returns:
+        numpy.ndarray: 2x3 affine matrix mapping moving to fixed coordinates.
+    """
+    n_features, n_threads = fixed_reference.n_features, fixed_reference.n_threads
+    moving_level = load_h5_downsampled(moving_image_path, downscale_factor)
+
+    if cache is not None:
+        key = cache.make_key(
+            fixed_reference.get_level(downscale_factor),
+            moving_level,
+            method="orb_partial_affine",
+            downscale_factor=downscale_factor,
+            refine_factor=refine_factor,
+            n_features=n_features,
+        )
+        entry = cache.load("affine", key)
+        if entry is not None:
+            logger.debug(f"Affine - reusing cached matrix: {entry['matrix'].tolist()}")
+            return entry["matrix"]
+
+    logger.debug(f"Affine - estimating matrix at 1/{downscale_factor} resolution")
+    matrix = compute_affine_mapping_cv2(
+        y=fixed_reference.get_level(downscale_factor),
+        x=moving_level,
+        n_features=n_features,
+        n_threads=n_threads,
+        y_features=fixed_reference.get_features(downscale_factor),
+    )
+    if matrix is None:
+        raise ValueError("Affine estimation failed on the downsampled DAPI channels.")
+    matrix = rescale_affine_matrix(matrix, downscale_factor)
+    logger.debug(f"Affine - coarse matrix: {matrix.tolist()}")
+
+    if refine_factor and refine_factor < downscale_factor:
+        logger.debug(f"Affine - refining matrix at 1/{refine_factor} resolution")
+        fixed = fixed_reference.get_level(refine_factor)
+        moving = load_h5_downsampled(moving_image_path, refine_factor)
+        coarse = rescale_affine_matrix(matrix, 1 / refine_factor)
+        moving = cv2.warpAffine(moving, coarse, (fixed.shape[1], fixed.shape[0]))
+        try:
+            residual = compute_affine_mapping_cv2(
+                y=fixed,
+                x=moving,
+                n_features=n_features,
+                n_threads=n_threads,
+                y_features=fixed_reference.get_features(refine_factor),
+            )
+        except (ValueError, cv2.error) as e:
+            logger.debug(f"Affine - refinement failed, keeping coarse matrix: {e}")
+            residual = None
+        if residual is not None:
+            matrix = rescale_affine_matrix(
+                compose_affine_matrices(coarse, residual), refine_factor
+            )
+            logger.debug(f"Affine - refined matrix: {matrix.tolist()}")
+        del moving
+        gc.collect()
+
+    if cache is not None:
+        cache.save("affine", key, matrix=matrix)
+
+    return matrix
+
+def estimate_coarse_field(fixed_reference, affine_image_path, factor, profile="balanced", cache=None):
+    """
+    Estimate a whole-slide diffeomorphic field between the fixed DAPI and the
+    affine-registered moving DAPI, both downsampled by `factor`.
+
+    Diffeo tiles start from this field instead of the identity (warm start).
+
+    Returns:
+        numpy.ndarray: Coarse (y, x, 2) displacement in full-resolution pixels,
+        (row, col) order, or None if either DAPI is blank.
+    """
+    fixed = fixed_reference.get_level(factor)
+    moving = normalize_to_uint8(load_h5_downsampled(affine_image_path, factor))
+    if fixed.min() == fixed.max() or moving.min() == moving.max():
+        return None
+
+    if cache is not None:
+        key = cache.make_key(fixed, moving, method="dipy_coarse_field", factor=factor, profile=profile)
+        entry = cache.load("coarse_field", key)
+        if entry is not None:
+            return entry["field"]
+
+    logger.debug(f"Affine - estimating coarse field at 1/{factor} resolution")
+    mapping = compute_diffeomorphic_mapping_dipy(y=fixed, x=moving, profile=profile)
+    # dipy displacements are in coarse pixels
+    field = mapping.get_forward_field().astype(np.float32) * factor
+
+    if cache is not None:
+        cache.save("coarse_field", key, field=field)
+    return field
+
+def are_all_alphabetic_lowercase(string):
+    # Filter alphabetic characters and check if all are lowercase
+    return all(char.islower() for char in string if char.isalpha())
+
+def get_channels_to_register(moving_image_path, channels_to_register):
+    """
+    Get the moving channels the diffeomorphic step registers (DAPI excluded).
+
+    Channels are taken from the file name, in image order. Lowercase
+    channels are never registered, and nothing is registered when none of
+    the remaining channels is in `channels_to_register`.
+
+    Returns:
+        list: Names of the channels to register.
+    """
+    moving_channels = os.path.basename(moving_image_path) \
+        .split('.')[0] \
+        .split('_')[2:][::-1]
+    current = [
+        ch for ch in moving_channels if ch != 'DAPI' and not are_all_alphabetic_lowercase(ch)
+    ]
+    if not any(ch in channels_to_register for ch in current):
+        return []
+    return current
+
+def get_crop_output_path(area, moving_image_path):
+    start_row, _, start_col, _ = area
+    output_path = f"{start_row}_{start_col}_{os.path.basename(moving_image_path)}.npz"
+    return output_path.replace('padded_', '')
+
+def estimate_tile_matrix(fixed_dapi, moving_dapi, get_fixed_features, n_threads=1, cache=None):
+    """
+    Estimate the residual affine matrix of a tile, reusing a cached one when
+    the same DAPI crops were registered before. `get_fixed_features` returns
+    the ORB features of the fixed crop; it is only called on a cache miss.
+
+    Returns:
+        numpy.ndarray: 2x3 tile matrix, or None if no estimate was found.
+    """
+    if cache is not None:
+        key = cache.make_key(fixed_dapi, moving_dapi, method="orb_tile_affine")
+        entry = cache.load("affine_tile", key)
+        if entry is not None:
+            return entry["matrix"] if entry["matrix"].size else None
+
+    matrix = compute_affine_mapping_cv2(
+        y=fixed_dapi,
+        x=moving_dapi,
+        n_threads=n_threads,
+        y_features=get_fixed_features(),
+    )
+
+    if cache is not None:
+        cache.save("affine_tile", key, matrix=matrix if matrix is not None else np.empty(0))
+    return matrix
+
+def load_warm_started_dapi(affine_image_path, area, coarse_field, factor):
+    """
+    Load the moving DAPI of a tile sampled through a coarse global field.
+
+    Returns:
+        tuple: (moving DAPI, downsampled initial displacement of the tile).
+    """
+    map_x, map_y = get_sampling_maps(coarse_field, factor, area)
+    with open_image_store(affine_image_path) as store:
+        source_region = get_maps_source_region(map_x, map_y, store.shape)
+        dtype = store.dtype
+        if source_region is None:
+            source = None
+        else:
+            source = store.read_region(source_region, channels_to_load=-1)
+
+    start_row, end_row, start_col, end_col = area
+    if source is None:
+        moving_dapi = np.zeros((end_row - start_row, end_col - start_col), dtype=dtype)
+    else:
+        moving_dapi = remap_region(source, map_x, map_y, source_region)
+
+    return moving_dapi, downsample_field(get_tile_displacement(coarse_field, factor, area), factor)
+
+def save_stacked_crops(areas, fixed_image_path, moving_image_paths, affine_image_paths,
+                       channels_to_register, n_threads=1, cache=None, coarse_fields=None,
+                       warm_start_factor=0, tissue_index=None):
+    """
+    Save the tile payloads of every moving image.
+
+    A payload holds the fixed DAPI, the moving DAPI (affine-registered per
+    tile), the tile matrix and the names of the moving channels to register.
+    The channels themselves are warped at stitching time from the affine
+    image with the tile displacement fields. Each fixed crop is read once
+    and its ORB features detected at most once, then reused for all moving
+    images.
+
+    With a coarse field for a moving image (see `estimate_coarse_field`),
+    its moving DAPI is sampled through that field (warm start) and the
+    field is stored in the payload.
+
+    With a tissue index, areas without tissue get no payload: no
+    diffeomorphic task runs on them and stitching keeps the affine image
+    there (a missing tile field is a zero displacement).
+    """
+    if coarse_fields is None:
+        coarse_fields = [None] * len(moving_image_paths)
+    if tissue_index is not None:
+        # Keep every area of a slide without tissue, so each moving image still gets its tiles
+        areas = tissue_index.filter_areas(areas) or areas
+    moving_channels = [
+        get_channels_to_register(path, channels_to_register) for path in moving_image_paths
+    ]
+
     for area in areas:
         logger.debug(f"Affine - processing crop area: {area}")
 
-        start_row, end_row, start_col, end_col = area
-
-        fixed_crop = load_h5(fixed_image_path, loading_region=area)
-        moving_crop = reconstructed_image[start_row:end_row, start_col:end_col, :]
-        patient_id = os.path.basename(moving_image_path)
-        output_path = f"{start_row}_{start_col}_{patient_id}.pkl"
-        output_path = output_path.replace('padded_', '')
-    
-        if len(np.unique(moving_crop[:,:,-1])) != 1 and len(np.unique(fixed_crop[:,:,-1])) != 1:
-            logger.debug(f"Affine - computing transformation: {area}")
-            try:
-                matrix = compute_affine_mapping_cv2(
-                    y=fixed_crop[:,:,-1].squeeze(),
-                    x=moving_crop[:,:,-1].squeeze()
-                )
-                logger.debug(f"Affine - computed transformation: {area}")
-
- 
-                logger.debug(f"Affine - saving crop: {output_path}")
-                save_pickle(
-                    (
-                        fixed_crop,
-                        apply_mapping(matrix, moving_crop, method="cv2"),
-                    ),
-                    output_path,
+        fixed_dapi = load_h5(fixed_image_path, loading_region=area, channels_to_load=-1)
+        fixed_blank = is_uniform(fixed_dapi)
+        fixed_features = []
+
+        def get_fixed_features():
+            # Detected on first use, then shared by all moving images
+            if not fixed_features:
+                fixed_features.append(
+                    detect_orb_features_grid(normalize_to_uint8(fixed_dapi), n_threads=n_threads)
                 )
-                logger.debug(f"Affine - saved crop: {output_path}")
-            except:
-                #if np.mean(fixed_crop!=0) < 0.1 or np.mean(moving_crop!=0) < 0.1:
-                save_pickle(
-                    (
-                        fixed_crop,
-                        moving_crop
-                    ),
-                    output_path,
+            return fixed_features[0]
+
+        for moving_image_path, affine_image_path, names, coarse_field in zip(
+            moving_image_paths, affine_image_paths, moving_channels, coarse_fields
+        ):
+            output_path = get_crop_output_path(area, moving_image_path)
+            initial_field = None
+            if coarse_field is not None:
+                moving_dapi, initial_field = load_warm_started_dapi(
+                    affine_image_path, area, coarse_field, warm_start_factor
                 )
-                #else:
-                #    error_message = "Error in affine transformation. Check the input image."
-                #    logger.debug("Raising ValueError: %s", error_message)
-                #    raise ValueError(error_message)
-                
-        elif len(np.unique(moving_crop[:,:,-1])) == 1 or len(np.unique(fixed_crop[:,:,-1])) == 1:
-            logger.debug(f"Affine - skipping crop: {output_path}")
-            save_pickle(
-                (
-                    fixed_crop,
-                    moving_crop
-                ),
+            else:
+                moving_dapi = load_h5(affine_image_path, loading_region=area, channels_to_load=-1)
+
+            matrix = None
+            if not fixed_blank and not is_uniform(moving_dapi):
+                logger.debug(f"Affine - computing transformation: {area}")
+                try:
+                    tile_matrix = estimate_tile_matrix(
+                        fixed_dapi, moving_dapi, get_fixed_features, n_threads, cache
+                    )
+                    logger.debug(f"Affine - computed transformation: {area}")
+                    moving_dapi = warp_affine(
+                        moving_dapi, tile_matrix, (moving_dapi.shape[1], moving_dapi.shape[0])
+                    )
+                    matrix = tile_matrix
+                except:
+                    logger.debug(f"Affine - keeping the unregistered crop: {area}")
+            else:
+                logger.debug(f"Affine - skipping blank crop: {output_path}")
+
+            logger.debug(f"Affine - saving crop: {output_path}")
+            save_tile_payload(
                 output_path,
+                fixed_dapi,
+                moving_dapi,
+                channels=names,
+                matrix=matrix,
+                initial_field=initial_field,
+                initial_factor=warm_start_factor,
             )
-        else:
-            error_message = "Error in affine transformation. Check the input image."
-            logger.debug("Raising ValueError: %s", error_message)
-            raise ValueError(error_message)
 
 
 def main():
@@ -187,62 +514,84 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    logger.debug(f"Fixed image: {args.fixed_image}, Moving image: {args.moving_image}")
+    logger.debug(f"Fixed image: {args.fixed_image}, Moving images: {args.moving_image}")
 
     channels_to_register = load_pickle(args.channels_to_register)
 
-    if channels_to_register:
-        moving = load_h5(args.moving_image)
-        fixed = load_h5(args.fixed_image)
-
-        moving_shape = moving.shape
+    # Built once per patient from the fixed DAPI, reused by the later tiled stages
+    with open_image_store(args.fixed_image) as store:
+        shape = store.shape
+    tissue_index = TissueIndex.from_dapi(
+        load_h5_downsampled(args.fixed_image, args.tissue_factor), args.tissue_factor, shape
+    )
+    tissue_index.save(f"tissue_{args.patient_id}.npz")
 
-        matrix = compute_affine_mapping_cv2(
-            y=fixed[:, :, -1].squeeze(), 
-            x=moving[:, :, -1].squeeze()
+    if channels_to_register:
+        fixed_reference = FixedReference(
+            args.fixed_image,
+            n_features=args.n_features,
+            n_threads=args.n_threads,
         )
+        cache = open_registration_cache(args.cache_dir)
 
-        del fixed, moving
-        gc.collect()
-
-        reconstructed_image = np.zeros(moving_shape, dtype='uint16')
-        areas_affine = get_crops_positions(moving_shape, args.crop_size_affine, args.overlap_size_affine)
-        for area in areas_affine:
-            logger.debug(f"AREA: {area}")
-            position = (area[0], area[2])
-            crop = apply_mapping(
-                matrix, 
-                load_h5(args.moving_image, loading_region=area), # uint16 
-                method="cv2"
+        affine_image_paths = []
+        coarse_fields = []
+        for moving_image_path in args.moving_image:
+            logger.debug(f"Affine - registering moving image: {moving_image_path}")
+            matrix = estimate_affine_matrix(
+                fixed_reference,
+                moving_image_path,
+                downscale_factor=args.downscale_factor,
+                refine_factor=args.refine_factor,
+                cache=cache,
             )
 
-            logger.debug(f"AFFINE: transformed CROP image dtype : {crop.dtype}")  
-            logger.debug(f"AFFINE: transformed CROP image min and max: {np.min(crop)} , {np.max(crop)}")  
-            
-            crop = crop.astype('uint16')  # Ensure the crop is in uint16 format
-            logger.debug(f"AFFINE: transformed CROP image dtype : {crop.dtype}")
-            logger.debug(f"AFFINE: transformed CROP image min and max: {np.min(crop)} , {np.max(crop)}")  
-            # logger.debug(f"AFFINE: all zeros in CROP: {np.all(crop == 0)}")
-
-            logger.debug(f"CROP SHAPE: {crop.shape}")
-            reconstructed_image = reconstruct_image(
-                reconstructed_image, 
-                crop, 
-                position, 
-                moving_shape, 
-                args.overlap_size_affine
+            # Warp output tile by output tile, straight into the affine image store
+            extension = os.path.basename(moving_image_path).split(".", 1)[1]
+            affine_image_path = f"affine_{os.path.basename(moving_image_path).split('.')[0]}.{extension}"
+            warp_affine_to_store(
+                moving_image_path,
+                affine_image_path,
+                matrix,
+                tile_size=args.crop_size_affine,
+                n_threads=args.n_threads,
+                chunk_size=args.chunk_size,
+                compression=args.compression,
             )
-            logger.debug(f"AFFINE: RECONSTRUCTED IMAGE image dtype : {reconstructed_image.dtype}")  
+            affine_image_paths.append(affine_image_path)
 
-        areas_diffeo = get_crops_positions(moving_shape, args.crop_size_diffeo, args.overlap_size_diffeo)
+            coarse_field = None
+            if args.warm_start_factor:
+                coarse_field = estimate_coarse_field(
+                    fixed_reference, affine_image_path, args.warm_start_factor, cache=cache
+                )
+            coarse_fields.append(coarse_field)
 
-        save_stacked_crops(areas_diffeo, args.fixed_image, args.moving_image, reconstructed_image)
+        areas_diffeo = get_crops_positions(shape, args.crop_size_diffeo, args.overlap_size_diffeo)
 
-        del reconstructed_image
-        gc.collect()
+        save_stacked_crops(
+            areas_diffeo,
+            args.fixed_image,
+            args.moving_image,
+            affine_image_paths,
+            channels_to_register,
+            n_threads=args.n_threads,
+            cache=cache,
+            coarse_fields=coarse_fields,
+            warm_start_factor=args.warm_start_factor,
+            tissue_index=tissue_index,
+        )
 
     else:
-        save_pickle([], f"0_0_{args.patient_id}.pkl")
+        # One placeholder per moving image, so downstream crops can be matched to it;
+        # the empty affine image is never read, as nothing is registered
+        for moving_image_path in args.moving_image:
+            open(f"affine_{os.path.basename(moving_image_path)}", "a").close()
+            save_tile_payload(
+                get_crop_output_path((0, 0, 0, 0), moving_image_path),
+                np.zeros((0, 0)),
+                np.zeros((0, 0)),
+            )
 
 
 if __name__ == "__main__":
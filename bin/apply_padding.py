@@ -3,59 +3,119 @@
 
 import argparse
 import ast
-import gc
 import os
 import numpy as np
 import logging
-import tifffile
 from utils import logging_config
-from utils.io import load_nd2, load_h5, save_h5
+from utils.cropping import get_tile_areas
+from utils.io import ND2RegionReader, create_image_store, get_image_format, open_image_store
+from utils.tiff_reader import TiffRegionReader
 
 # Set up logging configuration
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
 
-def pad_image_to_shape(image, target_shape, constant_values=0):
-    if image.shape[:2] != target_shape:
-        x, y = image.shape[:2]
-        w, z = target_shape
+def get_padding_offsets(image_shape, target_shape):
+    """
+    Get the offsets of an image centred in a zero-padded target shape.
 
-        if w < x or z < y:
-            raise ValueError(
-                "Target shape must be greater than or equal to the image shape."
-            )
+    Args:
+        image_shape (tuple): (height, width) of the image.
+        target_shape (tuple): (height, width) of the padded image.
+
+    Returns:
+        tuple: (pad_top, pad_left) offsets of the image in the padded image.
+    """
+    x, y = image_shape[:2]
+    w, z = target_shape
 
-        pad_height = w - x
-        pad_width = z - y
-
-        # Distribute padding equally on both sides
-        pad_top = pad_height // 2
-        pad_bottom = pad_height - pad_top
-        pad_left = pad_width // 2
-        pad_right = pad_width - pad_left
-
-        # Determine padding for each dimension
-        if image.ndim == 2:
-            # Grayscale image
-            pad_widths = ((pad_top, pad_bottom), (pad_left, pad_right))
-        elif image.ndim == 3:
-            # Color image (e.g., RGB)
-            pad_widths = ((pad_top, pad_bottom), (pad_left, pad_right), (0, 0))
-        else:
-            raise ValueError("Image must be 2D or 3D array.")
-
-        # Apply padding
-        padded_image = np.pad(
-            image,
-            pad_width=pad_widths,
-            mode="constant",
-            constant_values=constant_values,
+    if w < x or z < y:
+        raise ValueError(
+            "Target shape must be greater than or equal to the image shape."
         )
 
-        return padded_image
+    # Distribute padding equally on both sides
+    pad_top = (w - x) // 2
+    pad_left = (z - y) // 2
+
+    return pad_top, pad_left
+
+
+def open_image_reader(path):
+    """
+    Open a lazy reader for a CYX image (nd2, h5/zarr or tiff).
+
+    Returns:
+        tuple: The reader (with `shape`, `dtype` and `close`) and a function
+        reading a (start_row, end_row, start_col, end_col) region as CYX.
+    """
+    image_format = get_image_format(path)
+
+    if image_format == "nd2":
+        reader = ND2RegionReader(path)
+        read_region = reader.read_region
+    elif image_format in ("h5", "zarr", "zarr.zip"):
+        reader = open_image_store(path)
+        read_region = lambda area: reader.read_region(area, shape="CYX")
+    elif image_format == "tiff":
+        reader = TiffRegionReader(path)
+        read_region = reader.read_region
     else:
-        return image
+        raise ValueError(f"Unsupported image format: {path}")
+
+    return reader, read_region
+
+
+def stream_padded_image(path, output_path, target_shape, tile_size=4000,
+                        chunk_size=None, compression=None, virtual_padding=False):
+    """
+    Stream a CYX image into a zero-padded YXC image store, one tile at a time.
+
+    The output store is zero-filled and each input tile is written at its
+    padded offset, so peak memory is about one tile with all its channels.
+    With `virtual_padding`, only the image itself is written and the target
+    shape and offset are recorded as store metadata instead.
+
+    Args:
+        path (str): Input image (nd2, h5/zarr or tiff).
+        output_path (str): Output image store.
+        target_shape (tuple): (height, width) of the padded image.
+        tile_size (int): Size of the tiles streamed at once.
+        chunk_size (int, optional): Chunk edge of the output store.
+        compression (str, optional): Compression of the output store.
+        virtual_padding (bool, optional): Record the padding instead of writing it.
+    """
+    reader, read_region = open_image_reader(path)
+    n_channels, height, width = reader.shape
+    pad_top, pad_left = get_padding_offsets((height, width), target_shape)
+    logger.debug(f"Padding offsets: {(pad_top, pad_left)}, image shape: {reader.shape}")
+
+    if virtual_padding:
+        store_shape = (height, width, n_channels)
+        row_offset, col_offset = 0, 0
+    else:
+        store_shape = (target_shape[0], target_shape[1], n_channels)
+        row_offset, col_offset = pad_top, pad_left
+
+    with create_image_store(
+        output_path,
+        data_shape=store_shape,
+        dtype=reader.dtype,
+        chunk_size=chunk_size,
+        compression=compression,
+    ) as store:
+        for area in get_tile_areas((height, width), tile_size):
+            start_row, end_row, start_col, end_col = area
+            tile = np.transpose(read_region(area), (1, 2, 0))
+            store.write_region(
+                tile,
+                (start_row + row_offset, end_row + row_offset, start_col + col_offset, end_col + col_offset),
+            )
+        if virtual_padding:
+            store.set_virtual_padding(target_shape, (pad_top, pad_left))
+
+    reader.close()
 
 
 def _parse_args():
@@ -77,6 +137,40 @@ def _parse_args():
         required=True,
         help="Padding file containing a single line with shape in text format. E.g. (10, 10).",
     )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=4000,
+        required=False,
+        help="Size of the tiles streamed from the input to the padded image.",
+    )
+    parser.add_argument(
+        "--virtual_padding",
+        action="store_true",
+        help="Record the padding shape and offset as metadata instead of writing zeros.",
+    )
+    parser.add_argument(
+        "--store_format",
+        type=str,
+        default="h5",
+        choices=["h5", "zarr", "zarr.zip"],
+        required=False,
+        help="Format of the output image store.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Chunk edge (Y and X) of the output image store. Default is automatic.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        required=False,
+        help="Compression of the output image store: none, lzf, gzip, lz4 or blosc.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -102,34 +196,23 @@ def main():
         data = file.read()
 
     padding_shape = ast.literal_eval(data)
-    file_extension = os.path.basename(args.image).split(".")[1]
+    outname = os.path.splitext(os.path.basename(args.image))[0] + "." + args.store_format
 
-    if "nd2" in file_extension:
-        padded_image = pad_image_to_shape(
-            np.transpose(load_nd2(args.image), (1, 2, 0)), padding_shape
-        )
-        outname = str.replace(os.path.basename(args.image), "nd2", "h5")
-    elif "h5" in file_extension:
-        padded_image = pad_image_to_shape(
-            np.transpose(load_h5(args.image, shape="CYX"), (1, 2, 0)), padding_shape
-        )
-        outname = os.path.basename(args.image)
-    elif "tiff" in file_extension:
-        padded_image = pad_image_to_shape(
-            np.transpose(tifffile.imread(args.image), (1, 2, 0)), padding_shape
-        )
-        outname = str.replace(os.path.basename(args.image), "tiff", "h5")
-    
     if "preprocessed_" not in outname:
         output_path = "padded_preprocessed_" + outname
     else:
         output_path = "padded_" + outname
 
     logger.debug(f"OUTPUT FILE PADDING: {output_path}")
-    save_h5(padded_image, output_path)
-
-    del padded_image
-    gc.collect()
+    stream_padded_image(
+        args.image,
+        output_path,
+        padding_shape,
+        tile_size=args.tile_size,
+        chunk_size=args.chunk_size,
+        compression=args.compression,
+        virtual_padding=args.virtual_padding,
+    )
 
 
 if __name__ == "__main__":
@@ -11,6 +11,8 @@ import argparse
 import tifffile as tiff
 import logging
 from utils import logging_config
+from utils.cropping import get_tile_areas
+from utils.tiff_reader import TiffRegionReader
 
 # Set up logging configuration
 logging_config.setup_logging()
@@ -24,21 +26,22 @@ def power(image, a):
     return image**a
 
 
-def gamma_correction(image, gamma):
-    max_intensity = np.max(image)
-    image = multiply_image_and_scalar(image, 1.0 / max_intensity)
-    image = power(image, gamma)
-    image = multiply_image_and_scalar(image, max_intensity)
-
-    return image
+def scale_to_unit_range(image, min_val, max_val):
+    """Scale an image to [0, 1] given its channel range; a flat channel maps to 0."""
+    if max_val <= min_val:
+        return np.zeros(image.shape, dtype=np.float64)
+    return (image - min_val) / (max_val - min_val)
 
 
-def normalize_image(image):
-    min_val = image.min(axis=(0, 1), keepdims=True)
-    max_val = image.max(axis=(0, 1), keepdims=True)
-    scaled_image = (image - min_val) / (max_val - min_val)
+def get_channel_range(reader, tile_size):
+    """Compute the minimum and maximum of a channel one tile at a time."""
+    min_val, max_val = np.inf, -np.inf
+    for area in get_tile_areas(reader.shape, tile_size):
+        tile = reader.read_region(area)
+        min_val = min(min_val, tile.min())
+        max_val = max(max_val, tile.max())
 
-    return scaled_image
+    return min_val, max_val
 
 
 def rescale_to_uint8(image):
@@ -69,6 +72,13 @@ def _parse_args():
         nargs='*',
         help="List of tiff single channel images.",
     )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=4096,
+        required=False,
+        help="Size of the tiles processed at once.",
+    )
     parser.add_argument(
         "--log_file",
         type=str,
@@ -93,24 +103,42 @@ if __name__ == "__main__":
     channels_files = args.channels 
     patient_id = args.patient_id
 
-    combined_membrane_channel = []
-    for file in channels_files:
-        if 'VIMENTIN' in file or 'PANCK' in file:
-            combined_membrane_channel.append(
-                normalize_image(tiff.imread(file))
-            )
-        # else:
-        #     shutil.copy(file, os.path.basename(file))
+    membrane_files = [
+        file for file in channels_files if 'VIMENTIN' in file or 'PANCK' in file
+    ]
+    readers = [TiffRegionReader(file) for file in membrane_files]
+    channel_ranges = [get_channel_range(reader, args.tile_size) for reader in readers]
 
-    combined_membrane_channel = np.stack(combined_membrane_channel)
-    
-    combined_membrane_channel = np.max(combined_membrane_channel, axis=0)
+    shape = readers[0].shape
 
-    combined_membrane_channel = gamma_correction(combined_membrane_channel, 0.6)
+    # Each channel is normalized to [0, 1], so the maximum of the combined
+    # channel used by the gamma correction is 1
+    max_intensity = 1.0
 
     output_file = f"{patient_id}_MEMBRANE.tiff"
 
-    tiff.imwrite(output_file, combined_membrane_channel)
+    # Normalize, combine and gamma-correct tile by tile, writing into the
+    # memory-mapped output instead of holding every channel in memory
+    combined_membrane_channel = tiff.memmap(output_file, shape=shape, dtype=np.float64)
+    for area in get_tile_areas(shape, args.tile_size):
+        start_row, end_row, start_col, end_col = area
+        tile = np.max(
+            np.stack([
+                scale_to_unit_range(reader.read_region(area), min_val, max_val)
+                for reader, (min_val, max_val) in zip(readers, channel_ranges)
+            ]),
+            axis=0,
+        )
+        tile = multiply_image_and_scalar(tile, 1.0 / max_intensity)
+        tile = power(tile, 0.6)
+        tile = multiply_image_and_scalar(tile, max_intensity)
+        combined_membrane_channel[start_row:end_row, start_col:end_col] = tile
+
+    combined_membrane_channel.flush()
+    del combined_membrane_channel
+
+    for reader in readers:
+        reader.close()
 
 
 
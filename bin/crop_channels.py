@@ -5,6 +5,7 @@ import os
 import tifffile as tiff
 import logging
 from utils import logging_config
+from utils.tiff_reader import TiffRegionReader
 
 # Set up logging configuration
 logging_config.setup_logging()
@@ -113,21 +114,21 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    channel = tiff.imread(args.channel)
     channel_name = os.path.basename(args.channel).split(".")[0].split("_")[-1]
 
-    shape = channel.shape
     crop_size = args.crop_size
     overlap_size = args.overlap_size
 
-    crops_positions = get_crops_positions(shape, crop_size, overlap_size)
+    # Read one crop at a time: memory stays constant whatever the slide size
+    with TiffRegionReader(args.channel) as channel:
+        crops_positions = get_crops_positions(channel.shape, crop_size, overlap_size)
 
-    for pos in crops_positions:
-        outname = f"{args.patient_id}_{channel_name}_{pos[0]}_{pos[2]}.tiff"
-        logger.debug(f"Crop position: {pos}")
-        crop = channel[pos[0] : pos[1], pos[2] : pos[3]]
+        for pos in crops_positions:
+            outname = f"{args.patient_id}_{channel_name}_{pos[0]}_{pos[2]}.tiff"
+            logger.debug(f"Crop position: {pos}")
+            crop = channel.read_region(pos)
 
-        tiff.imwrite(outname, crop)
+            tiff.imwrite(outname, crop)
 
 
 if __name__ == "__main__":
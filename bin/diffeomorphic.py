@@ -6,8 +6,21 @@ import os
 import numpy as np
 import logging
 import hashlib
-from utils.io import load_pickle, save_h5
-from utils.mapping import compute_diffeomorphic_mapping_dipy, apply_mapping
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from utils.io import load_pickle, load_tile_payload, save_h5
+from utils.mapping import (
+    compute_diffeomorphic_mapping_dipy,
+    apply_mapping,
+    compose_affine_matrices,
+    compute_alignment_score,
+    estimate_translation_phase_correlation,
+    DIPY_PROFILES,
+)
+from utils.cache import open_registration_cache
+from utils.dtypes import cast_to_dtype, get_dtype
+from utils.tissue import is_uniform
+from utils.displacement import downsample_field, get_displacement_field, save_field, upsample_field
 from utils import logging_config
 
 # Set up logging configuration
@@ -40,9 +53,10 @@ def _parse_args():
         "-cr",
         "--crop_image",
         type=str,
+        nargs="+",
         default=None,
         required=True,
-        help="Pickle file containing fixed and moving crops, in this order.",
+        help="Tile payloads (.npz) with the fixed DAPI, the moving DAPI and the moving channels to register.",
     )
     parser.add_argument(
         "-m",
@@ -52,6 +66,83 @@ def _parse_args():
         required=True,
         help="h5 image file",
     )
+    parser.add_argument(
+        "-w",
+        "--n_workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes registering the crops of the batch.",
+    )
+    parser.add_argument(
+        "-fd",
+        "--field_downscale",
+        type=int,
+        default=4,
+        required=False,
+        help="Downsampling factor of the saved displacement fields.",
+    )
+    parser.add_argument(
+        "-pr",
+        "--profile",
+        type=str,
+        default="accurate",
+        choices=list(DIPY_PROFILES),
+        required=False,
+        help="Registration profile: pyramid levels, iterations, CC radius and tolerances.",
+    )
+    parser.add_argument(
+        "--phase_correlation",
+        action="store_true",
+        help="Remove the residual translation of each tile by phase correlation before dipy.",
+    )
+    parser.add_argument(
+        "--max_shift",
+        type=float,
+        default=200,
+        required=False,
+        help="Largest residual translation accepted from phase correlation, in pixels.",
+    )
+    parser.add_argument(
+        "--ncc_threshold",
+        type=float,
+        default=None,
+        required=False,
+        help="DAPI NCC above which a tile skips dipy and keeps its affine/translation alignment.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        required=False,
+        help="Directory of the content-addressed registration cache. Default is no caching.",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Chunk edge (Y and X) of the QC crops. Default is automatic.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        required=False,
+        help="Compression of the QC crops: none, lzf, gzip, lz4 or blosc.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        required=False,
+        help="dtype of the QC crops; 'auto' keeps the input dtype. Default is uint16.",
+    )
+    parser.add_argument(
+        "--validate_dtype",
+        action="store_true",
+        help="Fail instead of casting when a registered DAPI does not already have the configured dtype.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -63,39 +154,118 @@ def _parse_args():
     args = parser.parse_args()
     return args
 
-def main():
-    args = _parse_args()
+def get_random_hash():
+    # Generate random bytes
+    random_data = os.urandom(16)
 
-    handler = logging.FileHandler(args.log_file)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # Create a hash object using SHA256
+    hash_object = hashlib.sha256(random_data)
+
+    # Get the hexadecimal representation of the hash
+    return hash_object.hexdigest()
+
+def save_empty_field(path, field_downscale):
+    save_field(path, np.zeros((0, 0, 2), dtype=np.float32), field_downscale, (0, 0), (0, 0))
+
+def register_tile(fixed_dapi, moving_dapi, matrix, profile="accurate", phase_correlation=False,
+                  max_shift=200, ncc_threshold=None, warm_start=False):
+    """
+    Register the moving DAPI of a tile onto the fixed DAPI.
+
+    Blank tiles keep the tile matrix only. Otherwise the residual
+    translation is removed by phase correlation (optional), then the
+    alignment is scored by NCC on a downsampled grid: tiles at or above
+    `ncc_threshold` are considered aligned and skip the diffeomorphic
+    optimisation, the others are registered with dipy. Warm-started tiles
+    were pre-warped by a coarse field and skip the coarsest dipy level.
 
-    moving_channels = os.path.basename(args.moving_image) \
+    Returns:
+        tuple: (forward field (Y, X, 2), tile matrix including the translation,
+        registered DAPI, info dict with the method, profile, iterations,
+        translation and NCC score).
+    """
+    info = {"method": "none", "profile": profile, "iterations": 0, "translation": (0.0, 0.0), "ncc": 0.0}
+    forward_field = np.zeros(moving_dapi.shape + (2,), dtype=np.float32)
+
+    if is_uniform(moving_dapi) or is_uniform(fixed_dapi):
+        return forward_field, matrix, moving_dapi, info
+
+    if phase_correlation:
+        shift, response = estimate_translation_phase_correlation(
+            fixed_dapi, moving_dapi, max_shift=max_shift
+        )
+        if shift is not None:
+            moving_dapi = apply_mapping(shift, moving_dapi, method="cv2")
+            matrix = compose_affine_matrices(matrix, shift)
+            info["translation"] = tuple(shift[:, 2].tolist())
+
+    info["ncc"] = compute_alignment_score(fixed_dapi, moving_dapi)
+    if ncc_threshold is not None and info["ncc"] >= ncc_threshold:
+        info["method"] = "translation" if phase_correlation else "affine"
+        return forward_field, matrix, moving_dapi, info
+
+    mapping, dipy_info = compute_diffeomorphic_mapping_dipy(
+        y=fixed_dapi,
+        x=moving_dapi,
+        profile=profile,
+        return_info=True,
+        warm_start=warm_start,
+    )
+    info.update(dipy_info, method="syn")
+    forward_field = mapping.get_forward_field()
+    registered_dapi = apply_mapping(mapping, moving_dapi, method="remap")
+
+    return forward_field, matrix, registered_dapi, info
+
+def register_crop(crop_image, moving_image, channels_to_register, field_downscale=4,
+                  chunk_size=None, compression=None, cache_dir=None, profile="accurate",
+                  phase_correlation=False, max_shift=200, ncc_threshold=None, dtype="uint16",
+                  validate_dtype=False):
+    """
+    Register one tile payload and save its displacement field and QC DAPI.
+
+    The field maps each pixel of the tile to the affine image position it
+    samples from (tile matrix and deformation composed), downsampled by
+    `field_downscale`. Channels are warped with it at stitching time.
+
+    Parameters:
+        crop_image (str): Tile payload (.npz) written by affine.py.
+        moving_image (str): Padded moving image the tile comes from.
+        channels_to_register (list): Channels to register for the patient.
+        field_downscale (int, optional): Downsampling factor of the saved field. Default is 4.
+        chunk_size (int, optional): Chunk edge of the QC crop.
+        compression (str, optional): Compression of the QC crop.
+        cache_dir (str, optional): Registration cache directory. A tile whose DAPI
+            crops, tile matrix and parameters were registered before reuses the
+            cached field and QC DAPI instead of running dipy again.
+        profile (str, optional): dipy registration profile. The profile and the
+            number of iterations run are recorded in the field file.
+        phase_correlation (bool, optional): Remove the residual translation of the tile
+            by phase correlation before the diffeomorphic optimisation. Default is False.
+        max_shift (float, optional): Largest residual translation accepted, in pixels. Default is 200.
+        ncc_threshold (float, optional): Tiles whose DAPI NCC reaches this score after the
+            affine and translation steps skip dipy. Default is None (always run dipy).
+        dtype (str, optional): dtype of the QC DAPI, see `utils.dtypes.get_dtype`. Default is uint16.
+        validate_dtype (bool, optional): Fail if the registered DAPI does not already
+            have that dtype. Default is False.
+    """
+    moving_channels = os.path.basename(moving_image) \
         .split('.')[0] \
         .split('_')[2:][::-1] 
     
     logger.debug(f'DIFFEOMORPHIC - MOVING CHANNELS: {moving_channels}')
 
-    moving_channels_no_dapi = [ch for ch in moving_channels if ch != 'DAPI']
-
-    channels_to_register = load_pickle(args.channels_to_register)
     current_channels_to_register = remove_lowercase_channels(moving_channels)
     current_channels_to_register_no_dapi = [ch for ch in current_channels_to_register if ch != 'DAPI']
 
-    # if len(current_channels_to_register_no_dapi) == 3:
-    #     patient_id = os.path.basename(args.crop_image).split('.')[0].split('_')[2]
-    # elif len(current_channels_to_register_no_dapi) == 2:
-    #     patient_id = os.path.basename(args.crop_image).split('.')[0].split('_')[1]
-
-    patient_id = args.moving_image.split('.')[0].split('_')[1]
+    patient_id = moving_image.split('.')[0].split('_')[1]
 
-    crop_id_pos = os.path.basename(args.crop_image).split('.')[0].split('_')[0:3]
+    crop_id_pos = os.path.basename(crop_image).split('.')[0].split('_')[0:3]
     crop_id_pos = [str(e) for e in crop_id_pos]
     crop_name = crop_id_pos + current_channels_to_register_no_dapi[::-1]   
     crop_name = '_'.join(crop_name)
 
-    output_path = f"registered_{crop_name}.h5"
+    output_path = f"field_{crop_name}.npz"
     output_path = output_path.replace('padded_', '')
     
     output_path_dapi = f"qc_{'_'.join(crop_id_pos)}_DAPI.h5"
@@ -103,90 +273,133 @@ def main():
     
     if current_channels_to_register_no_dapi:
         if any([e for e in current_channels_to_register_no_dapi if e in channels_to_register]):
-            fixed, moving = load_pickle(args.crop_image)
-            if len(np.unique(moving[:,:,-1])) != 1 and len(np.unique(fixed[:,:,-1])) != 1:
-                logger.debug(f"Computing mapping: {args.crop_image}")
-                mapping = compute_diffeomorphic_mapping_dipy(
-                    y=fixed[:, :, -1].squeeze(), 
-                    x=moving[:, :, -1].squeeze()
-                )
-#                
-                # Save registered dapi channel for quality control
-                save_h5(
-                    np.squeeze(apply_mapping(mapping, moving[:, :, -1])), 
-                    output_path_dapi
-                )
-
-                logger.debug(f"Applying mapping: {args.crop_image}")
-                registered_images = []
-
-                for idx, ch in enumerate(moving_channels_no_dapi):
-                    if ch in current_channels_to_register_no_dapi:
-                        registered_images.append(apply_mapping(mapping, moving[:, :, idx]))
-
-                registered_images = np.stack(registered_images, axis=-1)
-
-                logger.debug(f"Saving registered image: {args.crop_image}")
-                save_h5(
-                    registered_images, 
-                    output_path
-                )
+            fixed_dapi, moving_dapi, _, payload_channels, matrix, initial_field = load_tile_payload(crop_image)
+            logger.debug(f"Tile payload channels: {payload_channels}")
+            position = (int(crop_id_pos[0]), int(crop_id_pos[1]))
+            qc_dtype = get_dtype(dtype, moving_dapi)
 
-            elif len(np.unique(moving[:,:,-1])) == 1 or len(np.unique(fixed[:,:,-1])) == 1:
-                moving_channels_images = []
-                for idx, ch in enumerate(moving_channels_no_dapi):
-                    if ch in current_channels_to_register_no_dapi:
-                        moving_channels_images.append(moving[:, :, idx])
-
-                moving_channels_images = np.stack(moving_channels_images, axis=-1)
-
-                logger.debug(f"MOVING STACKED IMAGE SHAPE: {moving_channels_images.shape}")
-
-                logger.debug(f"Saving empty crop (unregistered): {args.crop_image}")
-                save_h5(
-                    moving_channels_images, 
-                    output_path
+            cache = open_registration_cache(cache_dir)
+            if cache is not None:
+                warm_start_arrays = () if initial_field is None else (
+                    initial_field[0], np.int64(initial_field[1])
                 )
-                save_h5(
-                    np.squeeze(moving[:,:,-1]), 
-                    output_path_dapi
+                key = cache.make_key(
+                    fixed_dapi,
+                    moving_dapi,
+                    matrix,
+                    *warm_start_arrays,
+                    method="dipy_syn_cc",
+                    field_downscale=field_downscale,
+                    profile=profile,
+                    phase_correlation=phase_correlation,
+                    max_shift=max_shift,
+                    ncc_threshold=ncc_threshold,
                 )
-        else:
-            # Generate random bytes
-            random_data = os.urandom(16)
+                entry = cache.load("diffeo", key)
+                if entry is not None:
+                    logger.debug(f"Reusing cached mapping: {crop_image}")
+                    save_h5(
+                        cast_to_dtype(entry["qc_dapi"], qc_dtype, name="cached QC DAPI"),
+                        output_path_dapi, chunk_size=chunk_size, compression=compression,
+                    )
+                    save_field(
+                        output_path, entry["field"], field_downscale, position, moving_dapi.shape,
+                        profile=profile, iterations=int(entry["iterations"]),
+                        method=str(entry["method"]), cached=True,
+                    )
+                    return
 
-            # Create a hash object using SHA256
-            hash_object = hashlib.sha256(random_data)
+            forward_field, matrix, registered_dapi, info = register_tile(
+                fixed_dapi,
+                moving_dapi,
+                matrix,
+                profile=profile,
+                phase_correlation=phase_correlation,
+                max_shift=max_shift,
+                ncc_threshold=ncc_threshold,
+                warm_start=initial_field is not None,
+            )
+            logger.debug(f"Tile registered: {crop_image} {info}")
+            if initial_field is not None:
+                initial_field = upsample_field(initial_field[0], initial_field[1], moving_dapi.shape)
 
-            # Get the hexadecimal representation of the hash
-            random_hash = hash_object.hexdigest()
-            save_h5(
-                0, 
-                f"registered_0_0_{patient_id}_{random_hash}.h5"
+            # Save registered dapi channel for quality control
+            registered_dapi = cast_to_dtype(
+                registered_dapi, qc_dtype, validate=validate_dtype, name=f"QC DAPI of {crop_image}"
             )
             save_h5(
-                0, 
-                f"qc_0_0_{patient_id}_{random_hash}.h5"
+                registered_dapi,
+                output_path_dapi,
+                chunk_size=chunk_size,
+                compression=compression,
             )
-    else:
-        # Generate random bytes
-        random_data = os.urandom(16)
 
-        # Create a hash object using SHA256
-        hash_object = hashlib.sha256(random_data)
+            logger.debug(f"Saving displacement field: {output_path}")
+            field = downsample_field(
+                get_displacement_field(forward_field, matrix, initial_field), field_downscale
+            )
+            save_field(
+                output_path, field, field_downscale, position, moving_dapi.shape,
+                cached=False, **info,
+            )
 
-        # Get the hexadecimal representation of the hash
-        random_hash = hash_object.hexdigest()
-        if not os.path.exists(f"registered_{patient_id}_{random_hash}.h5"):
+            if cache is not None:
+                cache.save(
+                    "diffeo", key, field=field, qc_dapi=registered_dapi,
+                    iterations=info["iterations"], method=info["method"],
+                )
+        else:
+            random_hash = get_random_hash()
+            save_empty_field(f"field_0_0_{patient_id}_{random_hash}.npz", field_downscale)
             save_h5(
                 0, 
-                f"registered_{patient_id}_{random_hash}.h5"
+                f"qc_0_0_{patient_id}_{random_hash}.h5"
             )
+    else:
+        random_hash = get_random_hash()
+        if not os.path.exists(f"field_{patient_id}_{random_hash}.npz"):
+            save_empty_field(f"field_{patient_id}_{random_hash}.npz", field_downscale)
             save_h5(
                 0, 
                 f"qc_{patient_id}_{random_hash}.h5"
             )
 
+def main():
+    args = _parse_args()
+
+    handler = logging.FileHandler(args.log_file)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    # Loaded once for the whole batch
+    channels_to_register = load_pickle(args.channels_to_register)
+    register = partial(
+        register_crop,
+        moving_image=args.moving_image,
+        channels_to_register=channels_to_register,
+        field_downscale=args.field_downscale,
+        cache_dir=args.cache_dir,
+        profile=args.profile,
+        phase_correlation=args.phase_correlation,
+        max_shift=args.max_shift,
+        ncc_threshold=args.ncc_threshold,
+        chunk_size=args.chunk_size,
+        compression=args.compression,
+        dtype=args.dtype,
+        validate_dtype=args.validate_dtype,
+    )
+
+    logger.debug(f"Registering {len(args.crop_image)} crops with {args.n_workers} workers")
+    if args.n_workers > 1:
+        with ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+            # Consume the results to surface worker exceptions
+            list(executor.map(register, args.crop_image))
+    else:
+        for crop_image in args.crop_image:
+            register(crop_image)
+
+
 if __name__ == "__main__":
     main()
 
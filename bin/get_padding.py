@@ -6,8 +6,8 @@ import os
 import logging
 import tifffile
 import nd2
-import h5py
 from utils import logging_config
+from utils.io import get_image_format, open_image_store
 # from utils.metadata_tools import get_image_file_shape
 
 # Set up logging configuration
@@ -26,7 +26,7 @@ def get_image_file_shape(file, format=None):
         tuple: (width, height) of the image.
     """
     if format is None:
-        format = file.split(".")[-1]
+        format = get_image_format(file)
 
     if format == "tiff" or format == ".tiff":
         with tifffile.TiffFile(file) as tiff:
@@ -43,16 +43,15 @@ def get_image_file_shape(file, format=None):
                 shape_metadata.get("X", 0),
             )
 
-    if format == ".h5" or format == "h5":
-        with h5py.File(file, "r") as f:
-            shape = f["dataset"].shape
-            f.close()
+    if format in (".h5", "h5", "zarr", "zarr.zip"):
+        with open_image_store(file) as store:
+            shape = store.shape
 
     return shape
 
 
 def get_max_axis_value(files):
-    formats = [os.path.basename(file).split(".")[1] for file in files]
+    formats = [get_image_format(file) for file in files]
 
     shapes = [
         (
@@ -102,7 +102,7 @@ def _parse_args():
         default=None,
         required=True,
         nargs='+',
-        help="A list of crops",
+        help="A list of tile displacement fields",
     )
     parser.add_argument(
         "-cs",
@@ -163,20 +163,16 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    original_shape = get_image_file_shape(args.moving, format='.h5')
+    original_shape = get_image_file_shape(args.moving)
 
     matches = []
     for crop_name in args.crops:
         matches.append(len(crop_name.split('.')[0].split('_')[-1]) == 64) # Check if filename ends in a 64 characters hash
 
     if not all(matches):
-        crops_files = args.crops
         dapi_crops_files = args.dapi_crops
-        cr = load_h5(crops_files[0])
-
-        if not isinstance(cr, int):
-            shape = (original_shape[0], original_shape[1])
-            save_dapi_stack(dapi_crops_files, args.moving, args.fixed, shape, args.overlap_size)
+        shape = (original_shape[0], original_shape[1])
+        save_dapi_stack(dapi_crops_files, args.moving, args.fixed, shape, args.overlap_size)
     else:
         touch(f"QCNULL_{args.patient_id}.tiff")
 
@@ -22,6 +22,9 @@ from dask.multiprocessing import get as multiprocessing_get
 from dask.distributed import Client, LocalCluster
 from tqdm.dask import TqdmCallback
 
+from utils.tiff_reader import TiffRegionReader
+from utils.tissue import load_tissue_index
+
 
 def print_memory_usage(prefix=""):
     process = psutil.Process(os.getpid())
@@ -72,8 +75,8 @@ def stitch_array(crops, original_shape, crop_height, crop_width):
     return array
 
 def load_channel_crop(file, crop_positions):
-    image = AICSImage(file).get_image_data("YX")
-    return [image[pos[0]:pos[1], pos[2]:pos[3]] for pos in crop_positions]
+    with TiffRegionReader(file) as reader:
+        return [reader.read_region(pos) for pos in crop_positions]
 
 def import_images(path):
         ### Importing DAPI channel
@@ -88,7 +91,24 @@ def import_images(path):
 
         return img, pixel_microns
 
-def process_crop_from_files(mask_path, channel_path, pos, size_cutoff, chan_name, verbose):
+def get_crop_areas(positions):
+    """
+    (area, core) of each crop listed in positions.pkl.
+
+    Segmentation saves each tile core with the halo area around it; plain
+    (start_row, end_row, start_col, end_col) entries are crops without halo.
+    """
+    crops = []
+    for position in positions:
+        if len(position) == 2:
+            area, core = position
+        else:
+            area = core = position
+        crops.append((tuple(area), tuple(core)))
+    return crops
+
+
+def process_crop_from_files(mask_path, channel_path, area, core, size_cutoff, chan_name, verbose):
     def log(msg):
         if verbose:
             print(msg)
@@ -129,8 +149,12 @@ def process_crop_from_files(mask_path, channel_path, pos, size_cutoff, chan_name
 
     df = intensity_df.join(props_df)
     df.rename(columns={"centroid-0": "y", "centroid-1": "x"}, inplace=True)
-    df["y"] += pos[0]
-    df["x"] += pos[2]
+    df["y"] += area[0]
+    df["x"] += area[2]
+
+    # Nuclei are measured whole on the area, and kept by the one crop whose core holds their centroid
+    in_core = (df["y"] >= core[0]) & (df["y"] < core[1]) & (df["x"] >= core[2]) & (df["x"] < core[3])
+    df = df[in_core]
 
     # Cleaning
     os.remove(mask_path)
@@ -146,39 +170,43 @@ def extract_features_dask_crops(
     size_cutoff=0,
     crop_positions=None,
     verbose=True,
-    write=False
+    write=False,
+    tissue_index=None,
 ):
     segmentation_mask = segmentation_mask.squeeze()
     results_all = []
+    crops = get_crop_areas(crop_positions)
+
+    # Crops without tissue hold no cells: neither saved nor scheduled
+    if tissue_index is not None:
+        crops = [(area, core) for area, core in crops if tissue_index.has_tissue(core)]
+        if verbose:
+            print(f"Crops with tissue: {len(crops)}")
 
     for file in channels_files:
         chan_name = os.path.basename(file).split('.')[0].split('_')[-1]
         if verbose:
             print(f"\n--- Processing channel: {chan_name} ---")
 
-        channel_data, _ = import_images(file)
-        channel_image = channel_data.get_image_data("YX")
-
         print_memory_usage("Before Dask crops: ")
         tasks = []
 
-        for idx, pos in enumerate(crop_positions):
-            crop_mask = segmentation_mask[pos[0]:pos[1], pos[2]:pos[3]]
-            crop_channel = channel_image[pos[0]:pos[1], pos[2]:pos[3]]
+        # Read the channel window by window instead of materialising the slide
+        with TiffRegionReader(file) as channel_reader:
+            for idx, (area, core) in enumerate(crops):
+                # Save crops to temporary .npy files
+                mask_path =  f"cropmask_{chan_name}_{area[0]}.{area[1]}.{area[2]}.{area[3]}.npy"
+                channel_path = f"cropchan_{chan_name}_{area[0]}.{area[1]}.{area[2]}.{area[3]}.npy"
 
-            # Save crops to temporary .npy files
-            mask_path =  f"cropmask_{chan_name}_{pos[0]}.{pos[1]}.{pos[2]}.{pos[3]}.npy"
-            channel_path = f"cropchan_{chan_name}_{pos[0]}.{pos[1]}.{pos[2]}.{pos[3]}.npy"
-    
-            if not os.path.exists(mask_path):
-                np.save(mask_path, crop_mask)
-            if not os.path.exists(channel_path):
-                np.save(channel_path, crop_channel)
+                if not os.path.exists(mask_path):
+                    np.save(mask_path, segmentation_mask[area[0]:area[1], area[2]:area[3]])
+                if not os.path.exists(channel_path):
+                    np.save(channel_path, channel_reader.read_region(area))
 
-            task = delayed(process_crop_from_files)(
-                mask_path, channel_path, pos, size_cutoff, chan_name, verbose
-            )
-            tasks.append(task)
+                task = delayed(process_crop_from_files)(
+                    mask_path, channel_path, area, core, size_cutoff, chan_name, verbose
+                )
+                tasks.append(task)
 
         if verbose:
             print(f"\n--- Dask parallelisation ---")
@@ -222,16 +250,20 @@ def parse_args():
         "--mask_file", required=True, help="Path to segmentation mask .npy file"
     )
     parser.add_argument(
-        "--positions_file", required=True, help="Path to crop positions .pkl file"
+        "--positions_file", required=True, help="Path to the crop positions .pkl file: (area, core) of each segmentation tile"
     )
     parser.add_argument(
         "--outdir", required=True, help="Output directory to save quantification results"
     )
+    parser.add_argument(
+        "--tissue_index", default=None, help="Tissue index (.npz); crops without tissue are skipped"
+    )
     return parser.parse_args()
 
 
 def run_marker_quantification(
-    indir, mask_file, positions_file, outdir, patient_id, extract_features_dask_crops
+    indir, mask_file, positions_file, outdir, patient_id, extract_features_dask_crops,
+    tissue_index_file=None,
 ):
     if not os.path.exists(outdir):
         os.makedirs(outdir, exist_ok=True)
@@ -240,7 +272,8 @@ def run_marker_quantification(
         outdir, f"{patient_id}_segmentation_markers_data_FULL.csv"
     )
 
-    segmentation_mask = np.load(mask_file).squeeze()
+    # Memory-map the mask, crops are read from disk one at a time
+    segmentation_mask = np.load(mask_file, mmap_mode="r").squeeze()
     positions = load_pickle(positions_file)
 
     files = [os.path.join(indir, file) for file in os.listdir(indir)]
@@ -251,6 +284,7 @@ def run_marker_quantification(
         output_file=output_file,
         crop_positions=positions,
         write=True,
+        tissue_index=load_tissue_index(tissue_index_file),
     )
     return markers_data
 
@@ -273,6 +307,7 @@ def main():
         outdir=args.outdir,
         patient_id=args.patient_id,
         extract_features_dask_crops=extract_features_dask_crops,
+        tissue_index_file=args.tissue_index,
     )
 
 
@@ -6,6 +6,7 @@ import tifffile as tiff
 import logging
 import numpy as np
 from utils.cropping import reconstruct_image, image_reconstruction_loop
+from utils.dtypes import cast_to_dtype, get_dtype
 from utils.metadata_tools import get_image_file_shape
 from utils import logging_config
 
@@ -56,6 +57,18 @@ def _parse_args():
         required=False,
         help="Size of the overlap between crops.",
     )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        required=False,
+        help="dtype of the reconstructed channel; 'auto' keeps the input dtype. Default is uint16.",
+    )
+    parser.add_argument(
+        "--validate_dtype",
+        action="store_true",
+        help="Fail instead of casting when a crop does not already have the configured dtype.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -93,16 +106,23 @@ def main():
         get_image_file_shape(args.image)[2],
     )
 
-    reconstructed_channel = np.zeros(original_shape)
+    reconstructed_channel = None
     for file in crops_files:
         sub = os.path.basename(file).split(".")[1].split("_")[-2:]
         position = tuple([int(pos) for pos in sub])
         crop = tiff.imread(file)
+        if reconstructed_channel is None:
+            dtype = get_dtype(args.dtype, crop)
+            reconstructed_channel = np.zeros(original_shape, dtype=dtype)
+        crop = cast_to_dtype(crop, dtype, validate=args.validate_dtype, name=file)
 
         reconstructed_channel = reconstruct_image(
             reconstructed_channel, crop, position, original_shape, overlap_size
         )
 
+    if reconstructed_channel is None:
+        reconstructed_channel = np.zeros(original_shape, dtype=get_dtype(args.dtype, np.uint16))
+
     tiff.imwrite(reconstructed_channel_file, reconstructed_channel)
 
 
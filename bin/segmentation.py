@@ -10,13 +10,28 @@ with support for large image processing through cropping and stitching.
 import argparse
 import os
 import time
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 import numpy as np
 from aicsimageio import AICSImage
-from csbdeep.utils import normalize
 from skimage import segmentation
+import stardist
 from stardist.models import StarDist2D
+import tensorflow as tf
+
+from utils.labels import LabelStitcher, keep_core_labels, offset_labels, relabel_sequential
+from utils.normalization import get_percentiles, normalize_intensity
+from utils.tiling import get_halo_size, get_halo_tiles
+from utils.tiff_reader import TiffRegionReader
+from utils.tissue import load_tissue_index, TissueIndex
+
+# Distance, in pixels, predicted nuclei are expanded by
+EXPAND_DISTANCE = 10
+
+# StarDist release pinned in docker/stardist_segmentation; the batched
+# inference relies on its model internals (see `check_model`)
+STARDIST_VERSION = "0.9.1"
 
 import gc
 
@@ -38,34 +53,6 @@ def save_pickle(object, path):
         pickle.dump(object, file)
 
 
-
-def crop_array(arr: np.ndarray, overlap_size: int) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
-    """
-    Crop a 2D numpy array into a grid of overlapping crops.
-        
-    Args:
-        arr: 2D numpy array
-        overlap_size: Amount of overlap between crops
-            
-    Returns:
-        List of tuples containing (crop, (row_start, col_start))
-    """
-    crops = []
-    positions = []
-    n_rows, n_cols = arr.shape
-    step = max(overlap_size, 1)
-
-    for i in range(0, n_rows - overlap_size, step):
-        for j in range(0, n_cols - overlap_size, step):
-            row_end = min(i + step + overlap_size, n_rows)
-            col_end = min(j + step + overlap_size, n_cols)
-            crop = arr[i:row_end, j:col_end]
-            crops.append((crop, (i, j)))
-            positions.append((i, row_end, j, col_end))
-
-    return crops, positions
-
-
 import os
 from skimage import morphology
 from skimage.filters import gaussian
@@ -98,8 +85,22 @@ def dapi_preprocessing(image):
     return image
 
 
+def split_threads(n_threads: int) -> Tuple[int, int]:
+    """
+    Split the cores of the task between the network and the label rendering.
+
+    The two pools run at the same time, so they share the cores instead of
+    each using all of them.
+
+    Returns:
+        Tuple of (network threads, rendering threads)
+    """
+    n_render = max(1, n_threads // 2)
+    return max(1, n_threads - n_render), n_render
+
+
 class ImageProcessor:
-    """Handles image cropping, stitching, and mask processing operations."""
+    """Handles image preprocessing and mask processing operations."""
 
     @staticmethod
     def dapi_preprocessing(image: np.ndarray) -> np.ndarray:
@@ -110,73 +111,6 @@ class ImageProcessor:
 
         return image
 
-    
-    @staticmethod
-    def crop_array(arr: np.ndarray, overlap_size: int) -> List[Tuple[np.ndarray, Tuple[int, int]]]:
-        """
-        Crop a 2D numpy array into a grid of overlapping crops.
-        
-        Args:
-            arr: 2D numpy array
-            overlap_size: Amount of overlap between crops
-            
-        Returns:
-            List of tuples containing (crop, (row_start, col_start))
-        """
-        crops = []
-        positions = []
-        n_rows, n_cols = arr.shape
-        step = max(overlap_size, 1)
-        
-        for i in range(0, n_rows - overlap_size, step):
-            for j in range(0, n_cols - overlap_size, step):
-                row_end = min(i + step + overlap_size, n_rows)
-                col_end = min(j + step + overlap_size, n_cols)
-                crop = arr[i:row_end, j:col_end]
-                crops.append((crop, (i, j)))
-                positions.append((i, row_end, j, col_end))
-        
-        return crops, positions
-
-    @staticmethod
-    def stitch_array(crops: List[Tuple[np.ndarray, Tuple[int, int]]], 
-                    arr_shape: Tuple[int, int], 
-                    overlap_size: int) -> np.ndarray:
-        """
-        Stitch together overlapping crops to recreate the original array.
-        
-        Args:
-            crops: List of tuples (crop, (row_start, col_start))
-            arr_shape: Shape of the original array (rows, cols)
-            overlap_size: Amount of overlap between crops
-            
-        Returns:
-            Reconstructed 2D numpy array
-        """
-        if not crops:
-            return np.zeros(arr_shape, dtype=np.uint16)
-            
-        stitched = np.zeros(arr_shape, dtype=crops[0][0].dtype)
-        positions = []
-        
-        for crop, (i, j) in crops:
-            rows, cols = crop.shape
-            
-            # Determine the region to use from this crop (skip overlaps)
-            row_start = overlap_size if i > 0 else 0
-            col_start = overlap_size if j > 0 else 0
-            
-            # Calculate placement in stitched array
-            i_start = i + row_start
-            j_start = j + col_start
-            i_end = i + rows
-            j_end = j + cols
-            
-            stitched[i_start:i_end, j_start:j_end] = crop[row_start:rows, col_start:cols]
-            positions.append((i_start, i_end, j_start, j_end))
-        
-        return stitched, positions
-
     @staticmethod
     def remap_mask_crop_values(mask: np.ndarray, offset: int) -> np.ndarray:
         """
@@ -188,33 +122,20 @@ class ImageProcessor:
             offset: Value to add to all non-zero mask values
             
         Returns:
-            Remapped mask array
+            Remapped uint32 mask array (the input itself if already uint32)
         """
-        if offset == 0:
-            return mask
-        
-        remapped_mask = mask.copy()
-        unique_vals = np.unique(mask[mask > 0])
-        
-        for val in unique_vals:
-            remapped_mask[mask == val] = val + offset
-        
-        return remapped_mask
+        return offset_labels(mask, offset)
     
     @staticmethod
     def remap_mask_values(arr: np.ndarray) -> np.ndarray:
         """
         Remap all non-zero values in arr to their rank in ascending order,
-        with 0 preserved as 0.
+        with 0 preserved as 0, through a label lookup table.
+
+        Returns:
+            Remapped uint32 mask array (the input itself if already uint32)
         """
-        # fetch distinct non-zero values, in ascending order
-        nonzero_vals = np.unique(arr[arr != 0])
-        
-        # forge the mapping: value → rank (starting at 1)
-        val_to_rank = {val: i+1 for i, val in enumerate(nonzero_vals)}
-        
-        # apply mapping, keeping 0 as 0
-        return np.vectorize(lambda x: val_to_rank.get(x, 0))(arr)
+        return relabel_sequential(arr)
 
     @staticmethod
     def filter_noise(arr: np.ndarray, quantile: float = 0.01) -> np.ndarray:
@@ -253,6 +174,33 @@ class SegmentationPipeline:
         self.model = StarDist2D(None, name=model_name, basedir=model_path)
         self.verbose = verbose
         self.processor = ImageProcessor()
+        self.reader = None
+        self.check_model()
+
+    def check_model(self) -> None:
+        """
+        Check the StarDist internals the batched inference relies on.
+
+        `predict_probabilities` feeds the Keras model directly and
+        `predict_labels` calls the NMS of the model, both private to
+        StarDist; fail early if an upgrade changed them.
+        """
+        if stardist.__version__ != STARDIST_VERSION:
+            self.log(
+                f'Warning: StarDist {stardist.__version__} found, batched inference '
+                f'was written against {STARDIST_VERSION}'
+            )
+        for name in ('_axes_div_by', '_instances_from_prediction', 'keras_model'):
+            if not hasattr(self.model, name):
+                raise RuntimeError(
+                    f'StarDist {stardist.__version__} models have no {name}, '
+                    f'pin stardist=={STARDIST_VERSION}'
+                )
+        if self.model.config.n_channel_in != 1:
+            raise ValueError(
+                f'The model expects {self.model.config.n_channel_in} input channels, '
+                'segmentation feeds a single DAPI channel'
+            )
     
     def log(self, message: str) -> None:
         """Print message if verbose mode is enabled."""
@@ -262,6 +210,10 @@ class SegmentationPipeline:
     def load_image(self, filepath: str) -> Tuple[np.ndarray, object]:
         """
         Load image and extract pixel size information.
+
+        2D TIFFs are not loaded: the returned array reads windows on demand
+        (see `utils.tiff_reader.TiffRegionReader`), so memory stays at the
+        crops being segmented. Other images are loaded in full.
         
         Args:
             filepath: Path to the image file
@@ -270,10 +222,44 @@ class SegmentationPipeline:
             Tuple of (image_array, pixel_sizes)
         """
         img = AICSImage(filepath)
-        image_data = img.get_image_data("YX")
         pixel_sizes = img.physical_pixel_sizes
+
+        # 2D TIFFs are read lazily: crops decode only their own strips or tiles
+        if filepath.lower().endswith(('.tif', '.tiff')):
+            reader = TiffRegionReader(filepath)
+            if len(reader.shape) == 2:
+                self.reader = reader
+                return reader.array, pixel_sizes
+            reader.close()
+
+        self.log(f'{filepath} is not a 2D TIFF, loading the whole image')
+        image_data = img.get_image_data("YX")
         
         return image_data, pixel_sizes
+
+    def close(self) -> None:
+        """Close the lazily read input image, if any."""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+    
+    def get_intensity_range(self, image: np.ndarray,
+                            pmin: float = 1.0, pmax: float = 99.8) -> Tuple[float, float]:
+        """
+        Get the normalization range of the image, band by band, without copying it.
+        
+        Args:
+            image: Input image array
+            pmin: Lower percentile for normalization
+            pmax: Upper percentile for normalization
+            
+        Returns:
+            Tuple of (low, high) intensities
+        """
+        start_time = time.time()
+        low, high = get_percentiles(image, (pmin, pmax))
+        self.log(f'Percentiles {pmin}/{pmax}: {low:.1f}/{high:.1f} ({time.time() - start_time:.2f}s)')
+        return low, high
     
     def normalize_image(self, image: np.ndarray, 
                        pmin: float = 1.0, pmax: float = 99.8) -> np.ndarray:
@@ -288,7 +274,7 @@ class SegmentationPipeline:
         Returns:
             Normalized image array
         """
-        return normalize(image, pmin, pmax, axis=(0, 1))
+        return normalize_intensity(image, *self.get_intensity_range(image, pmin, pmax))
     
     def predict_whole_image(self, image: np.ndarray) -> np.ndarray:
         """
@@ -307,7 +293,7 @@ class SegmentationPipeline:
         pred, _ = self.model.predict_instances(image, verbose=False)
         
         # Expand labels
-        expanded_pred = segmentation.expand_labels(pred, distance=10, spacing=1)
+        expanded_pred = segmentation.expand_labels(pred, distance=EXPAND_DISTANCE, spacing=1)
         
         elapsed = time.time() - start_time
         self.log(f'Processing time: {elapsed:.2f}s')
@@ -315,50 +301,195 @@ class SegmentationPipeline:
         
         return expanded_pred
 
-    def predict_crops(self, image: np.ndarray, overlap: int = 500) -> np.ndarray:
+    def predict_probabilities(self, crops: List[np.ndarray],
+                              intensity_range: Optional[Tuple[float, float]] = None
+                              ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Run the StarDist network on a batch of same-shaped crops in one call.
+
+        Crops are padded at the end to a multiple of the network divisibility,
+        and the outputs cropped back, as `StarDist2D.predict` does for a
+        single image.
+
+        Args:
+            crops: 2D crops, all of the same shape
+            intensity_range: (low, high) intensities the crops are normalized
+                with; None if they are already normalized
+
+        Returns:
+            List of (probability, distances) per crop, at the resolution of the model grid
+        """
+        if intensity_range is not None:
+            crops = [normalize_intensity(crop, *intensity_range) for crop in crops]
+        height, width = crops[0].shape
+        div_by = self.model._axes_div_by('YX')
+        grid = self.model.config.grid
+        pad = ((-height) % div_by[0], (-width) % div_by[1])
+        batch = np.stack([
+            np.pad(crop, ((0, pad[0]), (0, pad[1])), mode='reflect') for crop in crops
+        ])[..., np.newaxis].astype(np.float32)
+
+        outputs = self.model.keras_model.predict(batch, batch_size=len(crops), verbose=0)
+        # StarDist models output (probability, distances[, class probabilities])
+        if not isinstance(outputs, (list, tuple)) or len(outputs) < 2:
+            raise RuntimeError('Unexpected StarDist network outputs, expected probability and distances')
+        prob, dist = outputs[:2]
+        if prob.ndim != 4 or prob.shape[-1] != 1 or dist.shape[-1] != self.model.config.n_rays:
+            raise RuntimeError(
+                f'Unexpected StarDist output shapes {prob.shape} and {dist.shape}, '
+                f'expected (batch, y, x, 1) and (batch, y, x, {self.model.config.n_rays})'
+            )
+        rows = (height + pad[0]) // grid[0] - pad[0] // grid[0]
+        cols = (width + pad[1]) // grid[1] - pad[1] // grid[1]
+
+        return [
+            (prob[idx, :rows, :cols, 0], np.maximum(1e-3, dist[idx, :rows, :cols]))
+            for idx in range(len(crops))
+        ]
+
+    def predict_labels(self, shape: Tuple[int, int], prob: np.ndarray, dist: np.ndarray) -> np.ndarray:
+        """
+        Turn the network outputs of a crop into expanded instance labels
+        (NMS, polygon rendering and label expansion).
+
+        Args:
+            shape: Shape of the crop
+            prob: Object probabilities of the crop
+            dist: Ray distances of the crop
+
+        Returns:
+            Expanded label image of the crop
+        """
+        pred, _ = self.model._instances_from_prediction(
+            shape,
+            prob,
+            dist,
+            prob_thresh=self.model.thresholds.prob,
+            nms_thresh=self.model.thresholds.nms,
+        )
+        return segmentation.expand_labels(pred, distance=EXPAND_DISTANCE, spacing=1)
+
+    def predict_crops(self, image: np.ndarray, tile_size: int = 4096, halo: int = 74,
+                      tissue_index: Optional[TissueIndex] = None,
+                      offset: Tuple[int, int] = (0, 0),
+                      batch_size: int = 4, n_workers: int = 1,
+                      output_path: str = 'segmentation_mask.npy',
+                      iou_threshold: float = 0.5,
+                      intensity_range: Optional[Tuple[float, float]] = None) -> np.ndarray:
         """
         Perform segmentation on image crops and stitch results.
+
+        Crops are non-overlapping tile cores read with a halo of context
+        (see `utils.tiling.get_halo_tiles`); each crop keeps the nuclei whose
+        centroid lies in its core, so only the halos are predicted twice.
+        Crops are fed to the network in batches of same-shaped crops. The
+        NMS and label rendering of a batch run in a pool of `n_workers`
+        threads while the network predicts the next batch, so at most two
+        batches of network outputs are held in memory. Rendered crops are
+        stitched in order into the on-disk mask at `output_path`, nuclei
+        split by crop borders being merged (see `utils.labels.LabelStitcher`).
         
         Args:
             image: Input image array
-            overlap: Overlap size between crops
+            tile_size: Size of the tile cores
+            halo: Context read around each core, wider than a nucleus plus
+                the label expansion (see `utils.tiling.get_halo_size`)
+            tissue_index: Optional tissue index of the slide; crops without
+                tissue are left empty instead of being predicted
+            offset: (row, col) of the image in the slide the index describes
+            batch_size: Number of crops predicted by one network call
+            n_workers: Number of threads rendering the labels
+            output_path: Path of the stitched .npy mask
+            iou_threshold: IoU above which labels of overlapping crops are merged
+            intensity_range: (low, high) intensities each crop is normalized with
+                just before inference; None if the image is already normalized
             
         Returns:
-            Stitched segmentation mask
+            Stitched segmentation mask, memory-mapped from `output_path`,
+            and the (area, core) of each tile, both as
+            (row_start, row_end, col_start, col_end)
         """
-        crops, positions = self.processor.crop_array(image, overlap)
-        expanded_preds = []
-        max_value_so_far = 0
-        
-        for idx, (crop, pos) in enumerate(crops):
+        # Crops are read from the (possibly lazy) image only when predicted
+        crops = get_halo_tiles(image.shape, tile_size, halo)
+        positions = list(crops)
+        labels = [None] * len(crops)
+        timings = [{'predict': 0.0, 'labels': 0.0} for _ in crops]
+
+        def get_shape(idx):
+            area = crops[idx][0]
+            return (area[1] - area[0], area[3] - area[2])
+
+        def read_crop(idx):
+            area = crops[idx][0]
+            return np.asarray(image[area[0]:area[1], area[2]:area[3]])
+
+        # Batches of consecutive crops with tissue and of the same shape
+        batches = []
+        for idx, (_, core) in enumerate(crops):
+            if tissue_index is not None:
+                slide_core = (core[0] + offset[0], core[1] + offset[0], core[2] + offset[1], core[3] + offset[1])
+                if not tissue_index.has_tissue(slide_core):
+                    labels[idx] = np.zeros(get_shape(idx), dtype=np.uint32)
+                    continue
+            if batches and len(batches[-1]) < batch_size \
+                    and get_shape(batches[-1][0]) == get_shape(idx):
+                batches[-1].append(idx)
+            else:
+                batches.append([idx])
+        self.log(f'{len(crops)} crops, {sum(map(len, batches))} with tissue, in {len(batches)} batches')
+
+        def render(idx, prob, dist):
             start_time = time.time()
-            self.log(f'Processing crop {idx + 1}/{len(crops)}')
-            
-            # Predict instances
-            self.log(f'Preprocessing crop (shape: {crop.shape})')
-            # crop = self.processor.dapi_preprocessing(crop)
-            self.log(f'Predicting instances for crop at position {pos}')
-            pred, _ = self.model.predict_instances(crop, verbose=False)
-            
-            # Remap values for consistent labeling across crops
-            if idx > 0:
-                pred = self.processor.remap_mask_crop_values(pred, max_value_so_far)
-                self.log(f'  Remapped values: offset={max_value_so_far}')
-            
-            # Expand labels
-            expanded_pred = segmentation.expand_labels(pred, distance=10, spacing=1)
-            max_value_so_far = max(max_value_so_far, np.max(expanded_pred))
-            
-            expanded_preds.append((expanded_pred, pos))
-            
-            elapsed = time.time() - start_time
-            self.log(f'  Processing time: {elapsed:.2f}s')
-            self.log(f'  Unique labels: {len(np.unique(expanded_pred))}')
-        
-        # Stitch crops together
-        self.log('Stitching crops...')
-        stitched_mask, _ = self.processor.stitch_array(expanded_preds, image.shape, overlap)
-        stitched_mask = self.processor.remap_mask_values(stitched_mask)
+            labels[idx] = self.predict_labels(get_shape(idx), prob, dist)
+            timings[idx]['labels'] = time.time() - start_time
+
+        stitcher = LabelStitcher(output_path, image.shape, iou_threshold=iou_threshold)
+        stitched = [0]
+
+        def stitch(until):
+            # Stitch rendered crops in crop order, then release them
+            for idx in range(stitched[0], until):
+                area, core = crops[idx]
+                start_time = time.time()
+                merged = 0
+                tile_labels = keep_core_labels(labels[idx], area, core)
+                if tile_labels.any():
+                    merged = stitcher.add_tile(tile_labels, area)
+                labels[idx] = None
+                self.log(
+                    f'Crop {idx + 1}/{len(crops)} core {core}: '
+                    f'predict {timings[idx]["predict"]:.2f}s, labels {timings[idx]["labels"]:.2f}s, '
+                    f'stitch {time.time() - start_time:.2f}s, merged {merged}'
+                )
+            stitched[0] = until
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pending = []
+            for batch in batches:
+                start_time = time.time()
+                outputs = self.predict_probabilities(
+                    [read_crop(idx) for idx in batch], intensity_range
+                )
+                elapsed = time.time() - start_time
+                for idx in batch:
+                    timings[idx]['predict'] = elapsed / len(batch)
+
+                # Finish the previous batch before queueing this one, to bound memory
+                for future in pending:
+                    future.result()
+                stitch(batch[0])
+                pending = [
+                    executor.submit(render, idx, prob, dist)
+                    for idx, (prob, dist) in zip(batch, outputs)
+                ]
+                del outputs
+            for future in pending:
+                future.result()
+        stitch(len(crops))
+
+        self.log('Relabelling stitched mask...')
+        stitched_mask, n_labels = stitcher.finalize()
+        self.log(f'Labels after merging: {n_labels}')
         
         return stitched_mask, positions
 
@@ -401,10 +532,17 @@ Example usage:
     )
     
     parser.add_argument(
-        '--overlap',
+        '--tile-size',
+        type=int,
+        default=4096,
+        help='Size of the tile cores (default: 4096, ignored with --whole_image)'
+    )
+    
+    parser.add_argument(
+        '--max-nucleus-diameter',
         type=int,
-        default=500,
-        help='Overlap size for image cropping (default: 500, ignored if --no-crop is used)'
+        default=64,
+        help='Largest nucleus diameter in pixels, sets the halo read around each tile (default: 64)'
     )
     
     parser.add_argument(
@@ -415,6 +553,34 @@ Example usage:
         help='Crop region as row_start row_end col_start col_end'
     )
     
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=4,
+        help='Number of crops predicted by one network call (default: 4)'
+    )
+    
+    parser.add_argument(
+        '--n-workers',
+        type=int,
+        default=1,
+        help='Cores of the task, split between the network and the label rendering (default: 1)'
+    )
+    
+    parser.add_argument(
+        '--iou-threshold',
+        type=float,
+        default=0.5,
+        help='IoU above which labels of overlapping crops are merged (default: 0.5)'
+    )
+    
+    parser.add_argument(
+        '--tissue-index',
+        type=str,
+        default=None,
+        help='Tissue index (.npz) of the slide; crops without tissue are skipped'
+    )
+    
     parser.add_argument(
         '--output-dir',
         type=str,
@@ -445,6 +611,11 @@ def main():
     # Create output directory
     os.makedirs(args.output_dir, exist_ok=True)
     
+    # The network and the label rendering run concurrently and share the
+    # cores of the task; threads are set before the model is built
+    n_network, n_render = split_threads(args.n_workers)
+    tf.config.threading.set_intra_op_parallelism_threads(n_network)
+    
     # Initialize pipeline
     pipeline = SegmentationPipeline(args.model_dir, args.model_name, args.verbose)
     
@@ -452,47 +623,65 @@ def main():
     pipeline.log(f"Loading DAPI image: {args.dapi_file}")
     dapi_image, pixel_sizes = pipeline.load_image(args.dapi_file)
     
-    # Normalize image
-    pipeline.log("Normalizing image...")
-    dapi_normalized = pipeline.normalize_image(dapi_image)
-    
-    del dapi_image
-    gc.collect()
+    # Normalization range of the whole slide; crops are normalized at inference time
+    pipeline.log("Computing normalization percentiles...")
+    intensity_range = pipeline.get_intensity_range(dapi_image)
     
     # Apply crop if specified
+    offset = (0, 0)
     if args.crop:
         row_start, row_end, col_start, col_end = args.crop
-        image_to_process = dapi_normalized[row_start:row_end, col_start:col_end]
+        image_to_process = dapi_image[row_start:row_end, col_start:col_end]
+        offset = (row_start, col_start)
         pipeline.log(f"Applied crop: [{row_start}:{row_end}, {col_start}:{col_end}]")
     else:
-        image_to_process = dapi_normalized
+        image_to_process = dapi_image
         
     pipeline.log(f"Processing image shape: {image_to_process.shape}")
     
     # Perform segmentation
     start_time = time.time()
+    basename = os.path.basename(args.dapi_file)
+    mask_path = os.path.join(args.output_dir, f'segmentation_mask.npy')
     
+    # Halo of the tiles, also used by quantification to measure whole nuclei
+    halo = get_halo_size(args.max_nucleus_diameter, EXPAND_DISTANCE)
+
     if args.whole_image:
         pipeline.log("Processing entire image without cropping...")
-        segmentation_mask = pipeline.predict_whole_image(image_to_process)
-        _, positions = crop_array(image_to_process, args.overlap)
+        segmentation_mask = pipeline.predict_whole_image(
+            normalize_intensity(np.asarray(image_to_process), *intensity_range)
+        )
+        positions = get_halo_tiles(image_to_process.shape, args.tile_size, halo)
+        np.save(mask_path, segmentation_mask)
     else:
-        pipeline.log(f"Processing image with crops (overlap: {args.overlap})...")
-        segmentation_mask, positions = pipeline.predict_crops(image_to_process, args.overlap)
+        # Crops are stitched straight into the mask file
+        pipeline.log(f"Processing image with crops (tile size: {args.tile_size}, halo: {halo})...")
+        segmentation_mask, positions = pipeline.predict_crops(
+            image_to_process,
+            args.tile_size,
+            halo,
+            load_tissue_index(args.tissue_index),
+            offset,
+            batch_size=args.batch_size,
+            n_workers=n_render,
+            output_path=mask_path,
+            iou_threshold=args.iou_threshold,
+            intensity_range=intensity_range,
+        )
     
     total_time = time.time() - start_time
     
     pipeline.log(f"Segmentation completed in {total_time:.2f}s")
-    pipeline.log(f"Total unique labels: {len(np.unique(segmentation_mask))}")
-    
-    # Save segmentation mask
-    basename = os.path.basename(args.dapi_file)
-    mask_path = os.path.join(args.output_dir, f'segmentation_mask.npy')
-    np.save(mask_path, segmentation_mask)
+    # Labels are consecutive
+    pipeline.log(f"Total labels: {int(segmentation_mask.max(initial=0))}")
     pipeline.log(f"Segmentation mask saved to: {mask_path}")
 
+    # (area, core) of each tile: quantification measures nuclei on the area
+    # and keeps those whose centroid lies in the core
     save_pickle(positions, os.path.join(args.output_dir, 'positions.pkl'))
     pipeline.log("Segmentation mask saved as pickle file.")
+    pipeline.close()
 
 
 if __name__ == "__main__":
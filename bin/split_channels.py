@@ -5,7 +5,9 @@ import os
 import tifffile as tiff
 import logging
 from utils import logging_config
-from utils.io import load_nd2, load_h5
+from utils.cropping import get_tile_areas
+from utils.io import ND2RegionReader, get_image_format, open_image_store
+from utils.tiff_reader import TiffRegionReader
 
 
 # Set up logging configuration
@@ -32,6 +34,13 @@ def _parse_args():
         required=True,
         help="Path to nd2 multichannel image.",
     )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=4000,
+        required=False,
+        help="Size of the tiles streamed from the input image.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -54,16 +63,19 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    # image = load_nd2(args.image)
-
-    extension = args.image.split(".")[1]
+    image_format = get_image_format(args.image)
 
-    if extension == "nd2":
-        image = load_nd2(args.image)
-    elif extension == "h5":
-        image = load_h5(args.image)
-    elif extension == "tiff":
-        image = tiff.imread(args.image)
+    if image_format == "nd2":
+        reader = ND2RegionReader(args.image)
+        read_region = reader.read_region
+    elif image_format in ("h5", "zarr", "zarr.zip"):
+        reader = open_image_store(args.image)
+        read_region = lambda area, idx: reader.read_region(area, idx, shape="CYX")
+    elif image_format == "tiff":
+        reader = TiffRegionReader(args.image)
+        read_region = reader.read_region
+    else:
+        raise ValueError(f"Unsupported image format: {args.image}")
 
     base = os.path.basename(args.image)
 
@@ -71,9 +83,20 @@ def main():
         base = base.replace("__", "-")
 
     channel_names = base.split(".")[0].split("_")[1:][::-1]
+    height, width = reader.shape[1:]
 
+    # Stream one channel at a time, tile by tile, into a memory-mapped tiff
     for idx, ch in enumerate(channel_names):
-        tiff.imsave(f"{args.patient_id}_{ch}.tiff", image[idx, :, :])
+        channel = tiff.memmap(
+            f"{args.patient_id}_{ch}.tiff", shape=(height, width), dtype=reader.dtype
+        )
+        for area in get_tile_areas((height, width), args.tile_size):
+            start_row, end_row, start_col, end_col = area
+            channel[start_row:end_row, start_col:end_col] = read_region(area, idx)
+        channel.flush()
+        del channel
+
+    reader.close()
 
 
 if __name__ == "__main__":
@@ -3,14 +3,13 @@
 import os
 import argparse
 import numpy as np
-import h5py
 import gc
 import re
 import tifffile as tiff
 import logging
-from utils.io import save_h5, load_h5, load_pickle, save_pickle
+from utils.io import create_image_store, load_h5, load_pickle, save_pickle
+from utils.dtypes import cast_to_dtype, get_dtype
 from utils.metadata_tools import get_channel_list, get_image_file_shape
-from utils.io import save_h5, load_h5, load_pickle
 from utils.cropping import get_crop_areas
 from utils import logging_config
 
@@ -18,27 +17,6 @@ logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
 
-def stack_channel(file_path, new_channel_data):
-    """
-    Append a new channel to an existing dataset in an HDF5 file without loading the entire dataset into memory.
-    Args:
-        file_path (str): Path to the HDF5 file.
-        new_channel_data (numpy.ndarray): The new channel data to be added.
-                                           It should have the shape (n, m, 1) where (n, m) matches the existing dataset dimensions.
-    """
-    with h5py.File(file_path, "a") as hdf_file:
-        # Access the existing dataset
-        dataset = hdf_file["dataset"]
-        # Check the current shape of the dataset
-        current_shape = dataset.shape
-        c, n, m = current_shape  # Unpack current dimensions
-        dataset.resize((c + 1, n, m))
-        # Add the new channel data to the last channel of the dataset
-        dataset[-1, :, :] = (
-            new_channel_data.squeeze()
-        )  # Remove the last singleton dimension if present
-
-
 def save_tiff(
     image, output_path, resolution=None, bigtiff=True, ome=True, metadata=None
 ):
@@ -92,6 +70,32 @@ def _parse_args():
         required=True,
         help="Number of image crops to export.",
     )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Chunk edge (Y and X) of the stacked image store. Default is automatic.",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=None,
+        required=False,
+        help="Compression of the stacked image store: none, lzf, gzip, lz4 or blosc.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        required=False,
+        help="dtype of the stacked image and exported crops; 'auto' keeps the input dtype. Default is uint16.",
+    )
+    parser.add_argument(
+        "--validate_dtype",
+        action="store_true",
+        help="Fail instead of casting when a channel does not already have the configured dtype.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -113,20 +117,37 @@ def main():
     channels_files = args.channels.split()
 
     channel_names = []
+    channel_files_to_stack = []
     output_path = f"{args.patient_id}.h5"
     for ch in channels_list:
         # if ch is within the name of any channels_files
         if any(ch in img for img in channels_files):
-
             curr_img = [img for img in channels_files if ch in img][0]
             channel_names.append(ch)
-            new_channel = tiff.imread(curr_img)
-            if not os.path.exists(output_path):
-                save_h5(np.expand_dims(new_channel, axis=0), output_path)
-            else:
-                stack_channel(output_path, new_channel)
-            del new_channel
-            gc.collect()
+            channel_files_to_stack.append(curr_img)
+
+    if channel_files_to_stack:
+        # Allocate the CYX stack once, then write one channel at a time
+        with tiff.TiffFile(channel_files_to_stack[0]) as tif:
+            page = tif.pages[0]
+            n_rows, n_cols = page.shape[:2]
+            dtype = get_dtype(args.dtype, page.dtype)
+
+        with create_image_store(
+            output_path,
+            data_shape=(len(channel_files_to_stack), n_rows, n_cols),
+            dtype=dtype,
+            shape="CYX",
+            chunk_size=args.chunk_size,
+            compression=args.compression,
+        ) as store:
+            for idx, curr_img in enumerate(channel_files_to_stack):
+                new_channel = cast_to_dtype(
+                    tiff.imread(curr_img), dtype, validate=args.validate_dtype, name=curr_img
+                )
+                store.write_region(new_channel.squeeze(), channels_to_write=idx, shape="CYX")
+                del new_channel
+                gc.collect()
 
     if channel_names:
         resolution, metadata = create_tiff_metadata(
@@ -161,9 +182,8 @@ def main():
             logger.info(f"Processing file {output_path_tiff}.")
             if not os.path.exists(output_path_tiff):
                 logger.info(f"Loading region {area} from {output_path}")
-                stacked_image = load_h5(
-                    output_path, loading_region=area, shape="CYX"
-                ).astype(np.int32)
+                # Exported with the dtype of the stack
+                stacked_image = load_h5(output_path, loading_region=area, shape="CYX")
                 logger.info(f"Region {area} loaded successfully")
                 save_tiff(
                     image=stacked_image,
@@ -7,8 +7,16 @@ import os
 import numpy as np
 import re
 import tifffile as tiff
-from utils.io import load_h5, save_h5
-from utils.cropping import image_reconstruction_loop
+from utils.io import create_tiff_memmap, load_h5, open_image_store, save_tiff
+from utils.cropping import get_tile_areas
+from utils.dtypes import cast_to_dtype, get_dtype
+from utils.displacement import (
+    assemble_field,
+    get_maps_source_region,
+    get_sampling_maps,
+    remap_region,
+    save_field,
+)
 from utils.metadata_tools import get_image_file_shape
 from utils import logging_config
 
@@ -55,7 +63,7 @@ def _parse_args():
         default=None,
         required=True,
         nargs='+',
-        help="A list of crops",
+        help="A list of tile displacement fields",
     )
     parser.add_argument(
         "-cs",
@@ -89,6 +97,34 @@ def _parse_args():
         required=True,
         help="Padded full moving file.",
     )
+    parser.add_argument(
+        "-a",
+        "--affine_image",
+        type=str,
+        default=None,
+        required=True,
+        help="Affine-registered moving image, warped with the displacement fields.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tile_size",
+        type=int,
+        default=2048,
+        required=False,
+        help="Size of the output tiles of the streaming warp.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        required=False,
+        help="dtype of the registered channels; 'auto' keeps the input dtype. Default is uint16.",
+    )
+    parser.add_argument(
+        "--validate_dtype",
+        action="store_true",
+        help="Fail instead of casting when a warped or fixed channel does not already have the configured dtype.",
+    )
     parser.add_argument(
         "-l",
         "--log_file",
@@ -99,15 +135,54 @@ def _parse_args():
     args = parser.parse_args()
     return args
 
-def save_tiff(image, output_path, resolution=None, bigtiff=True, ome=True, metadata=None):
-    tiff.imwrite(
-        output_path, 
-        image, 
-        resolution=resolution,
-        bigtiff=bigtiff, 
-        ome=ome,
-        metadata=metadata
-    )
+def warp_channels(affine_image_path, channels, global_field, factor, shape, tile_size=2048,
+                  dtype="uint16", validate_dtype=False):
+    """
+    Warp channels of the affine image with a global displacement field.
+
+    The image is processed one output tile at a time: the sampling maps of
+    the tile are interpolated from the coarse field once, then the source
+    window of all channels is read and remapped in a single pass into the
+    memory-mapped output OME BigTIFFs, the format of the fixed channels.
+
+    Parameters:
+        affine_image_path (str): Affine-registered moving image store.
+        channels (dict): Output TIFF path for each channel index of the store.
+        global_field (ndarray): Coarse (y, x, 2) displacement field.
+        factor (int): Downsampling factor of the field.
+        shape (tuple): Shape of the output images.
+        tile_size (int, optional): Size of the output tiles. Default is 2048.
+        dtype (str, optional): dtype of the outputs, see `utils.dtypes.get_dtype`. Default is uint16.
+        validate_dtype (bool, optional): Fail if the warped tiles do not already have
+            that dtype. Default is False.
+    """
+    indices = sorted(channels)
+    with open_image_store(affine_image_path) as affine:
+        dtype = get_dtype(dtype, affine.dtype)
+        outputs = {
+            idx: create_tiff_memmap(path, shape[:2], dtype)
+            for idx, path in channels.items()
+        }
+        for area in get_tile_areas(shape, tile_size):
+            map_x, map_y = get_sampling_maps(global_field, factor, area)
+            source_region = get_maps_source_region(map_x, map_y, affine.shape)
+            if source_region is None or affine.is_padding(source_region):
+                continue
+            start_row, end_row, start_col, end_col = area
+            # Read and warp all channels of the window in one pass
+            source = affine.read_region(source_region, channels_to_load=indices)
+            warped = cast_to_dtype(
+                remap_region(source, map_x, map_y, source_region),
+                dtype,
+                validate=validate_dtype,
+                name=f"warped tile {area}",
+            )
+            for position, idx in enumerate(indices):
+                outputs[idx][start_row:end_row, start_col:end_col] = warped[:, :, position]
+
+    for output in outputs.values():
+        output.flush()
+    del outputs
 
 def main():
     args = _parse_args()
@@ -117,53 +192,66 @@ def main():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    original_shape = get_image_file_shape(args.moving, format='.h5')
+    original_shape = get_image_file_shape(args.moving)
 
     matches = []
     for crop_name in args.crops:
         matches.append(len(crop_name.split('.')[0].split('_')[-1]) == 64) # Check if filename ends in a 64 characters hash 
 
     if not all(matches):
-        crops_files = args.crops
-        cr = load_h5(crops_files[0])
-
-        if not isinstance(cr, int):
-            shape = (original_shape[0], original_shape[1], cr.shape[2])
-            reconstructed_image = image_reconstruction_loop(crops_files, shape, args.overlap_size)
-
-            moving_channels = os.path.basename(args.moving).replace('padded_', '') \
-                .split('.')[0] \
-                .split('_')[3:] \
-                [::-1] # Select first two channels (omit DAPI) and reverse list
-            
-            fixed_channels = os.path.basename(args.fixed).replace('padded_', '') \
-                .split('.')[0] \
-                .split('_')[2:] \
-                [::-1] # Select all channels and reverse list
-            
-            moving_channels_to_export = remove_lowercase_channels(moving_channels)
-            moving_channels_to_export_no_dapi = [ch for ch in moving_channels_to_export if ch != 'DAPI']
-            fixed_channels_to_export = remove_lowercase_channels(fixed_channels)
-
-            # Save moving channels
-            for idx, ch in enumerate(moving_channels_to_export_no_dapi):
-                # save_h5(
-                #     np.expand_dims(reconstructed_image[:,:,idx], axis=0).astype(np.float32), 
-                #     f"registered_{args.patient_id}_{ch}.h5"
-                # )
-                save_tiff(reconstructed_image[:,:,idx], 
-                    f"registered_{args.patient_id}_{ch}.tiff")
-            
-            # Save fixed channels
-            for idx, ch in enumerate(fixed_channels_to_export):
-                image = load_h5(args.fixed, channels_to_load=idx)
-                image = image.astype(np.float32)
-                save_tiff(image, f"registered_{args.patient_id}_{ch}.tiff")
-                image = np.expand_dims(image, axis=0)
-                # save_h5(
-                #     image, 
-                #     f"registered_{args.patient_id}_{ch}.h5"
-                # )
+        field_files = [crop for crop, match in zip(args.crops, matches) if not match]
+        global_field, factor = assemble_field(field_files, original_shape, args.overlap_size)
+
+        # Keep the global field, so channels can be registered later without re-optimising
+        outname = os.path.basename(args.moving).replace('padded_', '').split('.')[0]
+        save_field(f"displacement_{outname}.npz", global_field, factor, (0, 0), original_shape[:2])
+
+        moving_channels = os.path.basename(args.moving).replace('padded_', '') \
+            .split('.')[0] \
+            .split('_')[3:] \
+            [::-1] # Select first two channels (omit DAPI) and reverse list
+        
+        fixed_channels = os.path.basename(args.fixed).replace('padded_', '') \
+            .split('.')[0] \
+            .split('_')[2:] \
+            [::-1] # Select all channels and reverse list
+        
+        moving_channels_to_export = remove_lowercase_channels(moving_channels)
+        moving_channels_to_export_no_dapi = [ch for ch in moving_channels_to_export if ch != 'DAPI']
+        fixed_channels_to_export = remove_lowercase_channels(fixed_channels)
+
+        # Indices of the registered channels in the moving image, in registration order
+        image_channels_no_dapi = [
+            ch for ch in os.path.basename(args.moving).split('.')[0].split('_')[2:][::-1]
+            if ch != 'DAPI'
+        ]
+        image_indices = [
+            idx for idx, ch in enumerate(image_channels_no_dapi)
+            if not are_all_alphabetic_lowercase(ch)
+        ]
+
+        # Save moving channels
+        warp_channels(
+            args.affine_image,
+            {
+                idx: f"registered_{args.patient_id}_{ch}.tiff"
+                for idx, ch in zip(image_indices, moving_channels_to_export_no_dapi)
+            },
+            global_field,
+            factor,
+            original_shape,
+            tile_size=args.tile_size,
+            dtype=args.dtype,
+            validate_dtype=args.validate_dtype,
+        )
+        
+        # Save fixed channels
+        for idx, ch in enumerate(fixed_channels_to_export):
+            image = load_h5(args.fixed, channels_to_load=idx)
+            image = cast_to_dtype(
+                image, get_dtype(args.dtype, image), validate=args.validate_dtype, name=f"fixed {ch}"
+            )
+            save_tiff(image, f"registered_{args.patient_id}_{ch}.tiff")
                 
     else:
         tiff.imwrite(
@@ -171,12 +259,6 @@ def main():
             0
         )
 
-        # save_h5(
-        #         0, 
-        #         f"registered_{args.patient_id}.h5"
-        # )
-
-
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationCache:
+    """
+    Content-addressed store of registration results.
+
+    Entries are compressed .npz files keyed on a hash of the images they
+    were computed from and of the parameters used, so a result is reused
+    whenever the same DAPI content is registered with the same settings,
+    whatever the image is called or which other channels it carries.
+    Entries are written atomically, so concurrent tasks can share a cache
+    directory on a network filesystem.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def make_key(*arrays, **params):
+        """
+        Hash arrays (content, shape and dtype) and keyword parameters into a key.
+
+        Returns:
+            str: Hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(f"{array.shape}{array.dtype.str}".encode())
+            digest.update(memoryview(array).cast("B"))
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get_path(self, kind, key):
+        """Path of the entry of a given kind (e.g. 'affine', 'diffeo') and key."""
+        return os.path.join(self.cache_dir, kind, key[:2], f"{key}.npz")
+
+    def load(self, kind, key):
+        """
+        Load an entry.
+
+        Returns:
+            dict: Arrays of the entry, or None on a cache miss.
+        """
+        path = self.get_path(kind, key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+        logger.debug(f"Cache hit: {kind} {key}")
+        return arrays
+
+    def save(self, kind, key, **arrays):
+        """Save an entry, replacing it atomically if it exists."""
+        path = self.get_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.debug(f"Cache store: {kind} {key}")
+
+
+def open_registration_cache(cache_dir):
+    """Return a RegistrationCache for `cache_dir`, or None if caching is disabled."""
+    if not cache_dir:
+        return None
+    return RegistrationCache(cache_dir)
@@ -60,6 +60,27 @@ def get_crop_areas(shape, n_crops):
 
     return crop_areas
 
+def get_tile_areas(shape, tile_size):
+    """
+    Split an image into a grid of non-overlapping tiles.
+
+    Args:
+        shape (tuple): Shape of the image, (Y, X) or (Y, X, Z).
+        tile_size (int): The size of the tiles along Y and X.
+
+    Returns:
+        list: A list of (start_row, end_row, start_col, end_col) tuples.
+    """
+    Y, X = shape[:2]
+    tile_areas = []
+    for start_row in range(0, Y, tile_size):
+        for start_col in range(0, X, tile_size):
+            tile_areas.append(
+                (start_row, min(start_row + tile_size, Y), start_col, min(start_col + tile_size, X))
+            )
+
+    return tile_areas
+
 def reconstruct_image(reconstructed, crop, position, original_shape, overlap_size):
     """
     Reconstruct the original image from overlapping crops.
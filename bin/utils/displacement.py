@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+import logging
+import cv2
+import numpy as np
+from utils.warping import remap_image
+
+logger = logging.getLogger(__name__)
+
+
+def get_displacement_field(forward_field, matrix=None, initial_field=None):
+    """
+    Express a tile registration as a displacement field on the affine image.
+
+    The registered tile samples the moving tile at p + d(p), where d is the
+    dipy forward field. The moving tile itself was warped by the tile
+    matrix M from a tile that samples the affine image at q + c(q), c being
+    the optional initial (warm start) displacement. The returned field D
+    gives, for each output pixel p, the affine-image position p + D(p) it
+    samples from.
+
+    Parameters:
+        forward_field (ndarray): (Y, X, 2) dipy forward displacement, (row, col) order.
+        matrix (ndarray, optional): 2x3 tile matrix applied before the deformation.
+        initial_field (ndarray, optional): (Y, X, 2) initial displacement, (row, col) order.
+
+    Returns:
+        ndarray: (Y, X, 2) float32 displacement in (row, col) order.
+    """
+    field = np.asarray(forward_field, dtype=np.float64)
+    rows, cols = np.mgrid[0 : field.shape[0], 0 : field.shape[1]].astype(np.float64)
+    source_rows = rows + field[:, :, 0]
+    source_cols = cols + field[:, :, 1]
+
+    if matrix is not None:
+        # warpAffine samples the source at M^-1 (x, y)
+        inverse = cv2.invertAffineTransform(np.asarray(matrix, dtype=np.float64))
+        source_cols, source_rows = (
+            inverse[0, 0] * source_cols + inverse[0, 1] * source_rows + inverse[0, 2],
+            inverse[1, 0] * source_cols + inverse[1, 1] * source_rows + inverse[1, 2],
+        )
+
+    if initial_field is not None:
+        initial = cv2.remap(
+            np.asarray(initial_field, dtype=np.float32),
+            source_cols.astype(np.float32),
+            source_rows.astype(np.float32),
+            interpolation=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_REPLICATE,
+        )
+        source_rows = source_rows + initial[:, :, 0]
+        source_cols = source_cols + initial[:, :, 1]
+
+    return np.stack((source_rows - rows, source_cols - cols), axis=-1).astype(np.float32)
+
+
+def upsample_field(field, factor, shape):
+    """
+    Interpolate a field downsampled by `downsample_field` back to `shape`.
+
+    Coarse pixel i is centred on full-resolution pixel i * factor + (factor - 1) / 2,
+    the centre of the block it averages. The field is sampled at those
+    coordinates rather than resized, so shapes that are not an exact
+    multiple of `factor` (trailing partial blocks) keep the same grid;
+    pixels past the last centre take the nearest coarse value.
+    """
+    field = field.astype(np.float32)
+    if factor == 1 and field.shape[:2] == tuple(shape[:2]):
+        return field
+    offset = (factor - 1) / 2
+    rows = (np.arange(shape[0], dtype=np.float32) - offset) / factor
+    cols = (np.arange(shape[1], dtype=np.float32) - offset) / factor
+    map_y = np.repeat(rows[:, None], shape[1], axis=1)
+    map_x = np.repeat(cols[None, :], shape[0], axis=0)
+    return cv2.remap(field, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def downsample_field(field, factor):
+    """
+    Downsample a displacement field by area averaging.
+
+    Coarse pixel i covers full-resolution pixels [i * factor, (i + 1) * factor);
+    a trailing partial block is averaged over the pixels it covers.
+    """
+    if factor == 1:
+        return field.astype(np.float32)
+    height, width = field.shape[:2]
+    size = (-(-width // factor), -(-height // factor))
+    return cv2.resize(field.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+
+
+def save_field(path, field, factor, position, shape, **metadata):
+    """
+    Save a downsampled tile displacement field as a compressed .npz file.
+
+    Parameters:
+        path (str): Output path, ending in .npz.
+        field (ndarray): Downsampled (y, x, 2) displacement field.
+        factor (int): Downsampling factor of the field.
+        position (tuple): (start_row, start_col) of the tile in the image.
+        shape (tuple): Full-resolution (height, width) of the tile.
+        **metadata: Extra scalars stored alongside, e.g. the registration
+            profile and number of iterations.
+    """
+    np.savez_compressed(
+        path,
+        field=field.astype(np.float32),
+        factor=np.int64(factor),
+        position=np.array(position, dtype=np.int64),
+        shape=np.array(shape[:2], dtype=np.int64),
+        **{key: np.array(value) for key, value in metadata.items()},
+    )
+
+
+def load_field(path):
+    """
+    Load a displacement field saved by `save_field`.
+
+    Returns:
+        tuple: (field, factor, position, shape).
+    """
+    with np.load(path) as data:
+        return (
+            data["field"],
+            int(data["factor"]),
+            tuple(data["position"].tolist()),
+            tuple(data["shape"].tolist()),
+        )
+
+
+def assemble_field(field_files, image_shape, overlap_size):
+    """
+    Assemble tile displacement fields into one coarse global field.
+
+    Each tile owns its crop minus half of the overlap on every inner side,
+    as in `utils.cropping.reconstruct_image`. Coarse pixels are filled from
+    the nearest coarse sample of the owning tile.
+
+    Parameters:
+        field_files (list): Tile field files written by `save_field`.
+        image_shape (tuple): Full-resolution shape of the image.
+        overlap_size (int): Overlap between tiles.
+
+    Returns:
+        tuple: (global field of shape (ceil(Y / f), ceil(X / f), 2), factor f).
+    """
+    height, width = image_shape[:2]
+    global_field = None
+    factor = None
+
+    for path in field_files:
+        field, tile_factor, (start_row, start_col), (tile_height, tile_width) = load_field(path)
+        if global_field is None:
+            factor = tile_factor
+            global_field = np.zeros(
+                (-(-height // factor), -(-width // factor), 2), dtype=np.float32
+            )
+        elif tile_factor != factor:
+            raise ValueError(f"Inconsistent field downsampling factors: {tile_factor} != {factor}")
+
+        def get_owned_indices(start, size, total, coarse_size):
+            first = start if start == 0 else start + overlap_size // 2
+            last = start + size if start + size >= total else start + size - overlap_size // 2
+            # Global coarse pixels starting in [first, last), and their tile-local indices
+            global_idx = np.arange(-(-first // factor), -(-last // factor))
+            local_idx = np.clip(
+                np.rint((global_idx * factor - start) / factor).astype(int), 0, coarse_size - 1
+            )
+            return global_idx, local_idx
+
+        global_rows, local_rows = get_owned_indices(start_row, tile_height, height, field.shape[0])
+        global_cols, local_cols = get_owned_indices(start_col, tile_width, width, field.shape[1])
+        if len(global_rows) and len(global_cols):
+            global_field[global_rows[0] : global_rows[-1] + 1, global_cols[0] : global_cols[-1] + 1] = (
+                field[np.ix_(local_rows, local_cols)]
+            )
+
+    return global_field, factor
+
+
+def get_tile_displacement(global_field, factor, area):
+    """
+    Interpolate a coarse global field at the full-resolution pixels of a tile.
+
+    Coarse pixel i is centred on full-resolution pixel i * factor + (factor - 1) / 2.
+
+    Parameters:
+        global_field (ndarray): Coarse (y, x, 2) displacement field, (row, col) order.
+        factor (int): Downsampling factor of the field.
+        area (tuple): Tile (start_row, end_row, start_col, end_col).
+
+    Returns:
+        ndarray: (height, width, 2) float32 displacement of the tile.
+    """
+    start_row, end_row, start_col, end_col = area
+    rows = np.arange(start_row, end_row, dtype=np.float32)
+    cols = np.arange(start_col, end_col, dtype=np.float32)
+    coarse_x, coarse_y = np.meshgrid(
+        (cols - (factor - 1) / 2) / factor, (rows - (factor - 1) / 2) / factor
+    )
+    return cv2.remap(
+        global_field.astype(np.float32),
+        coarse_x.astype(np.float32),
+        coarse_y.astype(np.float32),
+        interpolation=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+
+
+def get_sampling_maps(global_field, factor, area):
+    """
+    Get the full-resolution sampling maps of a tile from a coarse global field.
+
+    Parameters:
+        global_field (ndarray): Coarse (y, x, 2) displacement field, (row, col) order.
+        factor (int): Downsampling factor of the field.
+        area (tuple): Tile (start_row, end_row, start_col, end_col).
+
+    Returns:
+        tuple: (map_x, map_y) float32 source coordinates for `cv2.remap`.
+    """
+    start_row, end_row, start_col, end_col = area
+    rows = np.arange(start_row, end_row, dtype=np.float32)
+    cols = np.arange(start_col, end_col, dtype=np.float32)
+    displacement = get_tile_displacement(global_field, factor, area)
+    map_y = rows[:, np.newaxis] + displacement[:, :, 0]
+    map_x = cols[np.newaxis, :] + displacement[:, :, 1]
+
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+
+def get_maps_source_region(map_x, map_y, shape, margin=2):
+    """
+    Get the source region sampled by a pair of remap maps.
+
+    Returns:
+        tuple: (start_row, end_row, start_col, end_col), or None if the maps
+        only sample outside the image.
+    """
+    start_row = max(int(np.floor(map_y.min())) - margin, 0)
+    end_row = min(int(np.ceil(map_y.max())) + margin + 1, shape[0])
+    start_col = max(int(np.floor(map_x.min())) - margin, 0)
+    end_col = min(int(np.ceil(map_x.max())) + margin + 1, shape[1])
+
+    if start_row >= end_row or start_col >= end_col:
+        return None
+    return (start_row, end_row, start_col, end_col)
+
+
+def remap_region(source, map_x, map_y, source_region):
+    """
+    Sample a 2D or YXC source window with full-image remap maps.
+
+    All channels share the maps; outside pixels are 0 and the dtype of the
+    source is kept.
+    """
+    start_row, _, start_col, _ = source_region
+    return remap_image(
+        source,
+        map_x - np.float32(start_col),
+        map_y - np.float32(start_row),
+    )
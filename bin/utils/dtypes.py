@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Raw microscopy intensities, kept through registration and stitching
+DEFAULT_DTYPE = "uint16"
+
+
+def get_dtype(dtype=None, reference=None):
+    """
+    Resolve the dtype of the intermediates.
+
+    Parameters:
+        dtype (str, optional): Configured dtype, e.g. 'uint16' or 'float32'. 'auto'
+            keeps the dtype of `reference`. Default is DEFAULT_DTYPE.
+        reference (ndarray or numpy.dtype, optional): Input image or dtype used by 'auto'.
+
+    Returns:
+        numpy.dtype: The dtype to write.
+    """
+    if dtype is None:
+        dtype = DEFAULT_DTYPE
+    if dtype == "auto":
+        if reference is None:
+            raise ValueError("The 'auto' dtype needs a reference image.")
+        return np.dtype(getattr(reference, "dtype", reference))
+    try:
+        return np.dtype(dtype)
+    except TypeError:
+        raise ValueError(f"Invalid dtype specified: {dtype}.")
+
+
+def cast_to_dtype(image, dtype, validate=False, name="image"):
+    """
+    Cast an image to the dtype of the intermediates at a warp or write boundary.
+
+    Integer targets are rounded and clipped to the range of the dtype, so
+    interpolated values never wrap around.
+
+    Parameters:
+        image (ndarray): Image to cast.
+        dtype (numpy.dtype): Target dtype, see `get_dtype`.
+        validate (bool, optional): Raise a ValueError if the image does not
+            already have the target dtype, instead of casting it. Used to check
+            that no step drifts away from the policy. Default is False.
+        name (str, optional): Name of the image in log and error messages.
+
+    Returns:
+        ndarray: Image with the target dtype (the input itself if it already has it).
+    """
+    dtype = np.dtype(dtype)
+    if image.dtype == dtype:
+        return image
+    if validate:
+        raise ValueError(f"{name} has dtype {image.dtype}, expected {dtype}.")
+
+    logger.debug(f"Casting {name} from {image.dtype} to {dtype}")
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        if np.issubdtype(image.dtype, np.floating):
+            image = np.rint(image)
+        image = np.clip(image, info.min, info.max)
+    return image.astype(dtype)
@@ -1,53 +1,650 @@
 #!/usr/bin/env python
 
+import abc
 import h5py
+import logging
+import os
+import shutil
 import pickle
 import nd2
+import numpy as np
+import tifffile as tiff
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+try:
+    import numcodecs
+    import zarr
+except ImportError:
+    numcodecs = None
+    zarr = None
+
+logger = logging.getLogger(__name__)
 
 
 ## H5
-def load_h5(path, loading_region=None, channels_to_load=None, shape="YXC"):
-    with h5py.File(path, "r") as hdf5_file:
-        dataset = hdf5_file["dataset"]
-        # Handle empty datasets
-        if dataset.shape == ():
-            return dataset[()]
-        # Define default slicing
-        slices = [slice(None)] * len(shape)
-        if loading_region:
-            start_row, end_row, start_col, end_col = loading_region
-            if shape == "YXC" or shape == "YX":
-                slices[0] = slice(start_row, end_row)
-                slices[1] = slice(start_col, end_col)
-            elif shape == "CYX":
-                slices[1] = slice(start_row, end_row)
-                slices[2] = slice(start_col, end_col)
-        if channels_to_load is not None:
-            if shape == "YXC":
-                slices[2] = channels_to_load
-            elif shape == "CYX":
-                slices[0] = channels_to_load
-        # Extract data using slices
-        data = dataset[tuple(slices)]
-    return data
+def get_chunk_shape(data_shape, shape="YXC", chunk_size=512):
+    """
+    Get the chunk shape matching the tile grid and channel axis of a layout.
+
+    YXC datasets are chunked as (chunk_size, chunk_size, C), so a region read
+    with all channels touches the minimum number of chunks. CYX datasets are
+    chunked as (1, chunk_size, chunk_size), so single channels can be read
+    and appended independently.
+
+    Parameters:
+        data_shape (tuple): Shape of the dataset.
+        shape (str, optional): Axes layout, one of 'YXC', 'CYX' or 'YX'. Default is 'YXC'.
+        chunk_size (int, optional): Chunk edge along Y and X. Default is 512.
+
+    Returns:
+        tuple: Chunk shape.
+    """
+    if len(data_shape) == 2:
+        return (min(chunk_size, data_shape[0]), min(chunk_size, data_shape[1]))
+    if shape == "YXC":
+        Y, X, C = data_shape
+        return (min(chunk_size, Y), min(chunk_size, X), C)
+    elif shape == "CYX":
+        C, Y, X = data_shape
+        return (1, min(chunk_size, Y), min(chunk_size, X))
+    else:
+        raise ValueError(f"Unsupported layout for {len(data_shape)}D data: {shape}")
+
+
+def get_compression_options(compression=None):
+    """
+    Get the h5py dataset keyword arguments for a compression name.
+
+    Parameters:
+        compression (str, optional): One of None, 'none', 'lzf', 'gzip', 'lz4' or 'blosc'.
+            'lz4' and 'blosc' require the optional hdf5plugin package and fall back
+            to 'lzf' when it is not installed. Default is None (no compression).
 
+    Returns:
+        dict: Keyword arguments for `h5py.Group.create_dataset`.
+    """
+    if compression is None or compression == "none":
+        return {}
+    if compression in ("lz4", "blosc") and hdf5plugin is None:
+        logger.warning(f"hdf5plugin is not installed, using 'lzf' instead of '{compression}'")
+        compression = "lzf"
 
-def save_h5(data, path, dtype=None):
-    if isinstance(data, int):
-        chunks = None
-        maxshape = None
-        dtype = "int"
+    if compression == "lzf":
+        return {"compression": "lzf", "shuffle": True}
+    elif compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 1, "shuffle": True}
+    elif compression == "lz4":
+        return dict(hdf5plugin.LZ4())
+    elif compression == "blosc":
+        return dict(
+            hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        )
     else:
-        ndim = data.ndim
-        chunks = True
-        maxshape = tuple([None] * ndim)
+        raise ValueError(
+            "Invalid compression specified. Choose one of 'none', 'lzf', 'gzip', 'lz4' or 'blosc'."
+        )
+
+
+def get_region_slices(ndim, loading_region=None, channels_to_load=None, shape="YXC"):
+    """
+    Get the slices selecting a region and a set of channels of an image.
+
+    Parameters:
+        ndim (int): Number of dimensions of the image.
+        loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+        channels_to_load (int, slice or list, optional): Channels to select. Default is all channels.
+        shape (str, optional): Axes layout, one of 'YXC', 'CYX' or 'YX'. Default is 'YXC'.
+
+    Returns:
+        tuple: Slices to index the image with.
+    """
+    slices = [slice(None)] * max(ndim, len(shape))
+    if loading_region:
+        start_row, end_row, start_col, end_col = loading_region
+        if shape == "YXC" or shape == "YX":
+            slices[0] = slice(start_row, end_row)
+            slices[1] = slice(start_col, end_col)
+        elif shape == "CYX":
+            slices[1] = slice(start_row, end_row)
+            slices[2] = slice(start_col, end_col)
+    if channels_to_load is not None:
+        if shape == "YXC":
+            slices[2] = channels_to_load
+        elif shape == "CYX":
+            slices[0] = channels_to_load
+    return tuple(slices[:ndim])
+
+
+def get_store_format(path):
+    """
+    Get the image store format from a path: 'zarr.zip', 'zarr' or 'h5'.
+    """
+    path = str(path).rstrip("/")
+    if path.endswith(".zarr.zip"):
+        return "zarr.zip"
+    elif path.endswith(".zarr"):
+        return "zarr"
+    return "h5"
+
+
+def get_image_format(path):
+    """
+    Get the format of an image from its extension: 'nd2', 'tiff', 'h5', 'zarr' or 'zarr.zip'.
+
+    Only the last extension is read, so dotted sample names such as
+    P1.r2.nd2 are supported.
+    """
+    if get_store_format(path) != "h5":
+        return get_store_format(path)
+    extension = os.path.splitext(str(path).rstrip("/"))[1].lower().lstrip(".")
+    return "tiff" if extension == "tif" else extension
+
+
+def get_spatial_axes(shape="YXC", channels_to_load=None):
+    """
+    Get the (row, col) axes of an image, after an optional channel selection.
+    """
+    if shape == "CYX" and not np.isscalar(channels_to_load):
+        return 1, 2
+    return 0, 1
+
+
+class ImageStore(abc.ABC):
+    """
+    Chunked image array stored on disk under a single dataset named "dataset".
+
+    Subclasses implement the storage backend; `read_region` and
+    `write_region` address the image through the same loading regions and
+    axes layouts used by `load_h5`. Stores are context managers.
+
+    A store can be virtually padded (see `set_virtual_padding`): it then
+    holds the unpadded image plus its offset in a larger target shape.
+    `shape` reports the padded shape and reads return zeros outside the
+    stored image, without any zero-filled copy on disk.
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        self.dataset = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def shape(self):
+        if self.offset is None:
+            return self.dataset.shape
+        shape = list(self.dataset.shape)
+        row_axis, col_axis = get_spatial_axes(self.attrs["layout"])
+        shape[row_axis], shape[col_axis] = self.padded_shape
+        return tuple(shape)
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def attrs(self):
+        return self.dataset.attrs
+
+    @property
+    def offset(self):
+        """(row, col) offset of the stored image in the padded image, None when not virtually padded."""
+        if self.dataset is None or "offset" not in self.attrs:
+            return None
+        return tuple(int(v) for v in self.attrs["offset"])
+
+    @property
+    def padded_shape(self):
+        """(height, width) of the padded image, None when not virtually padded."""
+        if self.dataset is None or "padded_shape" not in self.attrs:
+            return None
+        return tuple(int(v) for v in self.attrs["padded_shape"])
+
+    def set_virtual_padding(self, padded_shape, offset, shape="YXC"):
+        """
+        Record the image as virtually padded to `padded_shape`, placed at `offset`.
+
+        Parameters:
+            padded_shape (tuple): (height, width) of the padded image.
+            offset (tuple): (row, col) of the top-left corner of the stored image.
+            shape (str, optional): Axes layout of the stored image. Default is 'YXC'.
+        """
+        self.attrs["padded_shape"] = [int(v) for v in padded_shape]
+        self.attrs["offset"] = [int(v) for v in offset]
+        self.attrs["layout"] = shape
+
+    def is_padding(self, loading_region):
+        """
+        Check whether a region lies entirely in the virtual padding.
+        Always False for stores that are not virtually padded.
+        """
+        if self.offset is None:
+            return False
+        start_row, end_row, start_col, end_col = loading_region
+        row_axis, col_axis = get_spatial_axes(self.attrs["layout"])
+        height, width = self.dataset.shape[row_axis], self.dataset.shape[col_axis]
+        row_offset, col_offset = self.offset
+        return (
+            end_row <= row_offset
+            or start_row >= row_offset + height
+            or end_col <= col_offset
+            or start_col >= col_offset + width
+        )
+
+    def read_region(self, loading_region=None, channels_to_load=None, shape="YXC"):
+        """
+        Read a region of the image.
+
+        Parameters:
+            loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+            channels_to_load (int, slice or list, optional): Channels to read. Default is all channels.
+            shape (str, optional): Axes layout of the image. Default is 'YXC'.
+
+        Returns:
+            ndarray: Image data.
+        """
+        # Handle empty datasets
+        if self.shape == ():
+            return self.dataset[()]
+        if self.offset is not None:
+            return self._read_virtual_region(loading_region, channels_to_load)
+        slices = get_region_slices(
+            len(self.shape), loading_region, channels_to_load, shape
+        )
+        return self.dataset[slices]
+
+    def _read_virtual_region(self, loading_region=None, channels_to_load=None):
+        layout = self.attrs["layout"]
+        padded_height, padded_width = self.padded_shape
+        if loading_region is None:
+            loading_region = (0, padded_height, 0, padded_width)
+        start_row, end_row, start_col, end_col = loading_region
+        end_row, end_col = min(end_row, padded_height), min(end_col, padded_width)
+
+        # Intersect the region with the stored image, in stored coordinates
+        row_axis, col_axis = get_spatial_axes(layout)
+        height, width = self.dataset.shape[row_axis], self.dataset.shape[col_axis]
+        row_offset, col_offset = self.offset
+        stored_region = (
+            max(start_row - row_offset, 0),
+            max(min(end_row - row_offset, height), 0),
+            max(start_col - col_offset, 0),
+            max(min(end_col - col_offset, width), 0),
+        )
+        if self.is_padding((start_row, end_row, start_col, end_col)):
+            # Empty read, only used to get the shape of the channel selection
+            stored_region = (0, 0, 0, 0)
+        slices = get_region_slices(
+            self.dataset.ndim, stored_region, channels_to_load, layout
+        )
+        data = self.dataset[slices]
+
+        row_axis, col_axis = get_spatial_axes(layout, channels_to_load)
+        region_shape = list(data.shape)
+        region_shape[row_axis] = end_row - start_row
+        region_shape[col_axis] = end_col - start_col
+        region = np.zeros(region_shape, dtype=self.dtype)
+        if data.size:
+            placement = [slice(None)] * region.ndim
+            placement[row_axis] = slice(
+                stored_region[0] + row_offset - start_row,
+                stored_region[1] + row_offset - start_row,
+            )
+            placement[col_axis] = slice(
+                stored_region[2] + col_offset - start_col,
+                stored_region[3] + col_offset - start_col,
+            )
+            region[tuple(placement)] = data
+        return region
+
+    def write_region(self, data, loading_region=None, channels_to_write=None, shape="YXC"):
+        """
+        Write data into a region of the image.
+
+        Parameters:
+            data (ndarray): Data to write, with the shape of the selected region.
+            loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+            channels_to_write (int, slice or list, optional): Channels to write. Default is all channels.
+            shape (str, optional): Axes layout of the image. Default is 'YXC'.
+        """
+        if self.mode == "r":
+            raise ValueError(f"Image store {self.path} is open in read-only mode.")
+        if self.offset is not None:
+            raise ValueError(f"Image store {self.path} is virtually padded and cannot be written.")
+        slices = get_region_slices(
+            len(self.shape), loading_region, channels_to_write, shape
+        )
+        self.dataset[slices] = data
+
+    @abc.abstractmethod
+    def close(self):
+        """Flush and release the backend resources of the store."""
+
+
+class H5ImageStore(ImageStore):
+    """
+    Image store backed by an HDF5 file.
+
+    HDF5 files support a single writer: regions must be written by one
+    process at a time. Use a Zarr store for concurrent writes.
+    """
+
+    def __init__(self, path, mode="r"):
+        super().__init__(path, mode)
+        self.file = h5py.File(path, mode)
+        if "dataset" in self.file:
+            self.dataset = self.file["dataset"]
+
+    @classmethod
+    def create(cls, path, data=None, data_shape=None, dtype=None, shape="YXC",
+               chunk_size=None, compression=None, **kwargs):
+        options = {}
+        if isinstance(data, int):
+            chunks = None
+            maxshape = None
+            dtype = "int"
+        else:
+            data_shape = data.shape if data is not None else data_shape
+            if chunk_size is None:
+                chunks = True
+            else:
+                chunks = get_chunk_shape(data_shape, shape=shape, chunk_size=chunk_size)
+            maxshape = tuple([None] * len(data_shape))
+            options = get_compression_options(compression)
+            if dtype is None:
+                dtype = data.dtype
+        store = cls(path, mode="w")
+        try:
+            store.dataset = store.file.create_dataset(
+                "dataset",
+                shape=None if data is not None else data_shape,
+                data=data,
+                chunks=chunks,
+                maxshape=maxshape,
+                dtype=dtype,
+                **options,
+            )
+        except BaseException:
+            store.close()
+            raise
+        return store
+
+    def close(self):
+        if self.mode != "r":
+            self.file.flush()
+        self.file.close()
+
+
+class ZarrImageStore(ImageStore):
+    """
+    Image store backed by a Zarr directory (*.zarr) or zip file (*.zarr.zip).
+
+    Directory stores support concurrent region writes from many processes.
+    Writes aligned to the chunk grid are always safe; stores created or
+    opened with `synchronized=True` also lock chunks on disk so unaligned
+    regions can be written concurrently. Zip stores support a single writer.
+    """
+
+    def __init__(self, path, mode="r", synchronized=False):
+        if zarr is None:
+            raise ImportError("The zarr package is required to read or write Zarr image stores.")
+        super().__init__(path, mode)
+        if get_store_format(path) == "zarr.zip":
+            self.store = zarr.ZipStore(path, mode="r" if mode == "r" else "a")
+        else:
+            self.store = zarr.DirectoryStore(path)
+        synchronizer = None
+        self.sync_path = None
+        if synchronized:
+            self.sync_path = str(path).rstrip("/") + ".sync"
+            synchronizer = zarr.ProcessSynchronizer(self.sync_path)
+        self.group = zarr.open_group(self.store, mode=mode, synchronizer=synchronizer)
+        if "dataset" in self.group:
+            self.dataset = self.group["dataset"]
+
+    @classmethod
+    def create(cls, path, data=None, data_shape=None, dtype=None, shape="YXC",
+               chunk_size=None, compression=None, synchronized=False):
+        store = cls(path, mode="w", synchronized=synchronized)
+        if isinstance(data, int):
+            store.dataset = store.group.array("dataset", data, dtype="int")
+            return store
+        data_shape = data.shape if data is not None else data_shape
         if dtype is None:
             dtype = data.dtype
-    with h5py.File(path, "w") as hdf5_file:
-        hdf5_file.create_dataset(
-            "dataset", data=data, chunks=chunks, maxshape=maxshape, dtype=dtype
+        if chunk_size is None:
+            chunks = True
+        else:
+            chunks = get_chunk_shape(data_shape, shape=shape, chunk_size=chunk_size)
+        try:
+            store.dataset = store.group.zeros(
+                "dataset",
+                shape=data_shape,
+                chunks=chunks,
+                dtype=dtype,
+                compressor=get_zarr_compressor(compression),
+            )
+            if data is not None:
+                store.dataset[...] = data
+        except BaseException:
+            store.close()
+            raise
+        return store
+
+    def close(self):
+        if isinstance(self.store, zarr.ZipStore):
+            self.store.close()
+        # Chunk locks are only needed while the store is written
+        if self.sync_path is not None:
+            shutil.rmtree(self.sync_path, ignore_errors=True)
+
+
+def get_zarr_compressor(compression=None):
+    """
+    Get the numcodecs compressor for a compression name, see `get_compression_options`.
+    'lzf' has no Zarr codec and maps to Blosc-LZ4.
+    """
+    if compression is None or compression == "none":
+        return None
+    elif compression == "gzip":
+        return numcodecs.GZip(level=1)
+    elif compression in ("lzf", "lz4", "blosc"):
+        return numcodecs.Blosc(cname="lz4", clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+    else:
+        raise ValueError(
+            "Invalid compression specified. Choose one of 'none', 'lzf', 'gzip', 'lz4' or 'blosc'."
         )
-        hdf5_file.flush()
+
+
+def open_image_store(path, mode="r", synchronized=False):
+    """
+    Open an image store, choosing the backend from the path extension.
+
+    Parameters:
+        path (str): Path to a *.h5 file, a *.zarr directory or a *.zarr.zip file.
+        mode (str, optional): File mode, 'r', 'r+' or 'a'. Default is 'r'.
+        synchronized (bool, optional): Lock Zarr chunks for concurrent writes. Default is False.
+
+    Returns:
+        ImageStore: The opened store.
+    """
+    if get_store_format(path) == "h5":
+        return H5ImageStore(path, mode=mode)
+    return ZarrImageStore(path, mode=mode, synchronized=synchronized)
+
+
+def create_image_store(path, data=None, data_shape=None, dtype=None, shape="YXC",
+                       chunk_size=None, compression=None, synchronized=False):
+    """
+    Create an image store, choosing the backend from the path extension.
+
+    Either `data` or `data_shape` and `dtype` must be given. Without `data`
+    the image is zero-filled and can be written region by region.
+
+    Parameters:
+        path (str): Path to a *.h5 file, a *.zarr directory or a *.zarr.zip file.
+        data (ndarray or int, optional): Initial data. Integers are saved as scalar placeholders.
+        data_shape (tuple, optional): Shape of the image when `data` is not given.
+        dtype (optional): Dtype of the image. Default is the dtype of `data`.
+        shape (str, optional): Axes layout, one of 'YXC', 'CYX' or 'YX'. Default is 'YXC'.
+        chunk_size (int, optional): Chunk edge along Y and X, see `get_chunk_shape`. Default is None (automatic).
+        compression (str, optional): Compression, see `get_compression_options`. Default is None.
+        synchronized (bool, optional): Lock Zarr chunks for concurrent writes. Default is False.
+
+    Returns:
+        ImageStore: The created store, open for writing.
+    """
+    if data is None and (data_shape is None or dtype is None):
+        raise ValueError("Either `data` or both `data_shape` and `dtype` must be given.")
+    if get_store_format(path) == "h5":
+        store_class = H5ImageStore
+    else:
+        store_class = ZarrImageStore
+    return store_class.create(
+        path,
+        data=data,
+        data_shape=data_shape,
+        dtype=dtype,
+        shape=shape,
+        chunk_size=chunk_size,
+        compression=compression,
+        synchronized=synchronized,
+    )
+
+
+def is_padding_region(path, loading_region):
+    """
+    Check whether a region of an image store lies entirely in its virtual padding.
+    """
+    with open_image_store(path) as store:
+        return store.is_padding(loading_region)
+
+
+def load_h5(path, loading_region=None, channels_to_load=None, shape="YXC"):
+    """
+    Load an image, or a region of it, from an image store (HDF5 or Zarr).
+
+    Parameters:
+        path (str): Path to the image store.
+        loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+        channels_to_load (int, slice or list, optional): Channels to load. Default is all channels.
+        shape (str, optional): Axes layout, one of 'YXC', 'CYX' or 'YX'. Default is 'YXC'.
+
+    Returns:
+        ndarray: Image data.
+    """
+    with open_image_store(path) as store:
+        data = store.read_region(loading_region, channels_to_load, shape)
+    return data
+
+
+def load_h5_downsampled(path, factor, channels_to_load=-1, band_size=2048):
+    """
+    Load a single channel of an image store downsampled by block averaging.
+
+    The channel is read one band of rows at a time, so memory stays at one
+    band plus the downsampled output. Trailing rows and columns that do not
+    fill a whole block are dropped, so pixel (i, j) of the output covers
+    pixels [i * factor, (i + 1) * factor) x [j * factor, (j + 1) * factor).
+
+    Parameters:
+        path (str): Path to the image store (YXC layout).
+        factor (int): Downsampling factor along Y and X.
+        channels_to_load (int, optional): Channel to load. Default is -1 (DAPI, the last channel).
+        band_size (int, optional): Number of full-resolution rows read at once. Default is 2048.
+
+    Returns:
+        ndarray: Downsampled 2D image, with the dtype of the store.
+    """
+    with open_image_store(path) as store:
+        if factor == 1:
+            return store.read_region(channels_to_load=channels_to_load)
+
+        height, width = store.shape[:2]
+        out_height, out_width = height // factor, width // factor
+        band_size = max(band_size // factor, 1) * factor
+        downsampled = np.zeros((out_height, out_width), dtype=store.dtype)
+
+        for start_row in range(0, out_height * factor, band_size):
+            end_row = min(start_row + band_size, out_height * factor)
+            band = store.read_region(
+                (start_row, end_row, 0, out_width * factor), channels_to_load
+            )
+            band = band.reshape(
+                (end_row - start_row) // factor, factor, out_width, factor
+            ).mean(axis=(1, 3))
+            downsampled[start_row // factor : end_row // factor] = band
+
+    return downsampled
+
+
+def save_h5(data, path, dtype=None, shape="YXC", chunk_size=None, compression=None):
+    """
+    Save an array to an image store (HDF5 or Zarr, chosen from the path extension).
+
+    Parameters:
+        data (ndarray or int): Data to save. Integers are saved as scalar placeholders.
+        path (str): Output path.
+        dtype (optional): Output dtype. Default is the dtype of `data`.
+        shape (str, optional): Axes layout of `data`, one of 'YXC', 'CYX' or 'YX'. Default is 'YXC'.
+        chunk_size (int, optional): Chunk edge along Y and X, see `get_chunk_shape`.
+            Default is None (automatic chunk shape).
+        compression (str, optional): Compression filter, see `get_compression_options`.
+            Default is None (no compression).
+    """
+    with create_image_store(
+        path,
+        data=data,
+        dtype=dtype,
+        shape=shape,
+        chunk_size=chunk_size,
+        compression=compression,
+    ):
+        pass
+
+
+## TIFF
+def save_tiff(image, output_path, resolution=None, bigtiff=True, ome=True, metadata=None):
+    """
+    Save an image as an OME BigTIFF, the format the downstream stages read.
+    """
+    tiff.imwrite(
+        output_path,
+        image,
+        resolution=resolution,
+        bigtiff=bigtiff,
+        ome=ome,
+        metadata=metadata,
+    )
+
+
+def create_tiff_memmap(output_path, shape, dtype, bigtiff=True, ome=True, metadata=None):
+    """
+    Create an empty OME BigTIFF, with the layout of `save_tiff`, and memory-map it.
+
+    The image is stored uncompressed and contiguous, so it can be written
+    region by region through the returned array; call `flush` when done.
+
+    Returns:
+        numpy.memmap: Writable view of the image.
+    """
+    return tiff.memmap(
+        output_path,
+        shape=shape,
+        dtype=dtype,
+        bigtiff=bigtiff,
+        ome=ome,
+        metadata=metadata,
+    )
 
 
 ## PICKLE
@@ -67,6 +664,68 @@ def save_pickle(object, path):
         pickle.dump(object, file)
 
 
+## Tile payloads
+def save_tile_payload(path, fixed_dapi, moving_dapi, moving=None, channels=(), matrix=None,
+                      initial_field=None, initial_factor=1):
+    """
+    Save a diffeomorphic tile as a compressed .npz payload.
+
+    Only what the registration needs is stored: the fixed DAPI, the moving
+    DAPI and the moving channels to register, with their names, the tile
+    matrix that warped the moving crops from the affine image and, for
+    warm-started tiles, the initial displacement applied before it.
+
+    Parameters:
+        path (str): Output path, ending in .npz.
+        fixed_dapi (ndarray): 2D fixed DAPI crop.
+        moving_dapi (ndarray): 2D moving DAPI crop.
+        moving (ndarray, optional): YXC moving channels to register. Default is none.
+        channels (list, optional): Names of the moving channels, in order.
+        matrix (ndarray, optional): 2x3 tile matrix. Default is the identity.
+        initial_field (ndarray, optional): Downsampled (y, x, 2) initial displacement of
+            the tile on the affine image, (row, col) order. Default is none.
+        initial_factor (int, optional): Downsampling factor of `initial_field`.
+    """
+    if moving is None:
+        moving = np.zeros(moving_dapi.shape + (0,), dtype=moving_dapi.dtype)
+    if matrix is None:
+        matrix = np.eye(2, 3)
+    if initial_field is None:
+        initial_field = np.zeros((0, 0, 2), dtype=np.float32)
+    np.savez_compressed(
+        path,
+        fixed_dapi=fixed_dapi,
+        moving_dapi=moving_dapi,
+        moving=moving,
+        channels=np.array(channels, dtype=str),
+        matrix=np.asarray(matrix, dtype=np.float64),
+        initial_field=np.asarray(initial_field, dtype=np.float32),
+        initial_factor=np.int64(initial_factor),
+    )
+
+
+def load_tile_payload(path):
+    """
+    Load a diffeomorphic tile payload saved by `save_tile_payload`.
+
+    Returns:
+        tuple: (fixed_dapi, moving_dapi, moving, channels, matrix, initial_field),
+        where initial_field is a (field, factor) tuple, or None.
+    """
+    with np.load(path) as payload:
+        initial_field = None
+        if "initial_field" in payload.files and payload["initial_field"].size:
+            initial_field = (payload["initial_field"], int(payload["initial_factor"]))
+        return (
+            payload["fixed_dapi"],
+            payload["moving_dapi"],
+            payload["moving"],
+            payload["channels"].tolist(),
+            payload["matrix"],
+            initial_field,
+        )
+
+
 ## ND2
 def load_nd2(file_path):
     """
@@ -82,3 +741,57 @@ def load_nd2(file_path):
         data = nd2_file.asarray()
 
     return data
+
+
+class ND2RegionReader:
+    """
+    Lazy reader returning windows of a CYX ND2 file.
+
+    Single-frame files (the whole slide stored as one multichannel frame)
+    are read through a memory-mapped view of the frame, so a window only
+    touches its own pages. Uncompressed data is never copied in full.
+    Lossless-compressed frames cannot be decoded partially by the nd2
+    package: the whole frame is decompressed once when the reader opens,
+    so memory then scales with the slide. Multi-frame files fall back to
+    the dask interface of the nd2 package.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = nd2.ND2File(path)
+        if self.file.attributes.sequenceCount == 1:
+            self.array = self.file.read_frame(0)
+        else:
+            self.array = self.file.to_dask().squeeze()
+        if self.array.ndim == 2:
+            self.array = self.array[np.newaxis]
+        self.shape = self.array.shape
+        self.dtype = self.array.dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_region(self, loading_region=None, channels_to_load=None):
+        """
+        Read a window of the image.
+
+        Parameters:
+            loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+            channels_to_load (int, slice or list, optional): Channels to read. Default is all channels.
+
+        Returns:
+            ndarray: Image data of the window, in CYX (or YX for a single channel index) layout.
+        """
+        slices = get_region_slices(
+            self.array.ndim, loading_region, channels_to_load, shape="CYX"
+        )
+        data = self.array[slices]
+        if hasattr(data, "compute"):
+            return data.compute()
+        return np.array(data)
+
+    def close(self):
+        self.file.close()
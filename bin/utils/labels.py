@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Largest label range relabelled with a dense lookup table, relative to the mask size
+MAX_LUT_RATIO = 4
+
+
+def offset_labels(mask, offset):
+    """
+    Add `offset` to every non-zero label of a mask; background stays 0.
+
+    Parameters:
+        mask (ndarray): Label image.
+        offset (int): Value added to the labels.
+
+    Returns:
+        ndarray: uint32 label image. The input is modified in place when it is already uint32.
+    """
+    mask = mask.astype(np.uint32, copy=False)
+    if offset:
+        mask[mask > 0] += np.uint32(offset)
+    return mask
+
+
+def relabel_sequential(mask):
+    """
+    Replace the non-zero labels of a mask by their rank in ascending order
+    (1, 2, ...); background stays 0.
+
+    The ranks come from a lookup table indexed by label (presence flags,
+    cumulated), applied to all pixels in one vectorized pass. Masks with
+    very sparse labels fall back to `np.unique(..., return_inverse=True)`.
+
+    Parameters:
+        mask (ndarray): Label image with non-negative labels.
+
+    Returns:
+        ndarray: uint32 label image. The input is overwritten when it is already uint32.
+    """
+    mask = mask.astype(np.uint32, copy=False)
+    if mask.size == 0:
+        return mask
+    max_label = int(mask.max())
+
+    if max_label > MAX_LUT_RATIO * mask.size:
+        values, inverse = np.unique(mask, return_inverse=True)
+        # Rank 0 is the background when it is present
+        ranks = np.arange(len(values), dtype=np.uint32) + np.uint32(values[0] != 0)
+        mask[...] = ranks[inverse.reshape(mask.shape)]
+        return mask
+
+    present = np.zeros(max_label + 1, dtype=bool)
+    present[mask.ravel()] = True
+    present[0] = False
+    lut = np.cumsum(present, dtype=np.uint32)
+    np.take(lut, mask, out=mask, mode="clip")
+    return mask
+
+
+class UnionFind:
+    """
+    Disjoint sets of labels, stored as a growable parent array.
+
+    The root of a set is its smallest label, so merged objects keep the
+    label of the tile that was stitched first.
+    """
+
+    def __init__(self, size=1):
+        self.parent = np.arange(size, dtype=np.uint32)
+
+    def grow(self, size):
+        """Make room for labels up to `size - 1`, each in its own set."""
+        if size > len(self.parent):
+            parent = np.arange(max(size, 2 * len(self.parent)), dtype=np.uint32)
+            parent[: len(self.parent)] = self.parent
+            self.parent = parent
+
+    def find(self, label):
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parent[max(first, second)] = min(first, second)
+
+    def get_roots(self, size):
+        """Root of every label below `size`, as a lookup table."""
+        roots = self.parent[:size].copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                return roots
+            roots = next_roots
+
+
+class LabelStitcher:
+    """
+    Stitch label tiles into an on-disk mask, reconciling objects cut by tile borders.
+
+    The mask is a memory-mapped .npy file: tiles are written as they come
+    and only the window of the current tile is read back, so memory stays
+    at a few tiles whatever the slide size. Tile labels are made unique by
+    a running offset. Where a tile overlaps tiles stitched before, its
+    labels are matched to the labels already written by IoU, measured on
+    the overlap only; matches above `iou_threshold` are merged through a
+    union-find table. Pixels already labelled keep their label, the new
+    tile fills the rest. `finalize` then relabels the mask band by band to
+    consecutive labels, one per merged object.
+    """
+
+    def __init__(self, path, shape, iou_threshold=0.5, band_size=2048):
+        self.mask = open_memmap(path, mode="w+", dtype=np.uint32, shape=tuple(shape[:2]))
+        self.iou_threshold = iou_threshold
+        self.band_size = band_size
+        self.areas = []
+        self.max_label = 0
+        self.union_find = UnionFind()
+
+    def get_covered(self, area):
+        """Pixels of an area already covered by stitched tiles."""
+        start_row, end_row, start_col, end_col = area
+        covered = np.zeros((end_row - start_row, end_col - start_col), dtype=bool)
+        for other in self.areas:
+            top, bottom = max(other[0], start_row), min(other[1], end_row)
+            left, right = max(other[2], start_col), min(other[3], end_col)
+            if top < bottom and left < right:
+                covered[top - start_row : bottom - start_row, left - start_col : right - start_col] = True
+        return covered
+
+    def reconcile(self, existing, labels):
+        """Merge the labels of a tile with the overlapping labels already written."""
+        both = (existing > 0) & (labels > 0)
+        if not both.any():
+            return 0
+        pairs = (existing[both].astype(np.uint64) << np.uint64(32)) | labels[both].astype(np.uint64)
+        keys, intersections = np.unique(pairs, return_counts=True)
+        old_ids = (keys >> np.uint64(32)).astype(np.uint32)
+        new_ids = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+        old_labels, old_areas = np.unique(existing[existing > 0], return_counts=True)
+        new_labels, new_areas = np.unique(labels[labels > 0], return_counts=True)
+        old_areas = old_areas[np.searchsorted(old_labels, old_ids)]
+        new_areas = new_areas[np.searchsorted(new_labels, new_ids)]
+        ious = intersections / (old_areas + new_areas - intersections)
+
+        matches = ious >= self.iou_threshold
+        for old_id, new_id in zip(old_ids[matches], new_ids[matches]):
+            self.union_find.union(int(old_id), int(new_id))
+        return int(matches.sum())
+
+    def add_tile(self, labels, area):
+        """
+        Write a label tile.
+
+        Parameters:
+            labels (ndarray): Tile labels, 0 for background.
+            area (tuple): (start_row, end_row, start_col, end_col) of the tile in the mask.
+
+        Returns:
+            int: Number of labels merged with labels of previous tiles.
+        """
+        start_row, end_row, start_col, end_col = area
+        labels = offset_labels(labels, self.max_label)
+        tile_max = int(labels.max(initial=0))
+        self.union_find.grow(tile_max + 1)
+
+        existing = np.asarray(self.mask[start_row:end_row, start_col:end_col])
+        covered = self.get_covered(area)
+        merged = 0
+        if covered.any():
+            merged = self.reconcile(existing[covered], labels[covered])
+
+        self.mask[start_row:end_row, start_col:end_col] = np.where(existing > 0, existing, labels)
+        self.areas.append(tuple(area))
+        self.max_label = max(self.max_label, tile_max)
+        return merged
+
+    def finalize(self):
+        """
+        Relabel the mask to consecutive labels, one per merged object, band by band.
+
+        Returns:
+            tuple: (memory-mapped mask, number of labels).
+        """
+        roots = self.union_find.get_roots(self.max_label + 1)
+        height = self.mask.shape[0]
+
+        present = np.zeros(len(roots), dtype=bool)
+        for start in range(0, height, self.band_size):
+            present[roots[self.mask[start : start + self.band_size].ravel()]] = True
+        present[0] = False
+        lut = np.cumsum(present, dtype=np.uint32)[roots]
+
+        for start in range(0, height, self.band_size):
+            band = self.mask[start : start + self.band_size]
+            band[...] = lut[band]
+        self.mask.flush()
+        return self.mask, int(lut.max(initial=0))
+
+
+def keep_core_labels(labels, area, core):
+    """
+    Keep the objects of a tile whose centroid lies in the tile core.
+
+    With cores partitioning the image and halos wider than the objects,
+    every object is kept whole by exactly one tile.
+
+    Parameters:
+        labels (ndarray): Labels of the tile, 0 for background.
+        area (tuple): (start_row, end_row, start_col, end_col) of the tile.
+        core (tuple): Core of the tile, in the same coordinates.
+
+    Returns:
+        ndarray: Labels with the objects owned by other tiles set to 0.
+    """
+    counts = np.bincount(labels.ravel())
+    if len(counts) <= 1:
+        return labels
+    rows, cols = np.indices(labels.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centroid_rows = np.bincount(labels.ravel(), weights=rows.ravel()) / counts + area[0]
+        centroid_cols = np.bincount(labels.ravel(), weights=cols.ravel()) / counts + area[2]
+
+    owned = (
+        (counts > 0)
+        & (centroid_rows >= core[0]) & (centroid_rows < core[1])
+        & (centroid_cols >= core[2]) & (centroid_cols < core[3])
+    )
+    owned[0] = False
+    return np.where(owned[labels], labels, 0)
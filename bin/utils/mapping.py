@@ -2,8 +2,10 @@
 
 import cv2
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
 from dipy.align.metrics import CCMetric
+from utils.warping import remap_image
 
 
 def apply_mapping(mapping, x, method="dipy"):
@@ -12,19 +14,26 @@ def apply_mapping(mapping, x, method="dipy"):
 
     Parameters:
         mapping: A mapping object from either the DIPY or the OpenCV package.
-        x (ndarray): 2-dimensional numpy array to transform.
-        method (str, optional): Method used for mapping. Either 'cv2' or 'dipy'. Default is 'dipy'.
+        x (ndarray): 2-dimensional numpy array to transform, or a YXC array with
+            the 'remap' method.
+        method (str, optional): Method used for mapping. Either 'cv2', 'dipy' or 'remap'.
+            'remap' warps with a DIPY mapping through OpenCV: the displacement field
+            is converted to sampling maps once and applied to all channels, keeping
+            the dtype of the input. Default is 'dipy'.
 
     Returns:
-        mapped (ndarray): Transformed image as a 2D numpy array.
+        mapped (ndarray): Transformed image.
     """
     # Validate the method parameter
-    if method not in ["cv2", "dipy"]:
-        raise ValueError("Invalid method specified. Choose either 'cv2' or 'dipy'.")
+    if method not in ["cv2", "dipy", "remap"]:
+        raise ValueError("Invalid method specified. Choose either 'cv2', 'dipy' or 'remap'.")
 
     # Apply the mapping based on the selected method
     if method == "dipy":
         mapped = mapping.transform(x)
+    elif method == "remap":
+        map_x, map_y = get_remap_maps(mapping)
+        mapped = remap_image(x, map_x, map_y)
     elif method == "cv2":
         height, width = x.shape[:2]
         mapped = cv2.warpAffine(x, mapping, (width, height))
@@ -32,75 +41,359 @@ def apply_mapping(mapping, x, method="dipy"):
     return mapped
 
 
+def get_remap_maps(mapping):
+    """
+    Convert a DIPY mapping into `cv2.remap` sampling maps.
+
+    The warped image samples the moving image at p + d(p), d being the
+    (row, col) forward displacement field of the mapping.
+
+    Returns:
+        tuple: (map_x, map_y) float32 arrays of the shape of the static image.
+    """
+    field = mapping.get_forward_field()
+    height, width = field.shape[:2]
+    map_y = np.arange(height, dtype=np.float32)[:, np.newaxis] + field[:, :, 0]
+    map_x = np.arange(width, dtype=np.float32)[np.newaxis, :] + field[:, :, 1]
+    return map_x.astype(np.float32), map_y.astype(np.float32)
+
+
+def rescale_affine_matrix(matrix, factor):
+    """
+    Express an affine matrix estimated on downsampled images at full resolution.
+
+    Pixel i of an image downsampled by block averaging covers full-resolution
+    pixels [i * factor, (i + 1) * factor), so its centre is at
+    i * factor + (factor - 1) / 2. Use 1 / factor to go the other way.
+
+    Parameters:
+        matrix (ndarray): 2x3 affine matrix in downsampled coordinates.
+        factor (float): Downsampling factor of the images the matrix was estimated on.
+
+    Returns:
+        ndarray: 2x3 affine matrix in full-resolution coordinates.
+    """
+    offset = (factor - 1) / 2
+    scaling = np.array([[factor, 0, offset], [0, factor, offset], [0, 0, 1]])
+    rescaled = scaling @ np.vstack([matrix, [0, 0, 1]]) @ np.linalg.inv(scaling)
+
+    return rescaled[:2].astype(np.float64)
+
+
+def compose_affine_matrices(first, second):
+    """
+    Compose two 2x3 affine matrices: the result applies `first`, then `second`.
+    """
+    composed = np.vstack([second, [0, 0, 1]]) @ np.vstack([first, [0, 0, 1]])
+
+    return composed[:2]
+
+
+def normalize_to_uint8(image):
+    """Rescale an image to the full 8-bit range, as expected by ORB."""
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+def _detect_orb_cell(image, area, n_features, margin):
+    """Detect ORB features in one grid cell, keeping only keypoints inside the cell."""
+    start_row, end_row, start_col, end_col = area
+    height, width = image.shape[:2]
+    # Read the cell with a margin so descriptors near the cell borders are complete
+    window_row, window_col = max(start_row - margin, 0), max(start_col - margin, 0)
+    window = image[window_row : min(end_row + margin, height), window_col : min(end_col + margin, width)]
+    if window.size == 0 or window.min() == window.max():
+        return np.empty((0, 2), dtype=np.float32), None
+
+    orb = cv2.ORB_create(fastThreshold=0, edgeThreshold=0, nfeatures=n_features)
+    keypoints, descriptors = orb.detectAndCompute(window, None)
+    if descriptors is None:
+        return np.empty((0, 2), dtype=np.float32), None
+
+    points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+    points += np.float32([window_col, window_row])
+    inside = (
+        (points[:, 0] >= start_col) & (points[:, 0] < end_col)
+        & (points[:, 1] >= start_row) & (points[:, 1] < end_row)
+    )
+    return points[inside], descriptors[inside]
+
+
+def detect_orb_features_grid(image, n_features=2000, grid_size=4, n_threads=1, margin=32):
+    """
+    Detect ORB features on a grid of cells, with a per-cell feature quota.
+
+    Bucketing spreads the features over the whole tissue instead of letting
+    a few dense regions take the whole budget, and the cells are processed
+    in parallel (OpenCV releases the GIL).
+
+    Parameters:
+        image (ndarray): 8-bit 2D image.
+        n_features (int, optional): Total feature budget, split evenly across cells. Default is 2000.
+        grid_size (int, optional): Number of cells along each axis. Default is 4.
+        n_threads (int, optional): Number of threads. Default is 1.
+        margin (int, optional): Context around each cell for the descriptors. Default is 32.
+
+    Returns:
+        tuple: (points, descriptors), an (N, 2) float32 array of (x, y) keypoint
+        coordinates and the (N, 32) uint8 ORB descriptors.
+    """
+    height, width = image.shape[:2]
+    row_edges = np.linspace(0, height, grid_size + 1).astype(int)
+    col_edges = np.linspace(0, width, grid_size + 1).astype(int)
+    areas = [
+        (row_edges[i], row_edges[i + 1], col_edges[j], col_edges[j + 1])
+        for i in range(grid_size)
+        for j in range(grid_size)
+    ]
+    features_per_cell = max(n_features // len(areas), 1)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = list(
+            executor.map(
+                lambda area: _detect_orb_cell(image, area, features_per_cell, margin), areas
+            )
+        )
+
+    results = [(p, d) for p, d in results if d is not None and len(p)]
+    if not results:
+        return np.empty((0, 2), dtype=np.float32), None
+    points = np.concatenate([p for p, _ in results])
+    descriptors = np.concatenate([d for _, d in results]).astype(np.uint8)
+
+    return points, descriptors
+
+
+def match_orb_features(descriptors1, descriptors2, ratio=0.75):
+    """
+    Match ORB descriptors with an LSH index, k=2 nearest neighbours and Lowe's ratio test.
+
+    Parameters:
+        descriptors1 (ndarray): Query descriptors (reference image).
+        descriptors2 (ndarray): Train descriptors (moving image).
+        ratio (float, optional): Maximum ratio between the best and second best distance. Default is 0.75.
+
+    Returns:
+        ndarray: (M, 2) array of (query index, train index) pairs.
+    """
+    index_params = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)  # FLANN_INDEX_LSH
+    matcher = cv2.FlannBasedMatcher(index_params, dict(checks=50))
+    knn_matches = matcher.knnMatch(descriptors1, descriptors2, k=2)
+
+    pairs = [
+        (m[0].queryIdx, m[0].trainIdx)
+        for m in knn_matches
+        if len(m) == 2 and m[0].distance < ratio * m[1].distance
+    ]
+    return np.array(pairs, dtype=np.int64).reshape(-1, 2)
+
+
+def estimate_affine_from_features(points1, descriptors1, points2, descriptors2, ratio=0.75,
+                                  ransac_threshold=5.0, max_iters=5000, confidence=0.995):
+    """
+    Match two feature sets and fit a partial affine (rotation, uniform scale,
+    translation) mapping the second onto the first with RANSAC.
+
+    Returns:
+        tuple: (matrix, number of RANSAC inliers). The matrix is None when
+        there are too few matches.
+    """
+    pairs = match_orb_features(descriptors1, descriptors2, ratio)
+    if len(pairs) < 3:
+        return None, 0
+
+    matrix, mask = cv2.estimateAffinePartial2D(
+        points2[pairs[:, 1]].reshape(-1, 1, 2),
+        points1[pairs[:, 0]].reshape(-1, 1, 2),
+        method=cv2.RANSAC,
+        ransacReprojThreshold=ransac_threshold,
+        maxIters=max_iters,
+        confidence=confidence,
+    )
+    n_inliers = int(mask.sum()) if mask is not None else 0
+
+    return matrix, n_inliers
+
+
 def compute_affine_mapping_cv2(
-    y: np.ndarray, x: np.ndarray, n_features=2000
+    y: np.ndarray,
+    x: np.ndarray,
+    n_features=2000,
+    max_features=16000,
+    min_inliers=30,
+    grid_size=4,
+    ratio=0.75,
+    ransac_threshold=5.0,
+    max_iters=5000,
+    confidence=0.995,
+    n_threads=1,
+    y_features=None,
 ):
     """
     Compute affine mapping using OpenCV.
 
+    Features are detected on a grid (see `detect_orb_features_grid`),
+    matched with LSH and a ratio test, and the partial affine is fitted
+    with RANSAC. If fewer than `min_inliers` matches agree, the feature
+    budget is doubled and the estimation repeated, up to `max_features`;
+    the first estimate with enough inliers is returned.
+
     Parameters:
         y (ndarray): Reference image.
         x (ndarray): Moving image to be registered.
-        crop (bool, optional): Whether to crop the images before processing. Default is True.
-        crop_size (int, optional): Size of the crop. Default is 4000.
-        n_features (int, optional): Maximum number of features to detect. Default is 2000.
+        n_features (int, optional): Initial number of features to detect. Default is 2000.
+        max_features (int, optional): Maximum number of features to detect. Default is 16000.
+        min_inliers (int, optional): RANSAC inliers needed to accept an estimate. Default is 30.
+        grid_size (int, optional): Number of feature grid cells along each axis. Default is 4.
+        ratio (float, optional): Ratio test threshold. Default is 0.75.
+        ransac_threshold (float, optional): RANSAC reprojection threshold in pixels. Default is 5.0.
+        max_iters (int, optional): Maximum RANSAC iterations. Default is 5000.
+        confidence (float, optional): RANSAC confidence. Default is 0.995.
+        n_threads (int, optional): Number of threads for feature detection. Default is 1.
+        y_features (tuple, optional): Precomputed (points, descriptors) of the reference
+            image at the `n_features` budget, reused instead of detecting them again.
 
     Returns:
-        matrix (ndarray): Affine transformation matrix.
+        matrix (ndarray): Affine transformation matrix, or None if no estimate was found.
     """
-    # Crop the images if specified and normalize them to 8-bit (0-255) for feature detection
-    y = cv2.normalize(y, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-    x = cv2.normalize(x, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    # Normalize the images to 8-bit (0-255) for feature detection
+    y = normalize_to_uint8(y)
+    x = normalize_to_uint8(x)
 
-    # Detect ORB keypoints and descriptors
-    orb = cv2.ORB_create(fastThreshold=0, edgeThreshold=0, nfeatures=n_features)
+    best_matrix, best_inliers = None, 0
+    while n_features <= max_features:
+        if y_features is not None:
+            points1, descriptors1 = y_features
+            y_features = None
+        else:
+            points1, descriptors1 = detect_orb_features_grid(y, n_features, grid_size, n_threads)
+        points2, descriptors2 = detect_orb_features_grid(x, n_features, grid_size, n_threads)
 
-    # Compute keypoints and descriptors for both images
-    keypoints1, descriptors1 = orb.detectAndCompute(y, None)
-    keypoints2, descriptors2 = orb.detectAndCompute(x, None)
+        if descriptors1 is None:
+            raise ValueError("Object 'descriptors1' is None")
+        elif descriptors2 is None:
+            raise ValueError("Object 'descriptors2' is None")
 
-    if descriptors1 is None:
-        raise ValueError("Object 'descriptors1' is None")
-    elif descriptors2 is None:
-        raise ValueError("Object 'descriptors2' is None")
+        matrix, n_inliers = estimate_affine_from_features(
+            points1, descriptors1, points2, descriptors2,
+            ratio=ratio,
+            ransac_threshold=ransac_threshold,
+            max_iters=max_iters,
+            confidence=confidence,
+        )
+        if matrix is not None and n_inliers > best_inliers:
+            best_matrix, best_inliers = matrix, n_inliers
+        if best_inliers >= min_inliers:
+            break
+        n_features *= 2
 
+    return best_matrix
 
-    # Convert descriptors to uint8 if they are not already in that format
-    if descriptors1 is not None and descriptors1.dtype != np.uint8:
-        descriptors1 = descriptors1.astype(np.uint8)
 
-    if descriptors2 is not None and descriptors2.dtype != np.uint8:
-        descriptors2 = descriptors2.astype(np.uint8)
+def estimate_translation_phase_correlation(y, x, min_response=0.05, max_shift=None):
+    """
+    Estimate the translation aligning x onto y by FFT phase correlation.
 
-    # Match descriptors using BFMatcher
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = bf.match(descriptors1, descriptors2)
-    matches = sorted(matches, key=lambda x: x.distance)
+    The peak of the normalized cross-power spectrum is located with subpixel
+    accuracy; a Hanning window limits the influence of the tile borders.
 
-    # Extract location of good matches
-    points1 = np.float32([keypoints1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-    points2 = np.float32([keypoints2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+    Parameters:
+        y (ndarray): Reference image.
+        x (ndarray): Moving image.
+        min_response (float, optional): Minimum peak response for the shift to be trusted. Default is 0.05.
+        max_shift (float, optional): Largest accepted shift in pixels. Default is no limit.
 
-    # Compute affine transformation matrix from matched points
-    matrix, mask = cv2.estimateAffinePartial2D(points2, points1)
+    Returns:
+        tuple: (2x3 translation matrix to apply to x, or None if the estimate
+        is not reliable, peak response).
+    """
+    if y.shape != x.shape:
+        raise ValueError(
+            "Reference image (y) and moving image (x) must have the same shape."
+        )
+    height, width = y.shape[:2]
+    window = cv2.createHanningWindow((width, height), cv2.CV_64F)
+    (shift_x, shift_y), response = cv2.phaseCorrelate(
+        y.astype(np.float64), x.astype(np.float64), window
+    )
+
+    if response < min_response:
+        return None, response
+    if max_shift is not None and max(abs(shift_x), abs(shift_y)) > max_shift:
+        return None, response
+
+    # x is y shifted by (shift_x, shift_y): shift it back
+    matrix = np.array([[1.0, 0.0, -shift_x], [0.0, 1.0, -shift_y]])
+    return matrix, response
+
+
+def compute_alignment_score(y, x, factor=4):
+    """
+    Normalized cross-correlation of two images on a downsampled grid.
+
+    Parameters:
+        y (ndarray): Reference image.
+        x (ndarray): Moving image.
+        factor (int, optional): Downsampling factor (area averaging). Default is 4.
+
+    Returns:
+        float: NCC in [-1, 1]; 0 if either image is constant.
+    """
+    if factor > 1:
+        size = (max(y.shape[1] // factor, 1), max(y.shape[0] // factor, 1))
+        y = cv2.resize(y.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+        x = cv2.resize(x.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+    y = y.astype(np.float64) - y.mean()
+    x = x.astype(np.float64) - x.mean()
+    norm = np.sqrt((y * y).sum() * (x * x).sum())
+    if norm == 0:
+        return 0.0
+    return float((y * x).sum() / norm)
 
-    return matrix
+
+# Speed/accuracy trade-offs of the SyN registration: pyramid levels (one
+# entry per level, coarsest first) with their maximum iterations, CC window
+# radius, dipy's convergence tolerance of each level (opt_tol) and tolerance
+# of the inverse field (inv_tol). "accurate" is the historical setting.
+DIPY_PROFILES = {
+    "fast": {"level_iters": [50, 20, 5], "radius": 4, "opt_tol": 1e-3, "inv_tol": 0.05},
+    "balanced": {"level_iters": [100, 50, 10], "radius": 10, "opt_tol": 1e-4, "inv_tol": 0.01},
+    "accurate": {"level_iters": [100, 100, 25], "radius": 20, "opt_tol": 1e-4, "inv_tol": 0.01},
+}
+
+
+def get_dipy_profile(profile):
+    """Return the settings of a named registration profile."""
+    if profile not in DIPY_PROFILES:
+        raise ValueError(
+            f"Unknown registration profile '{profile}'. Choose one of {list(DIPY_PROFILES)}."
+        )
+    return DIPY_PROFILES[profile]
 
 
 def compute_diffeomorphic_mapping_dipy(
-    y: np.ndarray, x: np.ndarray, sigma_diff=20, radius=20
+    y: np.ndarray, x: np.ndarray, sigma_diff=20, radius=None, profile="accurate", return_info=False,
+    warm_start=False,
 ):
     """
     Compute diffeomorphic mapping using DIPY.
 
+    Iterations stop through dipy's own convergence test: each pyramid level
+    ends once the energy derivative drops below the profile's `opt_tol`, or
+    at the level's maximum iterations. No other per-tile stop is applied.
+
     Parameters:
         y (ndarray): Reference image.
         x (ndarray): Moving image to be registered.
         sigma_diff (int, optional): Standard deviation for the CCMetric. Default is 20.
-        radius (int, optional): Radius for the CCMetric. Default is 20.
+        radius (int, optional): Radius for the CCMetric. Default is the profile's radius.
+        profile (str, optional): Registration profile, one of 'fast', 'balanced' or 'accurate'. Default is 'accurate'.
+        return_info (bool, optional): Also return the profile and the number of iterations run. Default is False.
+        warm_start (bool, optional): The moving image was pre-warped by a coarse field, so the
+            coarsest pyramid level is skipped. Default is False.
 
     Returns:
         mapping: A mapping object containing the transformation information.
+        dict: Profile and iterations run, if `return_info` is True.
     """
     # Check if both images have the same shape
     if y.shape != x.shape:
@@ -108,11 +401,31 @@ def compute_diffeomorphic_mapping_dipy(
             "Reference image (y) and moving image (x) must have the same shape."
         )
 
+    settings = get_dipy_profile(profile)
+    if radius is None:
+        radius = settings["radius"]
+    level_iters = list(settings["level_iters"])
+    if warm_start and len(level_iters) > 1:
+        level_iters = level_iters[1:]
+
     # Define the metric and create the Symmetric Diffeomorphic Registration object
     metric = CCMetric(2, sigma_diff=sigma_diff, radius=radius)
-    sdr = SymmetricDiffeomorphicRegistration(metric, opt_tol=1e-04, inv_tol=0.01)
+    sdr = SymmetricDiffeomorphicRegistration(
+        metric,
+        level_iters=level_iters,
+        opt_tol=settings["opt_tol"],
+        inv_tol=settings["inv_tol"],
+    )
 
     # Perform the diffeomorphic registration using the pre-alignment from affine registration
     mapping = sdr.optimize(y, x)
 
-    return mapping
\ No newline at end of file
+    if return_info:
+        # One energy value is recorded per iteration, over all levels
+        info = {
+            "profile": profile,
+            "iterations": len(getattr(sdr, "full_energy_profile", [])),
+        }
+        return mapping, info
+
+    return mapping
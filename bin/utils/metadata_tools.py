@@ -2,12 +2,12 @@
 
 import tifffile
 import nd2
-import h5py
 import tifffile
 import xml.etree.ElementTree as ET
 import json
 import os
 from nd2reader import ND2Reader
+from utils.io import get_store_format, open_image_store
 
 
 def get_channel_list():
@@ -40,7 +40,7 @@ def get_channel_list():
 
 def get_image_file_shape(file, format=None):
     """
-    Get the width and height (or shape) of TIFF, ND2, or HDF5 images 
+    Get the width and height (or shape) of TIFF, ND2, HDF5 or Zarr images 
     without fully loading them.
     """
 
@@ -49,7 +49,10 @@ def get_image_file_shape(file, format=None):
         format = format[1:]
 
     if format is None:
-        format = file.split(".")[-1].lower()
+        if get_store_format(file) != "h5":
+            format = "zarr"
+        else:
+            format = file.split(".")[-1].lower()
 
     if format in ("tiff", "tif"):
         with tifffile.TiffFile(file) as tiff:
@@ -61,9 +64,9 @@ def get_image_file_shape(file, format=None):
             s = dict(nd2_file.sizes)
             return (s.get("C", 0), s.get("Y", 0), s.get("X", 0))
 
-    elif format == "h5":
-        with h5py.File(file, "r") as f:
-            return f["dataset"].shape
+    elif format in ("h5", "zarr"):
+        with open_image_store(file) as store:
+            return store.shape
 
     else:
         raise ValueError(f"Unsupported format: {format}")
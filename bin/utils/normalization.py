@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+
+def get_percentiles(image, percentiles=(1.0, 99.8), band_size=1024, n_samples=1_000_000, seed=0):
+    """
+    Percentiles of a whole-slide image, computed one band of rows at a time.
+
+    Images of 8 or 16 bit integers are counted in a histogram with one bin
+    per value, which gives the same result as `np.percentile` (linear
+    interpolation) without sorting or copying the slide. Other dtypes are
+    estimated from an evenly spread random sample of about `n_samples` pixels.
+
+    Parameters:
+        image (ndarray): 2D image, possibly memory-mapped.
+        percentiles (tuple, optional): Percentiles to compute, in [0, 100]. Default is (1, 99.8).
+        band_size (int, optional): Number of rows read at once. Default is 1024.
+        n_samples (int, optional): Sample size for non-integer images. Default is 1e6.
+        seed (int, optional): Seed of the sampling. Default is 0.
+
+    Returns:
+        list: One value per percentile.
+    """
+    height = image.shape[0]
+    if image.size == 0:
+        raise ValueError("Cannot compute the percentiles of an empty image.")
+
+    if image.dtype in (np.uint8, np.uint16):
+        counts = np.zeros(np.iinfo(image.dtype).max + 1, dtype=np.int64)
+        for start in range(0, height, band_size):
+            counts += np.bincount(
+                np.asarray(image[start : start + band_size]).ravel(), minlength=len(counts)
+            )
+        cumulative = np.cumsum(counts)
+        total = int(cumulative[-1])
+
+        def get_value(rank):
+            # Value of the pixel of the given rank (0-based) in sorted order
+            return int(np.searchsorted(cumulative, rank, side="right"))
+
+        values = []
+        for percentile in percentiles:
+            rank = percentile / 100 * (total - 1)
+            low, high = int(np.floor(rank)), int(np.ceil(rank))
+            low_value, high_value = get_value(low), get_value(high)
+            values.append(low_value + (high_value - low_value) * (rank - low))
+        return values
+
+    rng = np.random.default_rng(seed)
+    fraction = min(n_samples / image.size, 1.0)
+    samples = []
+    for start in range(0, height, band_size):
+        band = np.asarray(image[start : start + band_size]).ravel()
+        n_band = int(np.ceil(band.size * fraction))
+        samples.append(band[rng.choice(band.size, size=n_band, replace=False)] if fraction < 1 else band)
+    return [float(v) for v in np.percentile(np.concatenate(samples), percentiles)]
+
+
+def normalize_intensity(image, low, high, eps=1e-20):
+    """
+    Scale intensities so that `low` maps to 0 and `high` to 1, as csbdeep's
+    `normalize_mi_ma`, without clipping.
+
+    Returns:
+        ndarray: float32 image.
+    """
+    image = image.astype(np.float32)
+    image -= np.float32(low)
+    image /= np.float32(high - low + eps)
+    return image
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import logging
+import tifffile
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+logger = logging.getLogger(__name__)
+
+
+class TiffRegionReader:
+    """
+    Lazy reader returning windows of the first series of a TIFF file.
+
+    Windows are decoded on demand through tifffile's zarr interface, so only
+    the tiles or strips overlapping a window are read. Without zarr, the
+    file is memory-mapped when it is uncompressed and contiguous, and fully
+    loaded otherwise.
+    """
+
+    def __init__(self, path, level=0):
+        self.path = path
+        self.tiff = tifffile.TiffFile(path)
+        series = self.tiff.series[0]
+        self.shape = series.levels[level].shape
+        self.dtype = series.dtype
+        self.store = None
+
+        if zarr is not None:
+            self.store = series.aszarr(level=level)
+            self.array = zarr.open(self.store, mode="r")
+        else:
+            try:
+                self.array = tifffile.memmap(path, mode="r", series=0, level=level)
+            except ValueError:
+                logger.warning(f"{path} cannot be memory-mapped, loading the whole image.")
+                self.array = series.levels[level].asarray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_region(self, loading_region=None, channels_to_load=None):
+        """
+        Read a window of the image.
+
+        Parameters:
+            loading_region (tuple, optional): (start_row, end_row, start_col, end_col)
+                on the last two axes. Default is the whole image.
+            channels_to_load (int, slice or list, optional): Channels to read from a
+                CYX image. Default is all channels.
+
+        Returns:
+            ndarray: Image data of the window.
+        """
+        rows, cols = slice(None), slice(None)
+        if loading_region is not None:
+            start_row, end_row, start_col, end_col = loading_region
+            rows, cols = slice(start_row, end_row), slice(start_col, end_col)
+        if len(self.shape) == 2:
+            return self.array[rows, cols]
+        channels = slice(None) if channels_to_load is None else channels_to_load
+        return self.array[..., channels, rows, cols]
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        self.tiff.close()
+
+
+def load_tiff_region(path, loading_region=None):
+    """
+    Load a window of a TIFF image without reading the rest of the file.
+
+    Parameters:
+        path (str): Path to the TIFF image.
+        loading_region (tuple, optional): (start_row, end_row, start_col, end_col). Default is the whole image.
+
+    Returns:
+        ndarray: Image data of the window.
+    """
+    with TiffRegionReader(path) as reader:
+        data = reader.read_region(loading_region)
+    return data
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+
+def get_halo_size(max_object_diameter, expand_distance=0):
+    """
+    Halo needed around a tile core so that every object whose centroid lies
+    in the core is fully visible, with context, in the tile.
+
+    Parameters:
+        max_object_diameter (int): Largest object diameter, in pixels.
+        expand_distance (int, optional): Distance labels are expanded by after prediction.
+
+    Returns:
+        int: Halo width in pixels.
+    """
+    return int(max_object_diameter) + int(expand_distance)
+
+
+def get_halo_tiles(shape, tile_size, halo):
+    """
+    Plan a grid of non-overlapping tile cores, each read with a halo around it.
+
+    Cores partition the image, so each pixel is owned by one tile; only the
+    halos are predicted twice.
+
+    Parameters:
+        shape (tuple): (height, width) of the image.
+        tile_size (int): Size of the tile cores.
+        halo (int): Width of the context read around each core.
+
+    Returns:
+        list: (area, core) tuples in row-major order, both as
+        (start_row, end_row, start_col, end_col); `area` is the core grown
+        by the halo and clipped to the image.
+    """
+    height, width = shape[:2]
+    tiles = []
+    for start_row in range(0, height, tile_size):
+        for start_col in range(0, width, tile_size):
+            core = (
+                start_row,
+                min(start_row + tile_size, height),
+                start_col,
+                min(start_col + tile_size, width),
+            )
+            area = (
+                max(core[0] - halo, 0),
+                min(core[1] + halo, height),
+                max(core[2] - halo, 0),
+                min(core[3] + halo, width),
+            )
+            tiles.append((area, core))
+    return tiles
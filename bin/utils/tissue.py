@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def is_uniform(image):
+    """
+    Check whether an image holds a single value (blank or padding tile).
+
+    Two linear passes, unlike `len(np.unique(image)) == 1`, which sorts the tile.
+    """
+    return image.size == 0 or image.min() == image.max()
+
+
+def get_otsu_threshold(values, n_bins=256):
+    """
+    Otsu threshold of a set of intensities, computed on their histogram.
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if values.size == 0 or values.min() == values.max():
+        return None
+    counts, edges = np.histogram(values, bins=n_bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(counts * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    between_variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+
+    return centers[np.argmax(between_variance)]
+
+
+def get_integral_image(mask):
+    """Summed-area table of a 2D array, with a leading row and column of zeros."""
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0, dtype=np.int64), axis=1)
+    return integral
+
+
+def dilate_mask(mask, radius):
+    """Square dilation of a boolean mask, through its summed-area table."""
+    if radius <= 0:
+        return mask
+    height, width = mask.shape
+    integral = get_integral_image(mask)
+    rows = np.arange(height)
+    cols = np.arange(width)
+    top, bottom = np.clip(rows - radius, 0, height), np.clip(rows + radius + 1, 0, height)
+    left, right = np.clip(cols - radius, 0, width), np.clip(cols + radius + 1, 0, width)
+    counts = (
+        integral[bottom[:, None], right[None, :]]
+        - integral[top[:, None], right[None, :]]
+        - integral[bottom[:, None], left[None, :]]
+        + integral[top[:, None], left[None, :]]
+    )
+    return counts > 0
+
+
+class TissueIndex:
+    """
+    Low-resolution tissue mask of a slide, queried by the tile planners.
+
+    Pixel (i, j) of the mask covers full-resolution pixels
+    [i * factor, (i + 1) * factor) x [j * factor, (j + 1) * factor).
+    The occupancy of any rectangular area is answered in constant time
+    from the summed-area table of the mask. Areas the mask does not cover
+    (e.g. the trailing rows dropped by the downsampling) count as tissue,
+    so tiles are never skipped by mistake.
+    """
+
+    def __init__(self, mask, factor, shape):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.factor = int(factor)
+        self.shape = tuple(int(s) for s in shape[:2])
+        self.integral = get_integral_image(self.mask)
+
+    @classmethod
+    def from_dapi(cls, dapi, factor, shape, margin=2):
+        """
+        Build the index from a DAPI image downsampled by `factor`.
+
+        Tissue is the DAPI above its Otsu threshold, zeros (padding) excluded,
+        dilated by `margin` low-resolution pixels so tile borders are kept.
+
+        Parameters:
+            dapi (ndarray): Downsampled DAPI, e.g. from `utils.io.load_h5_downsampled`.
+            factor (int): Downsampling factor of `dapi`.
+            shape (tuple): Full-resolution (height, width) of the slide.
+            margin (int, optional): Dilation radius, in low-resolution pixels. Default is 2.
+
+        Returns:
+            TissueIndex: The index.
+        """
+        dapi = np.asarray(dapi)
+        foreground = dapi > 0
+        threshold = get_otsu_threshold(dapi[foreground])
+        if threshold is None:
+            mask = foreground
+        else:
+            mask = foreground & (dapi > threshold)
+        mask = dilate_mask(mask, margin)
+        logger.debug(f"Tissue index: {mask.mean():.1%} of the slide is tissue (threshold {threshold})")
+        return cls(mask, factor, shape)
+
+    def save(self, path):
+        """Save the index as a compressed .npz file."""
+        np.savez_compressed(
+            path,
+            mask=self.mask,
+            factor=np.int64(self.factor),
+            shape=np.array(self.shape, dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by `save`."""
+        with np.load(path) as data:
+            return cls(data["mask"], int(data["factor"]), tuple(data["shape"].tolist()))
+
+    def get_occupancy(self, area):
+        """
+        Fraction of an area covered by tissue.
+
+        Parameters:
+            area (tuple): (start_row, end_row, start_col, end_col) at full resolution.
+
+        Returns:
+            float: Tissue fraction in [0, 1].
+        """
+        start_row, end_row, start_col, end_col = area
+        height, width = self.mask.shape
+        top, left = start_row // self.factor, start_col // self.factor
+        bottom, right = -(-end_row // self.factor), -(-end_col // self.factor)
+        if end_row <= start_row or end_col <= start_col:
+            return 0.0
+        # Only the part of the area the mask covers is measured
+        bottom, right = min(bottom, height), min(right, width)
+        if top >= bottom or left >= right:
+            return 1.0
+        tissue = (
+            self.integral[bottom, right]
+            - self.integral[top, right]
+            - self.integral[bottom, left]
+            + self.integral[top, left]
+        )
+        return tissue / ((bottom - top) * (right - left))
+
+    def has_tissue(self, area, min_occupancy=0.0):
+        """Check whether the tissue fraction of an area exceeds `min_occupancy`."""
+        return self.get_occupancy(area) > min_occupancy
+
+    def filter_areas(self, areas, min_occupancy=0.0):
+        """
+        Keep the areas with tissue.
+
+        Returns:
+            list: Areas whose tissue fraction exceeds `min_occupancy`, in input order.
+        """
+        kept = [area for area in areas if self.has_tissue(area, min_occupancy)]
+        logger.debug(f"Tissue index: {len(kept)}/{len(areas)} tiles with tissue")
+        return kept
+
+
+def load_tissue_index(path):
+    """Return the TissueIndex saved at `path`, or None if no index is given."""
+    if not path:
+        return None
+    return TissueIndex.load(path)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from utils.cropping import get_tile_areas
+from utils.io import create_image_store, open_image_store
+
+logger = logging.getLogger(__name__)
+
+
+def split_channels_groups(image, group_size=4):
+    """
+    Split a YXC image into groups of at most `group_size` channels, the
+    largest number of channels OpenCV warps in a single call.
+    """
+    if image.ndim == 2:
+        return [image]
+    return [image[:, :, idx : idx + group_size] for idx in range(0, image.shape[2], group_size)]
+
+
+def warp_affine(image, matrix, size, interpolation=cv2.INTER_LINEAR):
+    """
+    Warp a 2D or YXC image with an affine matrix, whatever its number of channels.
+
+    Parameters:
+        image (ndarray): Image to warp.
+        matrix (ndarray): 2x3 affine matrix mapping source to output coordinates.
+        size (tuple): (width, height) of the output.
+        interpolation (int, optional): OpenCV interpolation flag. Default is bilinear.
+
+    Returns:
+        ndarray: Warped image, with the dtype of the input.
+    """
+    warped = [
+        cv2.warpAffine(group, matrix, size, flags=interpolation, borderValue=0)
+        for group in split_channels_groups(image)
+    ]
+    warped = [w[:, :, np.newaxis] if w.ndim == 2 and image.ndim == 3 else w for w in warped]
+    if len(warped) == 1:
+        return warped[0]
+    return np.concatenate(warped, axis=2)
+
+
+def remap_image(image, map_x, map_y, interpolation=cv2.INTER_LINEAR):
+    """
+    Sample a 2D or YXC image at remap coordinates, whatever its number of channels.
+
+    The maps are computed once by the caller and shared by all channels;
+    OpenCV parallelizes each call over its own thread pool. Pixels sampled
+    outside the image are 0.
+
+    Parameters:
+        image (ndarray): Image to sample.
+        map_x (ndarray): float32 column coordinates, one per output pixel.
+        map_y (ndarray): float32 row coordinates, one per output pixel.
+        interpolation (int, optional): OpenCV interpolation flag. Default is bilinear.
+
+    Returns:
+        ndarray: Sampled image, with the dtype of the input.
+    """
+    dtype = image.dtype
+    # cv2.remap does not handle every dtype (e.g. uint32, int64, bool)
+    if dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        image = image.astype(np.float32)
+
+    remapped = [
+        cv2.remap(group, map_x, map_y, interpolation=interpolation,
+                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        for group in split_channels_groups(image)
+    ]
+    remapped = [r[:, :, np.newaxis] if r.ndim == 2 and image.ndim == 3 else r for r in remapped]
+    remapped = remapped[0] if len(remapped) == 1 else np.concatenate(remapped, axis=2)
+
+    if remapped.dtype != dtype:
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            remapped = np.clip(np.rint(remapped), info.min, info.max)
+        remapped = remapped.astype(dtype)
+    return remapped
+
+
+def get_source_region(matrix, area, shape, margin=2):
+    """
+    Get the region of the source image that an output tile samples from.
+
+    Parameters:
+        matrix (ndarray): 2x3 affine matrix mapping source to output coordinates.
+        area (tuple): Output tile (start_row, end_row, start_col, end_col).
+        shape (tuple): Shape of the source image.
+        margin (int, optional): Extra pixels around the region for interpolation. Default is 2.
+
+    Returns:
+        tuple: Source region (start_row, end_row, start_col, end_col), or None if the
+        tile samples only outside the source image.
+    """
+    start_row, end_row, start_col, end_col = area
+    inverse = cv2.invertAffineTransform(matrix)
+    corners = np.array(
+        [
+            [start_col, start_row, 1],
+            [end_col - 1, start_row, 1],
+            [start_col, end_row - 1, 1],
+            [end_col - 1, end_row - 1, 1],
+        ],
+        dtype=np.float64,
+    )
+    # Points are (x, y) = (col, row)
+    source = corners @ inverse.T
+    src_start_col = max(int(np.floor(source[:, 0].min())) - margin, 0)
+    src_end_col = min(int(np.ceil(source[:, 0].max())) + margin + 1, shape[1])
+    src_start_row = max(int(np.floor(source[:, 1].min())) - margin, 0)
+    src_end_row = min(int(np.ceil(source[:, 1].max())) + margin + 1, shape[0])
+
+    if src_start_row >= src_end_row or src_start_col >= src_end_col:
+        return None
+    return (src_start_row, src_end_row, src_start_col, src_end_col)
+
+
+def get_tile_matrix(matrix, area, source_region):
+    """
+    Express a global affine matrix between a source window and an output tile.
+    """
+    tile_matrix = np.array(matrix, dtype=np.float64)
+    source_origin = np.array([source_region[2], source_region[0]], dtype=np.float64)
+    output_origin = np.array([area[2], area[0]], dtype=np.float64)
+    tile_matrix[:, 2] = matrix[:, :2] @ source_origin + matrix[:, 2] - output_origin
+
+    return tile_matrix
+
+
+def warp_affine_to_store(moving_path, output_path, matrix, tile_size=2500, n_threads=1,
+                         chunk_size=None, compression=None):
+    """
+    Warp a YXC image store with an affine matrix, one output tile at a time.
+
+    Each output tile is computed once: the matrix is inverted to find the
+    source window the tile samples from, only that window is read, and the
+    warped tile is written straight to the output store. Tiles are processed
+    by a pool of threads; reads and writes are serialized, warps run in
+    parallel.
+
+    Parameters:
+        moving_path (str): Moving image store.
+        output_path (str): Output image store, with the shape and dtype of the moving image.
+        matrix (ndarray): 2x3 affine matrix mapping moving to output coordinates.
+        tile_size (int, optional): Size of the output tiles. Default is 2500.
+        n_threads (int, optional): Number of worker threads. Default is 1.
+        chunk_size (int, optional): Chunk edge of the output store.
+        compression (str, optional): Compression of the output store.
+    """
+    lock = threading.Lock()
+    # Parallelism comes from the tile pool, keep OpenCV single-threaded per tile
+    # and give the process back its thread setting afterwards
+    cv2_threads = cv2.getNumThreads()
+    if n_threads > 1:
+        cv2.setNumThreads(1)
+
+    try:
+        with open_image_store(moving_path) as moving, create_image_store(
+            output_path,
+            data_shape=moving.shape,
+            dtype=moving.dtype,
+            chunk_size=chunk_size,
+            compression=compression,
+        ) as output:
+            shape = moving.shape
+
+            def warp_tile(area):
+                source_region = get_source_region(matrix, area, shape)
+                if source_region is None or moving.is_padding(source_region):
+                    return
+                with lock:
+                    source = moving.read_region(source_region)
+                start_row, end_row, start_col, end_col = area
+                tile = warp_affine(
+                    source,
+                    get_tile_matrix(matrix, area, source_region),
+                    (end_col - start_col, end_row - start_row),
+                )
+                with lock:
+                    output.write_region(tile, area)
+
+            areas = get_tile_areas(shape, tile_size)
+            logger.debug(f"Warping {len(areas)} tiles with {n_threads} threads")
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                # Consume the results to surface worker exceptions
+                list(executor.map(warp_tile, areas))
+    finally:
+        cv2.setNumThreads(cv2_threads)
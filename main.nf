@@ -135,24 +135,39 @@ workflow {
         by: 0
     )
 
-    affine(affine_input)
+    // One affine task per patient: the fixed image is loaded once for all moving rounds
+    affine(affine_input.groupTuple().map { it ->
+        return [it[0], it[1], it[2][0], it[3][0]]
+    })
 
     crops_data = affine.out.map { it ->
         def patient_id = it[0]
-        def moving_image = it[1]
+        def moving_images = it[1] instanceof List ? it[1] : [it[1]]
         def fixed_image = it[2]
-        def crops_paths = it[3] // Paths to *.pkl files
+        def crops_paths = it[3] instanceof List ? it[3] : [it[3]] // Paths to *.npz tile payloads
         def channels_to_register = it[4]
 
-        if (crops_paths.getClass() == sun.nio.fs.UnixPath) {
-            // Handle the case where aug_data is a String
-            return [patient_id, moving_image, fixed_image, crops_paths, channels_to_register].collate(5)
-        } else if (crops_paths instanceof List) {
-            // Handle the case where aug_data is a List
-            return crops_paths.collect { crops_path ->                    
-                return [patient_id, moving_image, fixed_image, crops_path, channels_to_register]
+        // Crops are named <row>_<col>_<moving image name>.npz, without the padded_ prefix;
+        // longest names first, so a name that ends another one cannot steal its crops
+        def candidates = moving_images.sort(false) { -it.getName().length() }
+        def crops_per_moving = crops_paths.groupBy { crops_path ->
+            def moving_image = candidates.find { moving ->
+                crops_path.getName().endsWith("_" + moving.getName().replace('padded_', '') + ".npz")
             }
+            if (moving_image == null) {
+                error "Crop ${crops_path.getName()} of patient ${patient_id} matches none of its moving images: ${moving_images*.getName()}"
+            }
+            return moving_image
         }
+
+        // Batches of crops of the same moving image, registered by one task
+        def batches = []
+        crops_per_moving.each { moving_image, paths ->
+            paths.collate(params.diffeo_batch_size).each { batch ->
+                batches << [patient_id, moving_image, fixed_image, batch, channels_to_register]
+            }
+        }
+        return batches
     } 
     .flatMap { it }
 
@@ -168,20 +183,38 @@ workflow {
 
         return [patient_id, moving.getName(), moving, fixed, registered_dapi, registered_crop, channels_to_register]
     }.groupTuple(by:1).map{
-        return [it[0][0], it[2][0], it[3][0], it[4], it[5]]
+        // One list of crops per batch: flatten them into a single list per moving image
+        return [it[0][0], it[2][0], it[3][0], it[4].flatten(), it[5].flatten()]
     }
 
-    stitching(collapsed)
+    // Affine image of each moving image, warped with the stitched displacement field
+    affine_images = affine.out.flatMap { it ->
+        def moving_images = it[1] instanceof List ? it[1] : [it[1]]
+        def affine_paths = it[5] instanceof List ? it[5] : [it[5]]
+        return moving_images.collect { moving ->
+            [moving.getName(), affine_paths.find { it.getName() == "affine_" + moving.getName() }]
+        }
+    }
+
+    stitching_input = collapsed
+        .map { it -> [it[1].getName(), it] }
+        .join(affine_images)
+        .map { name, record, affine_image -> record + [affine_image] }
+
+    stitching(stitching_input)
     quality_control(collapsed)
 
-    ch_single_dapi = stitching.out
+    ch_single_dapi = stitching.out.tiff
         .map { id, files, dapi -> tuple(id, dapi) }
         .groupTuple()
         .map { id, dapis -> tuple(id, dapis.sort { it.name }[0]) }
     
-    segmentation(ch_single_dapi)
+    // Tissue index of each patient, built by the affine step from the fixed DAPI
+    tissue_index = affine.out.map { it -> [it[0], it[6]] }
+
+    segmentation(ch_single_dapi.join(tissue_index))
 
-    ch_files_per_id = stitching.out.map { id, files, _ ->
+    ch_files_per_id = stitching.out.tiff.map { id, files, _ ->
         // drop the DAPI file from the inner list
         tuple(id, files)
     }.groupTuple(by:0).map { id, nestedLists ->
@@ -192,7 +225,7 @@ workflow {
     }
     
     // join with segmentation: [id, files] ⨝ [id, file1, file2, dapi_seg]
-    ch_combined = ch_files_per_id.join(segmentation.out, by:0)
+    ch_combined = ch_files_per_id.join(segmentation.out, by:0).join(tissue_index, by:0)
 
     quantification(ch_combined)
     phenotyping(quantification.out)
@@ -38,6 +38,10 @@ process apply_padding{
         apply_padding.py \
             --image $img \
             --padding $padding \
+            --store_format ${params.store_format} \
+            ${params.virtual_padding ? '--virtual_padding' : ''} \
+            --chunk_size ${params.h5_chunk_size} \
+            --compression ${params.h5_compression} \
             --log_file "${params.log_file}"
     """
 }
@@ -3,15 +3,17 @@
 */
 
 process affine{
-    cpus 2
+    cpus 4
     maxRetries = 3
     memory { task.memory + 10 * task.attempt}
     tag "affine"
 
     input:
+        // All moving rounds of a patient, registered against one loaded fixed image
         tuple val(patient_id), path(moving), path(fixed), path(channels_to_register)
     output:
-        tuple val(patient_id), path(moving), path(fixed), path("*pkl"), path(channels_to_register)
+        // Tile payloads are named <row>_<col>_<moving image>.npz
+        tuple val(patient_id), path(moving), path(fixed), path("[0-9]*.npz"), path(channels_to_register), path("affine_*"), path("tissue_*.npz")
  
     script:
     """
@@ -23,18 +25,26 @@ process affine{
             --moving_image $moving \
             --fixed_image $fixed \
             --crop_size_affine ${params.crop_size_affine} \
-            --overlap_size_affine ${params.overlap_size_affine} \
             --crop_size_diffeo ${params.crop_size_diffeo} \
             --overlap_size_diffeo ${params.overlap_size_diffeo} \
+            --downscale_factor ${params.affine_downscale} \
+            --refine_factor ${params.affine_refine_downscale} \
+            --n_threads ${task.cpus} \
+            --n_features ${params.affine_n_features} \
+            --warm_start_factor ${params.diffeo_warm_start_downscale} \
+            --tissue_factor ${params.tissue_downscale} \
+            --chunk_size ${params.h5_chunk_size} \
+            --compression ${params.h5_compression} \
+            ${params.registration_cache_dir ? "--cache_dir ${params.registration_cache_dir}" : ""} \
             --log_file "${params.log_file}"
     """
 }
  
 
 process diffeomorphic{
-    cpus 1
+    cpus params.diffeo_cpus
     maxRetries = 3
-    memory { 2.GB * task.attempt }
+    memory { 2.GB * task.cpus * task.attempt }
     array { task.array }
     tag "diffeomorphic"
 
@@ -45,7 +55,7 @@ process diffeomorphic{
         path(moving), 
         path(fixed), 
         path("qc*"), 
-        path("registered*"), 
+        path("field*"), 
         path(channels_to_register)
  
     script:
@@ -57,6 +67,16 @@ process diffeomorphic{
             --channels_to_register $channels_to_register \
             --crop_image $crop \
             --moving_image $moving \
+            --n_workers ${task.cpus} \
+            --field_downscale ${params.field_downscale} \
+            --profile ${params.diffeo_profile} \
+            ${params.diffeo_phase_correlation ? '--phase_correlation' : ''} \
+            ${params.diffeo_ncc_threshold ? "--ncc_threshold ${params.diffeo_ncc_threshold}" : ''} \
+            --chunk_size ${params.h5_chunk_size} \
+            --compression ${params.h5_compression} \
+            --dtype ${params.image_dtype} \
+            ${params.validate_dtype ? '--validate_dtype' : ''} \
+            ${params.registration_cache_dir ? "--cache_dir ${params.registration_cache_dir}" : ""} \
             --log_file "${params.log_file}"
     """
 }
\ No newline at end of file
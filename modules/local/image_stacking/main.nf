@@ -15,6 +15,10 @@ process stacking {
         --patient_id "$patient_id" \
         --channels "$channels" \
         --n_crops ${params.n_crops} \
+        --chunk_size ${params.h5_chunk_size} \
+        --compression ${params.h5_compression} \
+        --dtype ${params.image_dtype} \
+        ${params.validate_dtype ? '--validate_dtype' : ''} \
         --log_file "${params.log_file}"
     """
 }
\ No newline at end of file
@@ -7,10 +7,11 @@ process stitching{
     tag "stitching"
 
     input:
-        tuple val(patient_id), path(moving), path(fixed), path(dapi_crops), path(crops)
+        tuple val(patient_id), path(moving), path(fixed), path(dapi_crops), path(crops), path(affine)
     output:
         // tuple val(patient_id), path("registered_${patient_id}*h5"), emit: "h5"
         tuple val(patient_id), path("registered_${patient_id}*tiff"), path("registered_${patient_id}*DAPI*tiff"), emit: "tiff"
+        tuple val(patient_id), path("displacement_*.npz"), optional: true, emit: "displacement"
  
     script:
     """
@@ -22,6 +23,9 @@ process stitching{
             --overlap_size ${params.overlap_size_diffeo} \
             --fixed $fixed \
             --moving $moving \
+            --affine_image $affine \
+            --dtype ${params.image_dtype} \
+            ${params.validate_dtype ? '--validate_dtype' : ''} \
             --log_file "${params.log_file}"
     """
 }
\ No newline at end of file
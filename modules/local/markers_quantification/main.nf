@@ -8,7 +8,7 @@ process quantification{
     tag "quantification"
 
     input:
-        tuple val(patient_id), path(markers), path(positions_file), path(mask_file)
+        tuple val(patient_id), path(markers), path(positions_file), path(mask_file), path(tissue_index)
     output:
         // tuple val(patient_id), path("registered_${patient_id}*h5"), emit: "h5"
         tuple val(patient_id), path("*segmentation_markers_data_FULL.csv"), path(mask_file), emit: "quantification"
@@ -25,6 +25,7 @@ process quantification{
         --indir tmp \
         --mask_file ${mask_file} \
         --positions_file ${positions_file} \
+        --tissue_index ${tissue_index} \
         --outdir .
 
         # rm crop*
@@ -16,6 +16,8 @@ process reconstruct_channels {
         --image $image \
         --crops $tif_crops \
         --is_fixed $is_fixed \
+        --dtype ${params.image_dtype} \
+        ${params.validate_dtype ? '--validate_dtype' : ''} \
         --log_file "${params.log_file}"
     """
 }
\ No newline at end of file
@@ -1,14 +1,14 @@
 process segmentation{
-    cpus 1
+    cpus params.segmentation_cpus
     maxRetries = 3
-    memory 300.GB
+    memory { 64.GB * task.attempt }
     time 48.h
     publishDir "${params.outdir}/${patient_id}/segmentation", mode: 'copy', pattern: "*.{pkl,npy}"
     container "docker://yinxiu/attend_seg:v0.0"
     tag "segmentation"
 
     input:
-        tuple val(patient_id), path(dapi)
+        tuple val(patient_id), path(dapi), path(tissue_index)
     output:
         // tuple val(patient_id), path("registered_${patient_id}*h5"), emit: "h5"
         tuple val(patient_id), path("positions.pkl"), path("segmentation_mask.npy"), emit: "segmentation"
@@ -19,7 +19,12 @@ process segmentation{
         --dapi-file "$dapi" \
         --model-dir "${params.segmentation_model_dir}" \
         --model-name "${params.segmentation_model}" \
-        --overlap "${params.segmentation_overlap}" \
+        --tile-size ${params.segmentation_tile_size} \
+        --max-nucleus-diameter ${params.segmentation_max_nucleus_diameter} \
+        --tissue-index "$tissue_index" \
+        --batch-size ${params.segmentation_batch_size} \
+        --iou-threshold ${params.segmentation_iou_threshold} \
+        --n-workers ${task.cpus} \
         --output-dir "./" \
         --verbose
         
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Benchmark HDF5 chunk layouts and compression for region reads
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from utils.io import load_h5, save_h5
+
+
+def make_synthetic_image(shape, seed=0):
+    """
+    Create a uint16 YXC image that looks like a padded tissue scan: a zero
+    border (padding and glass) around a textured foreground.
+    """
+    rng = np.random.default_rng(seed)
+    Y, X, C = shape
+    image = np.zeros(shape, dtype=np.uint16)
+    margin_y, margin_x = Y // 8, X // 8
+    core = (Y - 2 * margin_y, X - 2 * margin_x, C)
+    # Smooth background signal plus Poisson noise, similar to a fluorescence scan
+    yy, xx = np.mgrid[0 : core[0], 0 : core[1]]
+    signal = 400 + 300 * np.sin(yy / 97.0) * np.cos(xx / 131.0)
+    for c in range(C):
+        image[margin_y : Y - margin_y, margin_x : X - margin_x, c] = rng.poisson(
+            np.clip(signal * (c + 1), 0, None)
+        ).astype(np.uint16)
+    return image
+
+
+def get_layouts(chunk_size):
+    layouts = [("h5py auto chunks, no compression", "YXC", dict(chunk_size=None, compression=None))]
+    for shape in ("YXC", "CYX"):
+        for compression in (None, "lzf", "gzip", "lz4", "blosc"):
+            name = f"{shape} {chunk_size} px chunks, {compression or 'no compression'}"
+            layouts.append((name, shape, dict(chunk_size=chunk_size, compression=compression)))
+    return layouts
+
+
+def get_regions(shape, crop_size, overlap_size):
+    Y, X = shape[:2]
+    regions = []
+    for start_row in range(0, Y - overlap_size, crop_size - overlap_size):
+        for start_col in range(0, X - overlap_size, crop_size - overlap_size):
+            regions.append(
+                (start_row, min(start_row + crop_size, Y), start_col, min(start_col + crop_size, X))
+            )
+    return regions
+
+
+def benchmark_layout(image, path, regions, shape, options, repeats):
+    data = np.moveaxis(image, -1, 0) if shape == "CYX" else image
+    start = time.perf_counter()
+    save_h5(data, path, shape=shape, **options)
+    write_time = time.perf_counter() - start
+    size = os.path.getsize(path)
+
+    read_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for region in regions:
+            load_h5(path, loading_region=region, shape=shape)
+        read_times.append(time.perf_counter() - start)
+    read_time = min(read_times)
+
+    start = time.perf_counter()
+    for region in regions:
+        load_h5(path, loading_region=region, channels_to_load=-1, shape=shape)
+    dapi_time = time.perf_counter() - start
+
+    read_bytes = sum(
+        (r[1] - r[0]) * (r[3] - r[2]) * image.shape[2] * image.itemsize for r in regions
+    )
+    return {
+        "write_s": write_time,
+        "size_mb": size / 1024**2,
+        "ratio": image.nbytes / size,
+        "read_mb_s": read_bytes / 1024**2 / read_time,
+        "dapi_read_s": dapi_time,
+    }
+
+
+def _parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--height", type=int, default=12000, help="Image height.")
+    parser.add_argument("--width", type=int, default=12000, help="Image width.")
+    parser.add_argument("--channels", type=int, default=3, help="Number of channels.")
+    parser.add_argument("--crop_size", type=int, default=2000, help="Size of the crop.")
+    parser.add_argument("--overlap_size", type=int, default=800, help="Size of the overlap.")
+    parser.add_argument(
+        "--chunk_size", type=int, default=400, help="Chunk edge along Y and X (h5_chunk_size)."
+    )
+    parser.add_argument("--repeats", type=int, default=3, help="Number of read passes.")
+    parser.add_argument(
+        "--tmpdir", type=str, default=None, help="Directory for the benchmark files."
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+
+    shape = (args.height, args.width, args.channels)
+    image = make_synthetic_image(shape)
+    regions = get_regions(shape, args.crop_size, args.overlap_size)
+    print(
+        f"Image {shape} uint16 ({image.nbytes / 1024**2:.0f} MB), "
+        f"{len(regions)} regions of {args.crop_size} px (overlap {args.overlap_size} px)"
+    )
+
+    header = f"{'layout':<40} {'write s':>8} {'size MB':>9} {'ratio':>6} {'read MB/s':>10} {'DAPI read s':>12}"
+    print(header)
+    print("-" * len(header))
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        for name, layout, options in get_layouts(args.chunk_size):
+            path = os.path.join(tmpdir, "benchmark.h5")
+            result = benchmark_layout(image, path, regions, layout, options, args.repeats)
+            print(
+                f"{name:<40} {result['write_s']:>8.2f} {result['size_mb']:>9.1f} "
+                f"{result['ratio']:>6.2f} {result['read_mb_s']:>10.1f} {result['dapi_read_s']:>12.2f}"
+            )
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
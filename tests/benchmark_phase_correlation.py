@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Benchmark phase-correlation pre-alignment before the diffeomorphic registration
+
+import argparse
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from utils.mapping import (
+    apply_mapping,
+    compute_diffeomorphic_mapping_dipy,
+    estimate_translation_phase_correlation,
+)
+
+
+def make_nuclei_image(size, n_nuclei, seed=0):
+    """
+    Create a uint16 DAPI-like tile: blurred elliptical nuclei on a dark background.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((size, size), dtype=np.float32)
+    for _ in range(n_nuclei):
+        center = tuple(int(v) for v in rng.integers(0, size, 2))
+        axes = tuple(int(v) for v in rng.integers(4, 9, 2))
+        angle = float(rng.uniform(0, 180))
+        cv2.ellipse(image, center, axes, angle, 0, 360, float(rng.uniform(0.5, 1.0)), -1)
+    image = cv2.GaussianBlur(image, (0, 0), 1.5)
+    image = image * 3000 + rng.normal(100, 10, image.shape)
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def deform(image, shift, amplitude, seed=0):
+    """
+    Translate an image by `shift` (x, y) and add a smooth sinusoidal deformation.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = image.shape
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+    phase_x, phase_y = rng.uniform(0, 2 * np.pi, 2)
+    map_x = cols - shift[0] + amplitude * np.sin(2 * np.pi * rows / height + phase_x)
+    map_y = rows - shift[1] + amplitude * np.sin(2 * np.pi * cols / width + phase_y)
+    return cv2.remap(
+        image.astype(np.float32), map_x.astype(np.float32), map_y.astype(np.float32),
+        interpolation=cv2.INTER_LINEAR,
+    ).astype(np.uint16)
+
+
+def register(fixed, moving, profile, pre_align):
+    start = time.perf_counter()
+    shift_error = None
+    if pre_align:
+        translation, _ = estimate_translation_phase_correlation(fixed, moving)
+        if translation is not None:
+            moving = apply_mapping(translation, moving, method="cv2")
+            shift_error = translation[:, 2]
+    mapping, info = compute_diffeomorphic_mapping_dipy(
+        y=fixed, x=moving, profile=profile, return_info=True
+    )
+    elapsed = time.perf_counter() - start
+    registered = apply_mapping(mapping, moving, method="remap")
+    error = np.abs(registered.astype(np.float64) - fixed.astype(np.float64)).mean()
+    return info["iterations"], elapsed, error, shift_error
+
+
+def _parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tile_size", type=int, default=1000, help="Size of the tiles.")
+    parser.add_argument("--n_nuclei", type=int, default=1500, help="Number of nuclei per tile.")
+    parser.add_argument("--n_tiles", type=int, default=3, help="Number of tile pairs.")
+    parser.add_argument("--max_shift", type=float, default=25.0, help="Largest simulated translation.")
+    parser.add_argument("--amplitude", type=float, default=3.0, help="Amplitude of the deformation.")
+    parser.add_argument("--profile", type=str, default="balanced", help="dipy registration profile.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+    rng = np.random.default_rng(0)
+
+    header = f"{'tile':>4} {'shift (x, y)':>16} {'pre-align':>9} {'iterations':>10} {'time s':>7} {'mean abs err':>12}"
+    print(header)
+    print("-" * len(header))
+    totals = {False: [0, 0.0], True: [0, 0.0]}
+    for tile in range(args.n_tiles):
+        fixed = make_nuclei_image(args.tile_size, args.n_nuclei, seed=tile)
+        shift = rng.uniform(-args.max_shift, args.max_shift, 2)
+        moving = deform(fixed, shift, args.amplitude, seed=tile)
+
+        for pre_align in (False, True):
+            iterations, elapsed, error, estimated = register(fixed, moving, args.profile, pre_align)
+            totals[pre_align][0] += iterations
+            totals[pre_align][1] += elapsed
+            print(
+                f"{tile:>4} {f'({shift[0]:.1f}, {shift[1]:.1f})':>16} {str(pre_align):>9} "
+                f"{iterations:>10} {elapsed:>7.2f} {error:>12.1f}"
+            )
+            if estimated is not None:
+                print(f"{'':>4} phase correlation correction: ({estimated[0]:.2f}, {estimated[1]:.2f})")
+
+    print()
+    for pre_align, (iterations, elapsed) in totals.items():
+        print(f"pre-align={pre_align}: {iterations} iterations, {elapsed:.2f} s in total")
+
+
+if __name__ == "__main__":
+    main()
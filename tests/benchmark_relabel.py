@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Benchmark the lookup-table label remapping against the per-label loop and np.vectorize
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from utils.labels import offset_labels, relabel_sequential
+
+
+def remap_mask_crop_values_loop(mask, offset):
+    """Previous implementation: one full-crop comparison per label."""
+    if offset == 0:
+        return mask
+    remapped_mask = mask.copy()
+    for val in np.unique(mask[mask > 0]):
+        remapped_mask[mask == val] = val + offset
+    return remapped_mask
+
+
+def remap_mask_values_vectorize(arr):
+    """Previous implementation: a Python dict lookup per pixel."""
+    nonzero_vals = np.unique(arr[arr != 0])
+    val_to_rank = {val: i + 1 for i, val in enumerate(nonzero_vals)}
+    return np.vectorize(lambda x: val_to_rank.get(x, 0))(arr)
+
+
+def make_label_mask(size, n_labels, cell_size=12, seed=0):
+    """
+    Create a label image of square cells with shuffled, gapped labels,
+    as left by stitching overlapping crops.
+    """
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.int32)
+    labels = rng.choice(np.arange(1, 3 * n_labels), size=n_labels, replace=False)
+    for label in labels:
+        row, col = rng.integers(0, size - cell_size, 2)
+        mask[row : row + cell_size, col : col + cell_size] = label
+    return mask
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def _parse_args():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crop_size", type=int, default=2000, help="Size of the crop.")
+    parser.add_argument("--n_labels", type=int, default=2000, help="Number of labels per crop.")
+    parser.add_argument("--mask_size", type=int, default=4000, help="Size of the stitched mask.")
+    parser.add_argument("--n_mask_labels", type=int, default=20000, help="Number of labels of the stitched mask.")
+    parser.add_argument("--offset", type=int, default=100000, help="Label offset of the crop.")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = _parse_args()
+
+    crop = make_label_mask(args.crop_size, args.n_labels)
+    expected, loop_time = timed(remap_mask_crop_values_loop, crop, args.offset)
+    result, lut_time = timed(offset_labels, crop.copy(), args.offset)
+    assert np.array_equal(result, expected), "offset_labels differs from the per-label loop"
+    print(
+        f"remap_mask_crop_values ({args.crop_size}^2, {args.n_labels} labels): "
+        f"loop {loop_time:.2f} s, vectorized {lut_time:.4f} s ({loop_time / lut_time:.0f}x)"
+    )
+
+    mask = make_label_mask(args.mask_size, args.n_mask_labels, seed=1)
+    expected, vectorize_time = timed(remap_mask_values_vectorize, mask)
+    result, lut_time = timed(relabel_sequential, mask.copy())
+    assert np.array_equal(result, expected), "relabel_sequential differs from np.vectorize"
+    print(
+        f"remap_mask_values ({args.mask_size}^2, {args.n_mask_labels} labels): "
+        f"np.vectorize {vectorize_time:.2f} s, lookup table {lut_time:.4f} s "
+        f"({vectorize_time / lut_time:.0f}x), output {result.dtype}"
+    )
+
+
+if __name__ == "__main__":
+    main()